@@ -3,3 +3,6 @@ from app.api.v1 import auth
 from app.api.v1 import chat
 from app.api.v1 import group
 from app.api.v1 import group_chat
+from app.api.v1 import conversation
+from app.api.v1 import system
+from app.api.v1 import key
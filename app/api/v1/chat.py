@@ -2,92 +2,334 @@ import uuid
 
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.extensions import logger, db, sio
-from app.models import Message, User, Friend, UserMessage
-from app.socket_handler import online_users
-from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, generate_id, is_user_online
+from sqlalchemy.exc import IntegrityError
+
+from app.extensions import logger, db, delivery, recent_messages, user_friends
+from app.enums import CONVERSATION_PRIVATE, MAX_BATCH_MESSAGES
+from app.models import Message, User, Friend, UserMessage, Conversation
+from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, generate_id, generate_ids, \
+    is_user_online, emit_to_user, emit_to_users, encode_cursor, decode_cursor, is_client_message_id
 
 api = Blueprint('chats', __name__)
 
 
-@api.route('/<string:receiver_id>', methods=['POST'])
-@jwt_required
-def chat_private(receiver_id):
-    """ This is api for .
+def mark_seen(user_id, partner_id):
+    """
+    Mark the messages of the partner as seen by the user by moving the read watermark of the conversation and send
+    the receipt to the partner
+    Args:
+        user_id:
+        partner_id:
 
-        Request Body:
+    Returns:
 
-        Returns:
+    """
+    seen_date = get_timestamp_now()
+    seen = Conversation.mark_seen(user_id, partner_id, seen_date)
+    db.session.commit()
+    if seen:
+        receipt = {"conversation_id": user_id, "user_id": user_id, "seen_date": seen_date}
+        # the watermark is committed, a retry of the delivery queue only sends the receipt again
+        emit_to_users('seen', receipt, [partner_id])
 
-        Examples::
+
+def find_sent_messages(current_user_id, client_messages_id):
     """
+    Find the messages the user already sent with these client message ids, in the recent messages cache first then
+    with one query for the others
+    Args:
+        current_user_id:
+        client_messages_id: list client message ids
+
+    Returns:
+        dict client message id -> message with the cipher text of the sender
+
+    """
+    rs = {}
+    missing = []
+    for client_message_id in client_messages_id:
+        data = recent_messages.get((CONVERSATION_PRIVATE, current_user_id, client_message_id))
+        if data is None:
+            missing.append(client_message_id)
+        else:
+            rs[client_message_id] = dict(data)
+
+    for client_message_id, row in Message.get_by_client_message_ids(current_user_id, missing).items():
+        rs[client_message_id] = Message.to_json(row)
+        recent_messages.set((CONVERSATION_PRIVATE, current_user_id, client_message_id), rs[client_message_id])
+    return rs
+
+
+def send_message(current_user_id, receiver_id, messages, client_message_id=None):
+    """
+    Store a private message and queue its delivery, used by the api and by the socket event private_chat
+    Args:
+        current_user_id:
+        receiver_id:
+        messages: dict user id -> cipher text of the message for this user, contains the sender and the receiver
+        client_message_id: idempotency key, sending again with the same key returns the stored message
+
+    Returns:
+        (message with the cipher text of the sender, None) or (None, error message)
+
+    """
+    if not is_client_message_id(client_message_id):
+        return None, "Input data error"
+    if client_message_id is not None:
+        stored = find_sent_messages(current_user_id, [client_message_id])
+        if client_message_id in stored:
+            return stored[client_message_id], None
 
     check_receiver = User.get_by_id(receiver_id)
     if check_receiver is None:
-        return send_error(message="Not found receiver")
-    current_user_id = get_jwt_identity()
-    try:
-        json_data = request.get_json()
-        messages = json_data.get('messages', None)
-    except Exception as ex:
-        logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
-        return send_error(message="Parameters error: " + str(ex))
+        return None, "Not found receiver"
 
-    if current_user_id not in messages.keys() or receiver_id not in messages.keys():
-        return send_error(message="Input data error")
+    if not isinstance(messages, dict) or current_user_id not in messages or receiver_id not in messages:
+        return None, "Input data error"
 
     created_date = get_timestamp_now()
     message_id = str(uuid.uuid1())
 
     group_id = generate_id(current_user_id, receiver_id)
 
-    friend = Friend.check_friend(receiver_id)
+    friend = Friend.check_friend(receiver_id, current_user_id)
     if friend is None:
         new_obj1 = Friend(id=str(uuid.uuid1()), user_id=current_user_id, friend_id=receiver_id, group_id=group_id)
         new_obj2 = Friend(id=str(uuid.uuid1()), user_id=receiver_id, friend_id=current_user_id, group_id=group_id)
         db.session.add(new_obj1)
         db.session.add(new_obj2)
         db.session.commit()
+        user_friends.invalidate(current_user_id)
+        user_friends.invalidate(receiver_id)
 
     new_values = Message(id=message_id, sender_id=current_user_id, receiver_id=receiver_id, group_id=group_id,
-                         created_date=created_date)
+                         created_date=created_date, client_message_id=client_message_id)
     db.session.add(new_values)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # a retry with the same client message id was stored first
+        db.session.rollback()
+        stored = find_sent_messages(current_user_id, [client_message_id])
+        if client_message_id not in stored:
+            raise
+        return stored[client_message_id], None
 
     new_u_s = UserMessage(message=messages[current_user_id], user_id=current_user_id, message_id=message_id)
     db.session.add(new_u_s)
 
+    recipients = [(current_user_id, receiver_id, messages[current_user_id])]
     if receiver_id != current_user_id:
         new_u_s = UserMessage(message=messages[receiver_id], user_id=receiver_id, message_id=message_id)
         db.session.add(new_u_s)
+        recipients.append((receiver_id, current_user_id, messages[receiver_id]))
 
+    Conversation.update_latest(CONVERSATION_PRIVATE, message_id, current_user_id, created_date, recipients)
     db.session.commit()
     data = {
         "id": new_values.id,
         "sender_id": new_values.sender_id,
         "receiver_id": new_values.receiver_id,
         "created_date": new_values.created_date,
-        "seen": new_values.seen,
+        "seen": False,
         "message": messages[receiver_id]
     }
 
-    receivers_session_id = [key for key, value in online_users.items() if value == receiver_id]
-    for session_id in receivers_session_id:
-        sio.emit('new_private_msg', data, room=session_id)
-
-    unseen_messages = Message.query.filter_by(sender_id=receiver_id, group_id=group_id, seen=False).all()
-    for msg in unseen_messages:
-        msg.seen = True
-    db.session.commit()
+    # the message is stored, the receiver gets it and the sender has read the conversation after the response, in the
+    # order of the jobs of the receiver
+    delivery.put(emit_to_user, 'new_private_msg', dict(data), receiver_id, key=receiver_id)
+    delivery.put(mark_seen, current_user_id, receiver_id, key=receiver_id)
 
     data["message"] = messages[current_user_id]
+    if client_message_id is not None:
+        recent_messages.set((CONVERSATION_PRIVATE, current_user_id, client_message_id), dict(data))
+    return data, None
+
+
+@api.route('/<string:receiver_id>', methods=['POST'])
+@jwt_required
+def chat_private(receiver_id):
+    """ This is api for .
+
+        Request Body:
+
+            messages: dict user id -> cipher text of the message for this user
+            client_message_id: optional idempotency key, sending again with the same key returns the stored message
+
+        Returns:
+
+        Examples::
+    """
+
+    current_user_id = get_jwt_identity()
+    try:
+        json_data = request.get_json()
+        messages = json_data.get('messages', None)
+        client_message_id = json_data.get('client_message_id', None)
+    except Exception as ex:
+        logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
+        return send_error(message="Parameters error: " + str(ex))
+
+    data, error = send_message(current_user_id, receiver_id, messages, client_message_id)
+    if error is not None:
+        return send_error(message=error)
     return send_result(data=data)
 
 
+def send_messages(current_user_id, items):
+    """
+    Store a batch of private messages in one transaction and queue their delivery, the receivers, the friendships and
+    the client message ids are checked with one query each. A client message id which is already stored or appears
+    twice in the batch returns the stored message instead of a new one, an item with a wrong type fails alone with
+    "Input data error"
+    Args:
+        current_user_id:
+        items: list {client_message_id, receiver_id, messages}, messages is the dict user id -> cipher text
+
+    Returns:
+        (list {client_message_id, status, message, data} in the order of items, None) or (None, error message)
+
+    """
+    if not isinstance(items, list):
+        return None, "Input data error"
+    if len(items) > MAX_BATCH_MESSAGES:
+        return None, "Too many messages, the maximum is {}".format(MAX_BATCH_MESSAGES)
+
+    valid_items = [item for item in items if isinstance(item, dict) and isinstance(item.get("receiver_id"), str)
+                   and is_client_message_id(item.get("client_message_id"))]
+    receivers_id = {item["receiver_id"] for item in valid_items}
+    existed_receivers = [user_id for user_id, in db.session.query(User.id).filter(User.id.in_(receivers_id)).all()]
+    groups_id = dict(zip(existed_receivers, generate_ids(current_user_id, existed_receivers)))
+    stored = find_sent_messages(current_user_id, {item.get("client_message_id") for item in valid_items
+                                                  if item.get("client_message_id") is not None})
+
+    created_date = get_timestamp_now()
+    results = []
+    accepted = {}
+    new_messages = []
+    for item in items:
+        if not isinstance(item, dict):
+            item = {}
+        client_message_id = item.get("client_message_id")
+        receiver_id = item.get("receiver_id")
+        messages = item.get("messages")
+        result = {"client_message_id": client_message_id, "status": True, "message": "OK", "data": None}
+        results.append(result)
+
+        if not isinstance(receiver_id, str) or not is_client_message_id(client_message_id):
+            result.update(status=False, message="Input data error")
+        elif client_message_id in stored:
+            result["data"] = stored[client_message_id]
+        elif client_message_id in accepted:
+            result["data"] = accepted[client_message_id]
+        elif receiver_id not in groups_id:
+            result.update(status=False, message="Not found receiver")
+        elif not isinstance(messages, dict) or not isinstance(messages.get(current_user_id), str) \
+                or not isinstance(messages.get(receiver_id), str):
+            result.update(status=False, message="Input data error")
+        else:
+            message_id = str(uuid.uuid1())
+            new_messages.append({"id": message_id, "sender_id": current_user_id, "receiver_id": receiver_id,
+                                 "group_id": groups_id[receiver_id], "created_date": created_date,
+                                 "client_message_id": client_message_id,
+                                 "messages": {current_user_id: messages[current_user_id],
+                                              receiver_id: messages[receiver_id]}})
+            result["data"] = {"id": message_id, "sender_id": current_user_id, "receiver_id": receiver_id,
+                              "created_date": created_date, "seen": False, "message": messages[current_user_id]}
+            if client_message_id is not None:
+                accepted[client_message_id] = result["data"]
+
+    if not new_messages:
+        return results, None
+
+    by_receiver = {}
+    for item in new_messages:
+        by_receiver.setdefault(item["receiver_id"], []).append(item)
+
+    friends_id = {friend_id for friend_id, in db.session.query(Friend.friend_id)
+                  .filter(Friend.user_id == current_user_id, Friend.friend_id.in_(list(by_receiver))).all()}
+    new_friends = [receiver_id for receiver_id in by_receiver if receiver_id not in friends_id]
+    for receiver_id in new_friends:
+        group_id = groups_id[receiver_id]
+        db.session.add(Friend(id=str(uuid.uuid1()), user_id=current_user_id, friend_id=receiver_id, group_id=group_id))
+        if receiver_id != current_user_id:
+            db.session.add(Friend(id=str(uuid.uuid1()), user_id=receiver_id, friend_id=current_user_id,
+                                  group_id=group_id))
+
+    try:
+        Message.insert_messages(new_messages)
+    except IntegrityError:
+        # a retry of the same batch stored the client message ids first
+        db.session.rollback()
+        return None, "Duplicate client message id, send the batch again"
+    for receiver_id, receiver_messages in by_receiver.items():
+        last = receiver_messages[-1]
+        recipients = [(current_user_id, receiver_id, last["messages"][current_user_id])]
+        if receiver_id != current_user_id:
+            recipients.append((receiver_id, current_user_id, last["messages"][receiver_id]))
+        Conversation.update_latest(CONVERSATION_PRIVATE, last["id"], current_user_id, created_date, recipients,
+                                   unseen=len(receiver_messages))
+    db.session.commit()
+    if new_friends:
+        user_friends.invalidate(current_user_id)
+        for receiver_id in new_friends:
+            user_friends.invalidate(receiver_id)
+
+    for client_message_id, data in accepted.items():
+        recent_messages.set((CONVERSATION_PRIVATE, current_user_id, client_message_id), dict(data))
+    # one event per receiver with its messages, queued with the other jobs of the receiver
+    for receiver_id, receiver_messages in by_receiver.items():
+        delivery.put(emit_to_user, 'new_private_msgs', [
+            {"id": item["id"], "sender_id": current_user_id, "receiver_id": receiver_id, "created_date": created_date,
+             "seen": False, "message": item["messages"][receiver_id]} for item in receiver_messages],
+            receiver_id, key=receiver_id)
+        delivery.put(mark_seen, current_user_id, receiver_id, key=receiver_id)
+    return results, None
+
+
+@api.route('/batch', methods=['POST'])
+@jwt_required
+def chat_batch():
+    """ This is api for sending several private messages at once, like the outbox of a client which is back online.
+
+        Request Body:
+
+            items: list {client_message_id, receiver_id, messages}, at most MAX_BATCH_MESSAGES items,
+            client_message_id is the idempotency key of the message, sending the batch again does not duplicate the
+            messages already stored. The receivers get all their new messages in one event new_private_msgs
+
+        Returns:
+
+            list {client_message_id, status, message, data} in the order of the items, data is the stored message
+
+        Examples::
+    """
+
+    current_user_id = get_jwt_identity()
+    try:
+        json_data = request.get_json()
+        items = json_data.get('items', None)
+    except Exception as ex:
+        logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
+        return send_error(message="Parameters error: " + str(ex))
+
+    results, error = send_messages(current_user_id, items)
+    if error is not None:
+        return send_error(message=error)
+    return send_result(data=results)
+
+
 @api.route('/<string:partner_id>', methods=['GET'])
 @jwt_required
 def get(partner_id):
     """ This api for .
 
+        Query params:
+
+            page, page_size: offset pagination, data is the list messages
+            before: cursor pagination, send an empty value to get the first page then the next_cursor of the
+            previous page, data is {"items": list messages, "next_cursor": string or null}
+
         Returns:
 
         Examples::
@@ -95,6 +337,14 @@ def get(partner_id):
     """
     page = request.args.get('page', 1, type=int)
     page_size = request.args.get('page_size', 10, type=int)
+    cursor_mode = 'before' in request.args
+    before = request.args.get('before', None, type=str)
+
+    cursor = None
+    if before:
+        cursor = decode_cursor(before)
+        if cursor is None:
+            return send_error(message="Invalid cursor")
 
     partner = User.get_by_id(partner_id)
     if partner is None:
@@ -103,14 +353,22 @@ def get(partner_id):
     current_user_id = get_jwt_identity()
     group_id = generate_id(current_user_id, partner_id)
 
-    messages = Message.get_messages(group_id=group_id, page=page, page_size=page_size)
-    unseen_messages = Message.query.filter_by(sender_id=partner_id, group_id=group_id, seen=False).all()
-    for msg in unseen_messages:
-        msg.seen = True
-    db.session.commit()
+    if cursor_mode:
+        messages = Message.get_messages_before(group_id=group_id, before=cursor, page_size=page_size)
+    else:
+        messages = Message.get_messages(group_id=group_id, page=page, page_size=page_size)
+    mark_seen(current_user_id, partner_id)
+
+    seen_dates = Conversation.get_seen_dates([(current_user_id, partner_id), (partner_id, current_user_id)])
+    items = Message.many_to_json(messages, seen_dates)
+    if not cursor_mode:
+        return send_result(data=items)
 
-    messages = Message.many_to_json(messages)
-    return send_result(data=messages)
+    next_cursor = None
+    if len(messages) == page_size:
+        last = messages[-1].Message
+        next_cursor = encode_cursor(last.created_date, last.id)
+    return send_result(data={"items": items, "next_cursor": next_cursor})
 
 
 @api.route('/<string:message_id>', methods=['DELETE'])
@@ -131,6 +389,8 @@ def delete(message_id):
 @jwt_required
 def get_chats():
     """ This api for the user get their list chats.
+        Deprecated, GET /api/v1/conversations lists the private and group conversations with a cursor. Both read the
+        same inbox rows, this api keeps the offset pagination and the response of the private chats.
 
         Returns:
 
@@ -142,33 +402,31 @@ def get_chats():
     page_size = request.args.get('page_size', 10, type=int)
 
     current_user_id = get_jwt_identity()
-
-    friends = User.get_all_friends()
-
-    for friend in friends:
-        group_id = generate_id(current_user_id, friend["id"])
-        message = Message.query.filter_by(group_id=group_id, seen=False) \
-            .add_columns(UserMessage.message) \
-            .join(UserMessage, Message.id == UserMessage.message_id) \
-            .filter(UserMessage.user_id == current_user_id) \
-            .order_by(Message.created_date.desc()).first()
-
-        unseen = Message.query.filter_by(sender_id=friend["id"], group_id=group_id, seen=False).count()
-        friend["latest_message"] = None
-        friend["unseen"] = unseen
-        if message:
-            friend["latest_message"] = Message.to_json(message)
-
-    list_chats = [friend for friend in friends if friend["latest_message"]]
-
-    list_chats_sorted = sorted(list_chats, key=lambda k: k["latest_message"]["created_date"], reverse=True)
-    st = (page - 1) * page_size
-    end = st + page_size
-    len_list = len(list_chats_sorted)
-    if end > len_list:
-        end = len_list
-
-    rs = list_chats_sorted[st:end]
+    rows = [row for row in Conversation.get_inbox(page_size=page_size, conversation_type=CONVERSATION_PRIVATE,
+                                                  page=page) if row.User]
+    # the partner's watermark tells if the latest message of the current user has been seen
+    seen_dates = Conversation.get_seen_dates([(row.Conversation.conversation_id, current_user_id) for row in rows])
+
+    rs = []
+    for row in rows:
+        conversation = row.Conversation
+        friend = row.User.to_json()
+        friend["unseen"] = conversation.unseen
+        if conversation.last_sender_id == current_user_id:
+            receiver_id = conversation.conversation_id
+            seen_date = seen_dates.get((conversation.conversation_id, current_user_id), 0)
+        else:
+            receiver_id = current_user_id
+            seen_date = conversation.last_seen_date or 0
+        friend["latest_message"] = {
+            "id": conversation.last_message_id,
+            "message": conversation.last_message,
+            "sender_id": conversation.last_sender_id,
+            "receiver_id": receiver_id,
+            "created_date": conversation.last_created_date,
+            "seen": conversation.last_created_date <= seen_date
+        }
+        rs.append(friend)
 
     return send_result(data=rs)
 
@@ -178,7 +436,8 @@ def get_chats():
 def get_info_conversation(partner_id):
     """ This api for .
 
-        Returns:
+        Returns: users: user id -> {public_key, key_fingerprint, key_version, avatar_path}, public_key is deprecated,
+        the clients compare key_fingerprint and key_version with their copy and fetch the changed keys from GET /keys
 
         Examples::
 
@@ -193,10 +452,14 @@ def get_info_conversation(partner_id):
     users_info = {
         partner_id: {
             "public_key": partner.pub_key,
+            "key_fingerprint": partner.pub_key_fingerprint,
+            "key_version": partner.pub_key_version,
             "avatar_path": partner.avatar_path
         },
         current_user.id: {
             "public_key": current_user.pub_key,
+            "key_fingerprint": current_user.pub_key_fingerprint,
+            "key_version": current_user.pub_key_version,
             "avatar_path": current_user.avatar_path
         }
     }
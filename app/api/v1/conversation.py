@@ -0,0 +1,49 @@
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required
+
+from app.models import Conversation
+from app.utils import send_result, send_error, encode_cursor, decode_cursor
+
+api = Blueprint('conversations', __name__)
+
+
+@api.route('', methods=['GET'])
+@jwt_required
+def get_conversations():
+    """ This api for the user get their private and group conversations ordered by the latest message.
+
+        Query params:
+
+            page_size: int, default 10
+            before: string, the next_cursor of the previous page, omit to get the first page
+
+        Returns:
+
+            items: list conversations
+            next_cursor: string or null if this is the last page
+
+        Examples::
+
+    """
+
+    page_size = request.args.get('page_size', 10, type=int)
+    before = request.args.get('before', None, type=str)
+
+    cursor = None
+    if before:
+        cursor = decode_cursor(before)
+        if cursor is None:
+            return send_error(message="Invalid cursor")
+
+    rows = Conversation.get_inbox(before=cursor, page_size=page_size)
+
+    next_cursor = None
+    if len(rows) == page_size:
+        last = rows[-1].Conversation
+        next_cursor = encode_cursor(last.last_created_date, last.conversation_id)
+
+    rs = {
+        "items": Conversation.many_to_json(rows),
+        "next_cursor": next_cursor
+    }
+    return send_result(data=rs)
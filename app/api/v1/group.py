@@ -7,9 +7,10 @@ from werkzeug.security import safe_str_cmp
 from werkzeug.utils import secure_filename
 
 from app.enums import AVATAR_PATH, AVATAR_PATH_SEVER, DEFAULT_GROUP_AVATAR
-from app.extensions import logger, db, sio
-from app.models import User, GroupUser, Group
-from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, allowed_file_img
+from app.extensions import logger, db, sio, group_members
+from app.models import User, GroupUser, Group, Conversation
+from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, allowed_file_img, \
+    generate_members_hash
 
 api = Blueprint('groups', __name__)
 
@@ -34,30 +35,28 @@ def create_group():
         logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
         return send_error(message="Parameters error: " + str(ex))
 
-    groups = Group.get_all()
+    users = User.query.filter(User.id.in_(users_id)).all()
+    members_hash = generate_members_hash([user.id for user in users])
     # check if members group existed
-    for g in groups:
-        group_user = GroupUser.query.filter_by(group_id=g.id).all()
-        if len(group_user) == len(users_id):
-            set_users_id = set(users_id)
-            set_users_group = set([u.user_id for u in group_user])
-            if set_users_id == set_users_group:
-                return send_result(data=g.to_json())
+    group = Group.get_by_members_hash(members_hash)
+    if group:
+        return send_result(data=group.to_json())
 
     created_date = get_timestamp_now()
     group_id = str(uuid.uuid1())
-    new_group = Group(id=group_id, name=name, created_date=created_date)
+    new_group = Group(id=group_id, name=name, created_date=created_date, members_hash=members_hash)
     db.session.add(new_group)
     # insert new values to table group_user
-    for user_id in users_id:
-        user = User.get_by_id(user_id)
-        if user:
-            new_obj = GroupUser(user_id=user_id, group_id=group_id)
-            db.session.add(new_obj)
-            data = {'username': user.username, 'room': group_id}
-            sio.emit('join', data)
+    for user in users:
+        new_obj = GroupUser(user_id=user.id, group_id=group_id)
+        db.session.add(new_obj)
+        data = {'username': user.username, 'room': group_id}
+        sio.emit('join', data)
 
     db.session.commit()
+    group_members.invalidate(group_id)
+    # the members may type in the new group at once, load it now
+    GroupUser.get_members_id(group_id)
 
     return send_result(data=new_group.to_json())
 
@@ -123,13 +122,19 @@ def update_member(group_id):
     if status == "add" and check is None:
         new_obj = GroupUser(user_id=user_id, group_id=group_id)
         db.session.add(new_obj)
+        group.update_members_hash()
         db.session.commit()
+        group_members.invalidate(group_id)
+        GroupUser.get_members_id(group_id)
         data = {'username': user.username, 'room': group_id}
         sio.emit('join', data)
         return send_result()
 
     GroupUser.query.filter_by(user_id=user_id, group_id=group_id).delete()
+    Conversation.delete_conversation(user_id, group_id)
+    group.update_members_hash()
     db.session.commit()
+    group_members.invalidate(group_id)
     data = {'username': user.username, 'room': group_id}
     sio.emit('leave', data)
 
@@ -191,6 +196,7 @@ def delete(group_id):
     """
 
     Group.query.filter_by(id=group_id).delete()
+    group_members.invalidate(group_id)
     return send_result()
 
 
@@ -2,14 +2,168 @@ import uuid
 
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.extensions import logger, db, sio
-from app.models import Group, GroupUser, GroupMessage, UserMessageGroup, User
-from app.socket_handler import online_users
-from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, is_user_online
+from sqlalchemy.exc import IntegrityError
+
+from app.delivery import PartialDelivery
+from app.extensions import logger, db, delivery, recent_messages
+from app.enums import CONVERSATION_GROUP, MESSAGE_VERSION_RSA, MESSAGE_VERSION_ENVELOPE
+from app.models import Group, GroupUser, GroupMessage, User, Conversation
+from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, is_user_online, emit_to_user, \
+    emit_to_users, encode_cursor, decode_cursor, is_client_message_id
 
 api = Blueprint('group_chats', __name__)
 
 
+def deliver_message(data, messages):
+    """
+    Emit the message to every member with the cipher text of the member
+    Args:
+        data: the message without the cipher text, with the body of an envelope
+        messages: dict member id -> cipher text, the encrypted key of the member for an envelope
+
+    Raises:
+        PartialDelivery: with the members whose emit failed, the delivery queue retries only them
+
+    """
+    failed, error = {}, None
+    for member_id, message in messages.items():
+        data["message"] = message
+        try:
+            emit_to_user('new_group_msg', data, member_id)
+        except Exception as ex:
+            failed[member_id] = message
+            error = ex
+    if failed:
+        raise PartialDelivery(error, deliver_message, data, failed)
+
+
+def mark_seen(user_id, group_id):
+    """
+    Mark the messages of the group as seen by the user by moving the read watermark of the conversation and send the
+    receipt to the other members
+    Args:
+        user_id:
+        group_id:
+
+    Returns:
+
+    """
+    seen_date = get_timestamp_now()
+    seen = Conversation.mark_seen(user_id, group_id, seen_date)
+    db.session.commit()
+    if seen:
+        receipt = {"conversation_id": group_id, "user_id": user_id, "seen_date": seen_date}
+        emit_to_users('seen', receipt, [member_id for member_id in GroupUser.get_members_id(group_id)
+                                        if member_id != user_id])
+
+
+def find_sent_message(current_user_id, client_message_id):
+    """
+    Find the group message the user already sent with this client message id, in the recent messages cache first
+    Returns:
+        message with the cipher text of the sender or None
+    """
+    key = (CONVERSATION_GROUP, current_user_id, client_message_id)
+    data = recent_messages.get(key)
+    if data is not None:
+        return dict(data)
+
+    row = GroupMessage.get_by_client_message_id(current_user_id, client_message_id)
+    if row is None:
+        return None
+    data = {
+        "id": row.GroupMessage.id,
+        "sender_id": row.GroupMessage.sender_id,
+        "group_id": row.GroupMessage.group_id,
+        "created_date": row.GroupMessage.created_date,
+        "version": row.GroupMessage.version or MESSAGE_VERSION_RSA,
+        "body": row.GroupMessage.body,
+        "message": row.message
+    }
+    recent_messages.set(key, dict(data))
+    return data
+
+
+def send_message(current_user_id, group_id, messages, client_message_id=None, version=MESSAGE_VERSION_RSA,
+                 body=None):
+    """
+    Store a group message and queue its delivery, used by the api and by the socket event group_chat
+    Args:
+        current_user_id:
+        group_id:
+        messages: dict user id -> cipher text of the message for this user, contains every member.
+                  For MESSAGE_VERSION_ENVELOPE the symmetric key of body encrypted for this user
+        client_message_id: idempotency key, sending again with the same key returns the stored message
+        version: MESSAGE_VERSION_RSA or MESSAGE_VERSION_ENVELOPE
+        body: cipher text of the message with the symmetric key, only for MESSAGE_VERSION_ENVELOPE
+
+    Returns:
+        (message with the cipher text of the sender, None) or (None, error message)
+
+    """
+    if not is_client_message_id(client_message_id):
+        return None, "Input data error"
+    if version == MESSAGE_VERSION_RSA:
+        if body is not None:
+            return None, "Input data error"
+    elif version != MESSAGE_VERSION_ENVELOPE or not isinstance(body, str) or not body:
+        return None, "Input data error"
+    if client_message_id is not None:
+        data = find_sent_message(current_user_id, client_message_id)
+        if data is not None:
+            return data, None
+
+    check_group = Group.get_by_id(group_id)
+    if check_group is None:
+        return None, "Not found error"
+
+    members_id = GroupUser.get_members_id(group_id)
+    # only a member sends to the group, a group without members gets no message
+    if current_user_id not in members_id:
+        return None, "Not found error"
+    if not isinstance(messages, dict) or any(member_id not in messages for member_id in members_id):
+        return None, "Input data error"
+
+    created_date = get_timestamp_now()
+    message_id = str(uuid.uuid1())
+
+    # insert message and the message of every member to table user_messages_group
+    try:
+        GroupMessage.insert_message(message_id, current_user_id, group_id, created_date,
+                                    {member_id: messages[member_id] for member_id in members_id}, client_message_id,
+                                    version, body)
+    except IntegrityError:
+        # a retry with the same client message id was stored first
+        db.session.rollback()
+        data = find_sent_message(current_user_id, client_message_id) if client_message_id is not None else None
+        if data is None:
+            raise
+        return data, None
+
+    recipients = [(member_id, group_id, messages[member_id]) for member_id in members_id]
+    Conversation.update_latest(CONVERSATION_GROUP, message_id, current_user_id, created_date, recipients)
+    db.session.commit()
+    data = {
+        "id": message_id,
+        "sender_id": current_user_id,
+        "group_id": group_id,
+        "created_date": created_date,
+        "version": version,
+        "body": body
+    }
+
+    # the message is stored, the members get it and the sender has read the group after the response, in the order
+    # of the jobs of the group
+    delivery.put(deliver_message, dict(data), {member_id: messages[member_id] for member_id in members_id},
+                 key=group_id)
+    delivery.put(mark_seen, current_user_id, group_id, key=group_id)
+
+    data["message"] = messages[current_user_id]
+    if client_message_id is not None:
+        recent_messages.set((CONVERSATION_GROUP, current_user_id, client_message_id), dict(data))
+    return data, None
+
+
 @api.route('/<string:group_id>', methods=['POST'])
 @jwt_required
 def chat_group(group_id):
@@ -17,62 +171,31 @@ def chat_group(group_id):
 
         Request Body:
 
+            messages: dict user id -> cipher text of the message for this user
+            client_message_id: optional idempotency key, sending again with the same key returns the stored message
+            version: optional, 1 by default, 2 for an envelope: body is the message encrypted once with a symmetric
+                     key and messages has this key encrypted for every member
+            body: cipher text of the envelope
+
         Returns:
 
         Examples::
     """
 
-    check_group = Group.get_by_id(group_id)
-    if check_group is None:
-        return send_error(message="Not found error")
     current_user_id = get_jwt_identity()
     try:
         json_data = request.get_json()
         messages = json_data.get('messages', None)
+        client_message_id = json_data.get('client_message_id', None)
+        version = json_data.get('version', MESSAGE_VERSION_RSA)
+        body = json_data.get('body', None)
     except Exception as ex:
         logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
         return send_error(message="Parameters error: " + str(ex))
 
-    members = GroupUser.get_by_group_id(group_id)
-    members_id = [member.user_id for member in members]
-    for member_id in members_id:
-        if member_id not in messages.keys():
-            return send_error(message="Input data error")
-
-    created_date = get_timestamp_now()
-    message_id = str(uuid.uuid1())
-
-    new_values = GroupMessage(id=message_id, sender_id=current_user_id, group_id=group_id, created_date=created_date)
-    db.session.add(new_values)
-
-    # insert message to table user_messages_group with this user friend
-    for member_id in members_id:
-        new_u_s = UserMessageGroup(message=messages[member_id], user_id=member_id, message_id=message_id,
-                                   group_id=group_id)
-        db.session.add(new_u_s)
-
-    db.session.commit()
-    data = {
-        "id": new_values.id,
-        "sender_id": new_values.sender_id,
-        "group_id": new_values.group_id,
-        "created_date": new_values.created_date
-    }
-
-    for member_id in members_id:
-        data["message"] = messages[member_id]
-        receivers_session_id = [key for key, value in online_users.items() if value == member_id]
-        for session_id in receivers_session_id:
-            sio.emit('new_group_msg', data, room=session_id)
-
-    unseen_messages = UserMessageGroup.query.filter(UserMessageGroup.user_id == current_user_id,
-                                                    UserMessageGroup.group_id == group_id,
-                                                    UserMessageGroup.seen == False).all()
-    for msg in unseen_messages:
-        msg.seen = True
-    db.session.commit()
-
-    data["message"] = messages[current_user_id]
+    data, error = send_message(current_user_id, group_id, messages, client_message_id, version, body)
+    if error is not None:
+        return send_error(message=error)
     return send_result(data=data)
 
 
@@ -81,6 +204,12 @@ def chat_group(group_id):
 def get(group_id):
     """ This api for .
 
+        Query params:
+
+            page, page_size: offset pagination, data is the list messages
+            before: cursor pagination, send an empty value to get the first page then the next_cursor of the
+            previous page, data is {"items": list messages, "next_cursor": string or null}
+
         Returns:
 
         Examples::
@@ -88,6 +217,14 @@ def get(group_id):
     """
     page = request.args.get('page', 1, type=int)
     page_size = request.args.get('page_size', 10, type=int)
+    cursor_mode = 'before' in request.args
+    before = request.args.get('before', None, type=str)
+
+    cursor = None
+    if before:
+        cursor = decode_cursor(before)
+        if cursor is None:
+            return send_error(message="Invalid cursor")
 
     group = Group.get_by_id(group_id)
     if group is None:
@@ -95,16 +232,22 @@ def get(group_id):
 
     current_user_id = get_jwt_identity()
 
-    messages = GroupMessage.get_messages(group_id=group_id, page=page, page_size=page_size)
-    unseen_messages = UserMessageGroup.query.filter(UserMessageGroup.user_id == current_user_id,
-                                                    UserMessageGroup.group_id == group_id,
-                                                    UserMessageGroup.seen == False).all()
-    for msg in unseen_messages:
-        msg.seen = True
-    db.session.commit()
+    if cursor_mode:
+        messages = GroupMessage.get_messages_before(group_id=group_id, before=cursor, page_size=page_size)
+    else:
+        messages = GroupMessage.get_messages(group_id=group_id, page=page, page_size=page_size)
+    mark_seen(current_user_id, group_id)
+
+    seen_date = Conversation.get_seen_dates([(current_user_id, group_id)]).get((current_user_id, group_id), 0)
+    items = GroupMessage.many_to_json(messages, current_user_id, seen_date)
+    if not cursor_mode:
+        return send_result(data=items)
 
-    messages = GroupMessage.many_to_json(messages)
-    return send_result(data=messages)
+    next_cursor = None
+    if len(messages) == page_size:
+        last = messages[-1].GroupMessage
+        next_cursor = encode_cursor(last.created_date, last.id)
+    return send_result(data={"items": items, "next_cursor": next_cursor})
 
 
 @api.route('/<string:message_id>', methods=['DELETE'])
@@ -125,6 +268,8 @@ def delete(message_id):
 @jwt_required
 def get_chats():
     """ This api for the user get their list chats.
+        Deprecated, GET /api/v1/conversations lists the private and group conversations with a cursor. Both read the
+        same inbox rows, this api keeps the offset pagination and the response of the group chats.
 
         Returns:
 
@@ -136,45 +281,27 @@ def get_chats():
     page_size = request.args.get('page_size', 10, type=int)
 
     current_user_id = get_jwt_identity()
-
-    groups_msg = Group.get_groups_by_user()
-
-    groups_msg = Group.many_to_json(groups_msg)
-
-    for group_msg in groups_msg:
-        message = GroupMessage.query.filter_by(group_id=group_msg["id"]) \
-            .add_columns(UserMessageGroup.message) \
-            .add_columns(UserMessageGroup.seen) \
-            .join(UserMessageGroup, GroupMessage.id == UserMessageGroup.message_id) \
-            .filter(UserMessageGroup.user_id == current_user_id, UserMessageGroup.seen == False) \
-            .order_by(GroupMessage.created_date.desc()).first()
-
-        unseen = UserMessageGroup.query.filter(UserMessageGroup.user_id == current_user_id,
-                                               UserMessageGroup.group_id == group_msg["id"],
-                                               UserMessageGroup.seen == False).count()
-
+    rows = [row for row in Conversation.get_inbox(page_size=page_size, conversation_type=CONVERSATION_GROUP,
+                                                  page=page) if row.Group]
+
+    rs = []
+    for row in rows:
+        conversation = row.Conversation
+        group_msg = row.Group.to_json()
+        group_msg["unseen"] = conversation.unseen
         group_msg["latest_message"] = {
-            "id": "1",
-            "sender_id": "",
-            "group_id": "",
-            "created_date": group_msg["created_date"],
-            "message": "",
-            "seen": ""
+            "id": conversation.last_message_id,
+            "sender_id": conversation.last_sender_id,
+            "group_id": conversation.conversation_id,
+            "created_date": conversation.last_created_date,
+            "version": row.version or MESSAGE_VERSION_RSA,
+            "body": row.body,
+            "message": conversation.last_message,
+            # the messages of the reader are seen, the others until the read watermark
+            "seen": conversation.last_sender_id == current_user_id or
+                    conversation.last_created_date <= (conversation.last_seen_date or 0)
         }
-        group_msg["unseen"] = unseen
-        if message:
-            group_msg["latest_message"] = GroupMessage.to_json(message)
-
-    friends_sorted = []
-    if len(groups_msg) > 0:
-        friends_sorted = sorted(groups_msg, key=lambda k: k["latest_message"]["created_date"], reverse=True)
-    st = (page - 1) * page_size
-    end = st + page_size
-    len_list = len(friends_sorted)
-    if end > len_list:
-        end = len_list
-
-    rs = friends_sorted[st:end]
+        rs.append(group_msg)
 
     return send_result(data=rs)
 
@@ -184,7 +311,8 @@ def get_chats():
 def get_info_conversation(group_id):
     """ This api for .
 
-        Returns:
+        Returns: users: user id -> {public_key, key_fingerprint, key_version, avatar_path}, public_key is deprecated,
+        the clients compare key_fingerprint and key_version with their copy and fetch the changed keys from GET /keys
 
         Examples::
 
@@ -194,8 +322,7 @@ def get_info_conversation(group_id):
     if group is None:
         return send_error(message="Not found Error")
 
-    users_group = GroupUser.get_by_group_id(group_id=group_id)
-    users_id = [ug.user_id for ug in users_group]
+    users_id = list(GroupUser.get_members_id(group_id))
 
     users = User.query.filter(User.id.in_(users_id)).all()
 
@@ -203,6 +330,8 @@ def get_info_conversation(group_id):
     for user in users:
         info = {
             "public_key": user.pub_key,
+            "key_fingerprint": user.pub_key_fingerprint,
+            "key_version": user.pub_key_version,
             "avatar_path": user.avatar_path
         }
         users_info[user.id] = info
@@ -0,0 +1,64 @@
+import hashlib
+
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required
+
+from app.enums import MAX_KEY_USERS
+from app.extensions import public_keys
+from app.models import User
+from app.utils import send_result, send_error
+
+api = Blueprint('keys', __name__)
+
+
+def get_keys(users_id):
+    """
+    Get the keys from the cache, the missing ones with one query
+    Returns:
+        dict user id -> {public_key, fingerprint, version} of the users who exist
+    """
+    keys = {}
+    missing = []
+    for user_id in users_id:
+        key = public_keys.get(user_id)
+        if key is None:
+            missing.append(user_id)
+        else:
+            keys[user_id] = key
+    for user_id, key in User.get_public_keys(missing).items():
+        public_keys.set(user_id, key)
+        keys[user_id] = key
+    return keys
+
+
+@api.route('', methods=['GET'])
+@jwt_required
+def get_public_keys():
+    """ This api gets the public keys of a list of users, the listings and the conversation infos only give their
+        fingerprint and version so the clients download the keys again only when a fingerprint changed.
+        The ETag of the response is made of the fingerprints, a request with If-None-Match gets 304 Not Modified
+        while none of the keys changed.
+
+        Query params: users_id, comma separated user ids, at most 500
+
+        Returns: {user id: {public_key, fingerprint, version}}, users who do not exist are left out
+
+        Examples::
+
+    """
+
+    users_id = list(dict.fromkeys(user_id for user_id in request.args.get('users_id', '', type=str).split(',')
+                                  if user_id))
+    if len(users_id) > MAX_KEY_USERS:
+        return send_error(message="Too many users, the maximum is {}".format(MAX_KEY_USERS))
+
+    keys = get_keys(users_id)
+    etag = hashlib.sha256(",".join("{}:{}".format(user_id, keys[user_id]["fingerprint"])
+                                   for user_id in users_id if user_id in keys).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        return '', 304, {"ETag": '"{}"'.format(etag)}
+
+    response, code = send_result(data={user_id: keys[user_id] for user_id in users_id if user_id in keys})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response, code
@@ -0,0 +1,66 @@
+from flask import Blueprint
+from flask_jwt_extended import jwt_required
+
+from app.decorators import admin_required
+from app.extensions import revoked_tokens, group_members, public_keys, delivery, recent_messages, conversation_ids, \
+    presence_changes, typing_indicators, user_friends
+from app.utils import send_result
+
+api = Blueprint('system', __name__)
+
+
+@api.route('/caches', methods=['GET'])
+@jwt_required
+@admin_required()
+def get_caches():
+    """ This api gets the size, hits, misses and invalidations of the in process caches of this worker.
+
+        Returns:
+
+        Examples::
+
+    """
+
+    rs = {
+        "revoked_tokens": revoked_tokens.stats(),
+        "group_members": group_members.stats(),
+        "user_friends": user_friends.stats(),
+        "public_keys": public_keys.stats(),
+        "recent_messages": recent_messages.stats(),
+        "conversation_ids": conversation_ids.stats()
+    }
+    return send_result(data=rs)
+
+
+@api.route('/delivery', methods=['GET'])
+@jwt_required
+@admin_required()
+def get_delivery():
+    """ This api gets the depth, counters and lag of the delivery queue of this worker.
+
+        Returns:
+
+        Examples::
+
+    """
+
+    return send_result(data=delivery.stats())
+
+
+@api.route('/presence', methods=['GET'])
+@jwt_required
+@admin_required()
+def get_presence():
+    """ This api gets the intervals and counters of the presence diffs and of the typing indicators of this worker.
+
+        Returns:
+
+        Examples::
+
+    """
+
+    rs = {
+        "presence": presence_changes.stats(),
+        "typing": typing_indicators.stats()
+    }
+    return send_result(data=rs)
@@ -8,12 +8,13 @@ from jsonschema import validate
 from werkzeug.security import check_password_hash, safe_str_cmp
 from werkzeug.utils import secure_filename
 
-from app.enums import AVATAR_PATH, AVATAR_PATH_SEVER, DEFAULT_AVATAR
-from app.models import User, Token, Friend, Message, Group, GroupUser, UserMessageGroup
-from app.schema.schema_validator import user_validator, password_validator
+from app.enums import AVATAR_PATH, AVATAR_PATH_SEVER, DEFAULT_AVATAR, CONVERSATION_GROUP, SEARCH_LIMIT, \
+    MAX_SEARCH_LIMIT
+from app.models import User, Token, Friend, Conversation
+from app.schema.schema_validator import user_validator, password_validator, presence_validator
 from app.utils import send_result, send_error, hash_password, get_datetime_now, is_password_contain_space, \
     get_timestamp_now, allowed_file_img, generate_id, is_user_online
-from app.extensions import logger, db, online_users
+from app.extensions import logger, db, online_users, public_keys, user_friends
 
 api = Blueprint('users', __name__)
 
@@ -55,8 +56,9 @@ def create_user():
     avatar_path = AVATAR_PATH_SEVER + DEFAULT_AVATAR.replace(".", index_avatar)
     new_values = User(id=_id, username=username, password_hash=hash_password(password),
                       created_date=created_date, is_active=True, force_change_password=True,
-                      pub_key=pub_key, modified_date_password=created_date, test_message=test_message,
+                      modified_date_password=created_date, test_message=test_message,
                       avatar_path=avatar_path)
+    new_values.set_pub_key(pub_key)
     db.session.add(new_values)
     db.session.commit()
     data = {
@@ -94,13 +96,19 @@ def update_user(user_id):
     keys = ["display_name", "gender", "pub_key", "is_active", "address", "login_failed_attempts",
             "force_change_password", "test_message"]
     data = {}
+    key_changed = False
     for key in keys:
-        if key in json_data:
+        if key == "pub_key" and key in json_data:
+            data[key] = json_data.get(key)
+            key_changed = user.set_pub_key(json_data.get(key))
+        elif key in json_data:
             data[key] = json_data.get(key)
             setattr(user, key, json_data.get(key))
 
     user.modified_date = get_timestamp_now()
     db.session.commit()
+    if key_changed:
+        public_keys.invalidate(user.id)
 
     return send_result(data=data, message="Update user successfully!")
 
@@ -133,13 +141,19 @@ def update_info():
     keys = ["display_name", "gender", "pub_key", "is_active", "address", "login_failed_attempts",
             "force_change_password", "test_message"]
     data = {}
+    key_changed = False
     for key in keys:
-        if key in json_data:
+        if key == "pub_key" and key in json_data:
+            data[key] = json_data.get(key)
+            key_changed = current_user.set_pub_key(json_data.get(key))
+        elif key in json_data:
             data[key] = json_data.get(key)
             setattr(current_user, key, json_data.get(key))
 
     current_user.modified_date = get_timestamp_now()
     db.session.commit()
+    if key_changed:
+        public_keys.invalidate(current_user.id)
 
     return send_result(data=data, message="Update user successfully!")
 
@@ -225,7 +239,8 @@ def get_all_users():
 @api.route('/online_users', methods=['GET'])
 @jwt_required
 def get_online_users():
-    """ This api gets all users.
+    """ This api gets the ids of all online users.
+        Deprecated, the clients get the presence of their contacts with POST /users/presence.
 
         Returns:
 
@@ -233,11 +248,46 @@ def get_online_users():
 
     """
 
-    rs = [value for key, value in online_users.items()]
+    rs = online_users.get_users()
 
     return send_result(data=rs)
 
 
+@api.route('/presence', methods=['POST'])
+@jwt_required
+def get_presence():
+    """ This api gets the online state and the last seen date of a list of users, a contact list or the members of a
+        group. Users who do not exist are left out.
+
+        Request Body: {"users_id": [user ids, at most 500]}
+
+        Returns: [{"id", "online", "last_seen"}], last_seen is now for the online users, 0 if the user was never seen
+
+        Examples::
+
+    """
+
+    try:
+        json_data = request.get_json()
+        # Check valid params
+        validate(instance=json_data, schema=presence_validator)
+    except Exception as ex:
+        logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
+        return send_error(message='Parse error ' + str(ex))
+
+    users_id = list(dict.fromkeys(json_data["users_id"]))
+    online = {user_id: online_users.is_online(user_id) for user_id in users_id}
+    last_seen = User.get_last_seen([user_id for user_id in users_id if not online[user_id]])
+    now = get_timestamp_now()
+    rs = []
+    for user_id in users_id:
+        if online[user_id]:
+            rs.append({"id": user_id, "online": True, "last_seen": now})
+        elif user_id in last_seen:
+            rs.append({"id": user_id, "online": False, "last_seen": last_seen[user_id]})
+    return send_result(data=rs)
+
+
 @api.route('/<user_id>', methods=['GET'])
 @jwt_required
 def get_user_by_id(user_id):
@@ -260,7 +310,8 @@ def get_user_by_id(user_id):
 @api.route('/search', methods=['GET'])
 @jwt_required
 def search_user():
-    """ This api get information of a user.
+    """ This api searches the users by id, username or display name, the best matches first.
+        Query params: text_search, limit (default 20, at most 100)
 
         Returns:
 
@@ -269,15 +320,17 @@ def search_user():
     """
 
     text_search = request.args.get('text_search', None, type=str)
+    limit = min(request.args.get('limit', SEARCH_LIMIT, type=int), MAX_SEARCH_LIMIT)
+    if not text_search or limit < 1:
+        return send_result(data=[])
+
     user = User.get_by_id(text_search)
     if user:
         user = user.to_json()
         user["online"] = is_user_online(user["id"])
         return send_result(data=[user])
 
-    text_search = "%{}%".format(text_search)
-    users = User.query.filter((User.username.like(text_search)) | (User.display_name.like(text_search))).all()
-    users = User.many_to_json(users)
+    users = User.many_to_json(User.search(text_search, limit))
     for u in users:
         u["online"] = is_user_online(u["id"])
     return send_result(data=users)
@@ -325,6 +378,8 @@ def add_friend(friend_id):
         db.session.add(new_obj1)
         db.session.add(new_obj2)
         db.session.commit()
+        user_friends.invalidate(current_user_id)
+        user_friends.invalidate(friend_id)
 
     return send_result()
 
@@ -347,7 +402,11 @@ def delete_friend(user_id):
         return send_error(message="Not found friend")
     Friend.query.filter_by(user_id=current_user_id, friend_id=user_id).delete()
     Friend.query.filter_by(user_id=user_id, friend_id=current_user_id).delete()
+    Conversation.delete_conversation(current_user_id, user_id)
+    Conversation.delete_conversation(user_id, current_user_id)
     db.session.commit()
+    user_friends.invalidate(current_user_id)
+    user_friends.invalidate(user_id)
 
     return send_result()
 
@@ -435,36 +494,32 @@ def delete_avatar():
 @api.route('/unseen_conversations', methods=['GET'])
 @jwt_required
 def unseen_conversations():
-    """ This api for .
+    """ This api for the user get their conversations having unseen messages, read from the unseen counters of the
+        conversations table in one query.
 
         Returns:
 
+            unseen_private: list partner ids
+            unseen_group: list group ids
+            counts: dict conversation id -> number of unseen messages
+
         Examples::
 
     """
 
     current_user_id = get_jwt_identity()
 
-    friends = Friend.query.filter_by(user_id=current_user_id).all()
-    groups = Group.query.join(GroupUser, GroupUser.group_id == Group.id) \
-        .filter(GroupUser.user_id == get_jwt_identity()).all()
-
     unseen_private = []
     unseen_group = []
+    counts = {}
 
-    for friend in friends:
-        group_id = generate_id(current_user_id, friend.friend_id)
-        unseen = Message.query.filter_by(sender_id=friend.friend_id, group_id=group_id, seen=False).count()
-        if unseen > 0:
-            unseen_private.append(friend.friend_id)
-
-    for group in groups:
-        unseen = UserMessageGroup.query.filter(UserMessageGroup.user_id == current_user_id,
-                                               UserMessageGroup.group_id == group.id,
-                                               UserMessageGroup.seen == False).count()
-        if unseen > 0:
-            unseen_group.append(group.id)
+    for conversation_id, conversation_type, unseen in Conversation.get_all_unseen(current_user_id):
+        if conversation_type == CONVERSATION_GROUP:
+            unseen_group.append(conversation_id)
+        else:
+            unseen_private.append(conversation_id)
+        counts[conversation_id] = unseen
 
-    rs = {"unseen_private": unseen_private, "unseen_group": unseen_group}
+    rs = {"unseen_private": unseen_private, "unseen_group": unseen_group, "counts": counts}
 
     return send_result(data=rs)
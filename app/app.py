@@ -4,7 +4,10 @@ import traceback
 from time import strftime
 from flask import Flask, request
 from flask_cors import CORS
-from app.extensions import jwt, logger, db, ma, sio
+from app.extensions import jwt, logger, db, ma, sio, revoked_tokens, group_members, online_users, delivery, \
+    recent_messages, conversation_ids, presence_changes, \
+    typing_indicators, public_keys, user_friends
+from app.ids import binary_ids
 from .api import v1 as api_v1
 from .settings import AppConfig
 
@@ -31,11 +34,23 @@ def register_extensions(app):
     :return:
     """
     # Order matters: Initialize SQLAlchemy before Marshmallow
+    binary_ids.init_app(app)  # before any statement so the id columns use the configured storage
     db.app = app
     db.init_app(app)  # SQLAlchemy
     ma.init_app(app)  # Marshmallow json parser and validator
     jwt.init_app(app)
-    sio.init_app(app)
+    revoked_tokens.init_app(app)
+    group_members.init_app(app)
+    user_friends.init_app(app)
+    public_keys.init_app(app)
+    recent_messages.init_app(app)
+    conversation_ids.init_app(app)
+    # with a message queue the emits of every worker reach the sockets connected to the other workers
+    sio.init_app(app, message_queue=app.config.get('SOCKETIO_MESSAGE_QUEUE'))
+    online_users.init_app(app, sio.server.eio)
+    delivery.init_app(app, sio.server.eio)
+    presence_changes.init_app(app, sio.server.eio)
+    typing_indicators.init_app(app, sio.server.eio)
 
     @sio.on_error()  # Handles the default namespace
     def error_handler(e):
@@ -96,3 +111,7 @@ def register_blueprints(app):
     app.register_blueprint(api_v1.group.api, url_prefix='/api/v1/groups')
     app.register_blueprint(api_v1.group_chat.api,
                            url_prefix='/api/v1/group_chats')
+    app.register_blueprint(api_v1.conversation.api,
+                           url_prefix='/api/v1/conversations')
+    app.register_blueprint(api_v1.system.api, url_prefix='/api/v1/system')
+    app.register_blueprint(api_v1.key.api, url_prefix='/api/v1/keys')
@@ -0,0 +1,287 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic, time
+
+
+class TTLCache(object):
+    """
+    Dictionary cache where every key has its own expiry time, the oldest key is evicted when the cache is full
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = {}
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[1] <= monotonic():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                # keys are kept in insertion order, the first one is the oldest
+                del self._data[next(iter(self._data))]
+            self._data[key] = (value, monotonic() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations
+        }
+
+
+class LRUCache(object):
+    """
+    Dictionary cache bounded by maxsize, the least recently used key is evicted when the cache is full
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions
+        }
+
+
+class LocalInvalidationChannel(object):
+    """
+    In process stand-in of the invalidation channel, all caches subscribed to the same object get the messages
+    """
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, key):
+        for callback in self._subscribers:
+            callback(key)
+
+
+class RedisInvalidationChannel(object):
+    """
+    Invalidation channel shared by all worker processes through redis pub/sub
+    """
+
+    def __init__(self, url, name):
+        import redis  # optional dependency, only needed when a redis channel is configured
+
+        self._redis = redis.StrictRedis.from_url(url)
+        self._name = name
+
+    def subscribe(self, callback):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self._name: lambda message: callback(message['data'].decode())})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def publish(self, key):
+        self._redis.publish(self._name, key)
+
+
+def create_invalidation_channel(url, name):
+    """
+    Args:
+        url: "local" or the url of a redis server
+        name: name of the channel
+
+    Returns:
+        the channel or None if url is empty
+
+    """
+    if not url:
+        return None
+    if url == "local":
+        return LocalInvalidationChannel()
+    return RedisInvalidationChannel(url, name)
+
+
+class RevocationCache(TTLCache):
+    """
+    Cache the revoked flag of the tokens by jti, an entry never lives longer than its token or TOKEN_CACHE_TTL.
+    Revoking a token invalidates the entry in this process and in the other workers through the channel
+    """
+
+    def __init__(self, maxsize=100000):
+        super(RevocationCache, self).__init__(maxsize=maxsize)
+        self.enabled = False
+        self.ttl = 0
+        self.channel = None
+
+    def init_app(self, app):
+        self.enabled = app.config.get('TOKEN_CACHE_ENABLED', False)
+        self.ttl = app.config.get('TOKEN_CACHE_TTL', 60)
+        self.channel = create_invalidation_channel(app.config.get('TOKEN_CACHE_CHANNEL_URL'), 'revoked_tokens')
+        if self.channel is not None:
+            self.channel.subscribe(self.delete)
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        return super(RevocationCache, self).get(key, default)
+
+    def set(self, key, value, expires):
+        """
+        Args:
+            key: jti
+            value: revoked flag
+            expires: exp claim of the token in timestamp
+        """
+        if self.enabled:
+            super(RevocationCache, self).set(key, value, min(expires - int(time()), self.ttl))
+
+    def invalidate(self, key):
+        self.delete(key)
+        if self.channel is not None:
+            self.channel.publish(key)
+
+
+class InvalidatingLRUCache(LRUCache):
+    """
+    LRUCache whose entries are invalidated in this process and in the other workers through the channel, the size and
+    the channel url are read from the config keys given by the subclass
+    """
+
+    def __init__(self, size_key, channel_key, channel_name, maxsize=10000):
+        super(InvalidatingLRUCache, self).__init__(maxsize=maxsize)
+        self.size_key = size_key
+        self.channel_key = channel_key
+        self.channel_name = channel_name
+        self.channel = None
+
+    def init_app(self, app):
+        self.maxsize = app.config.get(self.size_key, self.maxsize)
+        self.channel = create_invalidation_channel(app.config.get(self.channel_key), self.channel_name)
+        if self.channel is not None:
+            self.channel.subscribe(self.delete)
+
+    def invalidate(self, key):
+        self.delete(key)
+        if self.channel is not None:
+            self.channel.publish(key)
+
+
+class MembershipCache(InvalidatingLRUCache):
+    """
+    Cache the members of the groups: group id -> frozenset of user ids, invalidated when the members change
+    """
+
+    def __init__(self, maxsize=10000):
+        super(MembershipCache, self).__init__('GROUP_CACHE_SIZE', 'GROUP_CACHE_CHANNEL_URL', 'group_members',
+                                              maxsize=maxsize)
+
+
+class FriendCache(InvalidatingLRUCache):
+    """
+    Cache the friends of the users: user id -> frozenset of user ids, adding or removing a friend invalidates the
+    entries of both users
+    """
+
+    def __init__(self, maxsize=100000):
+        super(FriendCache, self).__init__('FRIEND_CACHE_SIZE', 'FRIEND_CACHE_CHANNEL_URL', 'user_friends',
+                                          maxsize=maxsize)
+
+
+class PublicKeyCache(InvalidatingLRUCache):
+    """
+    Cache the key directory: user id -> {public_key, fingerprint, version}, invalidated when a key changes
+    """
+
+    def __init__(self, maxsize=100000):
+        super(PublicKeyCache, self).__init__('KEY_CACHE_SIZE', 'KEY_CACHE_CHANNEL_URL', 'public_keys',
+                                             maxsize=maxsize)
+
+
+class RecentMessageCache(TTLCache):
+    """
+    Cache the messages sent with a client message id: (conversation type, sender id, client message id) -> message
+    returned to the sender, so the retry of a recent send is answered without reading the database.
+    The unique index of the client message ids still rejects the duplicates this cache does not know
+    """
+
+    def __init__(self, maxsize=100000):
+        super(RecentMessageCache, self).__init__(maxsize=maxsize)
+        self.ttl = 300
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('RECENT_MESSAGE_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('RECENT_MESSAGE_CACHE_TTL', self.ttl)
+
+    def set(self, key, value):
+        super(RecentMessageCache, self).set(key, value, self.ttl)
+
+
+class ConversationIdCache(LRUCache):
+    """
+    Cache the ids of the private conversations made by generate_id: (smaller user id, greater user id) -> id.
+    The ids never change so there is nothing to invalidate
+    """
+
+    def __init__(self, maxsize=100000):
+        super(ConversationIdCache, self).__init__(maxsize=maxsize)
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('CONVERSATION_ID_CACHE_SIZE', self.maxsize)
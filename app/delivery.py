@@ -0,0 +1,176 @@
+import logging
+from itertools import count
+from queue import Empty, Full
+from threading import Lock, main_thread
+from time import monotonic
+
+logger = logging.getLogger('api')
+
+
+class PartialDelivery(Exception):
+    """
+    Raised by a job which failed part of its emits, the retry runs func(*args) which only does the failed ones
+    """
+
+    def __init__(self, cause, func, *args):
+        super(PartialDelivery, self).__init__(str(cause))
+        self.cause = cause
+        self.func = func
+        self.retry_args = args
+
+
+class DeliveryQueue(object):
+    """
+    Run the socket fan-out and the seen updates of a sent message after the request has committed, in background
+    tasks of this process, so a slow fan-out does not delay the response.
+    Every worker has its own queue and the jobs of the same key, the conversation or the recipient, always go to the
+    same worker so they are emitted in the order they were put. A failed job is tried again by its worker before the
+    next job of its queue, up to max_retries times, and only with the emits which failed when it raises
+    PartialDelivery.
+    The queues are bounded: put waits up to put_timeout seconds for a free slot and drops the job when the queue stays
+    full. The message is already stored when its job is dropped, the clients get it with the history apis.
+    With 0 workers, or before init_app, the jobs run in the caller like before and are counted in inline, not in
+    delivered
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.workers = 0
+        self.max_retries = 3
+        self.retry_delay = 0.1
+        self.put_timeout = 0.05
+        self.enqueued = 0
+        self.inline = 0
+        self.delivered = 0
+        self.retried = 0
+        self.dropped = 0
+        self.failed = 0
+        self.total_lag = 0.0
+        self.lag_count = 0
+        self.max_lag = 0.0
+        self._app = None
+        self._server = None
+        self._queues = []
+        self._queue_empty = Empty
+        self._next = count()
+        self._started = False
+        self._lock = Lock()
+
+    def init_app(self, app, server):
+        """
+        Args:
+            app:
+            server: the engine.io server of socket.io, the workers and the queues use its async mode
+        """
+        self.maxsize = app.config.get('DELIVERY_QUEUE_SIZE', self.maxsize)
+        self.workers = app.config.get('DELIVERY_WORKERS', self.workers)
+        self.max_retries = app.config.get('DELIVERY_MAX_RETRIES', self.max_retries)
+        self.retry_delay = app.config.get('DELIVERY_RETRY_DELAY', self.retry_delay)
+        self.put_timeout = app.config.get('DELIVERY_PUT_TIMEOUT', self.put_timeout)
+        self._app = app
+        self._server = server
+        self._queue_empty = server.get_queue_empty_exception()
+
+    def _start(self):
+        # the workers start with the first job so they run in the serving process, not in a parent which forks
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            size = max(1, self.maxsize // self.workers)
+            self._queues = [self._server.create_queue(maxsize=size) for _ in range(self.workers)]
+        for queue in self._queues:
+            self._server.start_background_task(self._work, queue)
+
+    def put(self, func, *args, key=None):
+        """
+        Queue func(*args), it runs in an app context once the job reaches a worker
+        Args:
+            func:
+            args:
+            key: the jobs with the same key run in order on the same worker, a job without key goes to the workers
+                in turn
+
+        Returns:
+            False if the job is dropped because the queue is full
+        """
+        if self.workers <= 0 or self._server is None:
+            func(*args)
+            self.inline += 1
+            return True
+
+        self._start()
+        index = hash(key) if key is not None else next(self._next)
+        try:
+            self._queues[index % len(self._queues)].put((func, args, monotonic()), timeout=self.put_timeout)
+        except Full:
+            self.dropped += 1
+            logger.error('Delivery queue is full, drop {}'.format(func.__name__))
+            return False
+        self.enqueued += 1
+        return True
+
+    def _work(self, queue):
+        # the workers stop with the main thread so they never keep the process alive
+        while main_thread().is_alive():
+            try:
+                func, args, enqueued_at = queue.get(timeout=1)
+            except self._queue_empty:
+                continue
+            try:
+                if self._run(func, args):
+                    lag = monotonic() - enqueued_at
+                    with self._lock:
+                        self.delivered += 1
+                        self.total_lag += lag
+                        self.lag_count += 1
+                        self.max_lag = max(self.max_lag, lag)
+            finally:
+                queue.task_done()
+
+    def _run(self, func, args):
+        """
+        Run the job and its retries, the next job of the queue waits so the order of a key is kept
+        Returns:
+            True if the job is delivered
+        """
+        name = func.__name__
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with self._app.app_context():
+                    func(*args)
+                return True
+            except PartialDelivery as ex:
+                error, func, args = ex.cause, ex.func, ex.retry_args
+            except Exception as ex:
+                error = ex
+            if attempt < self.max_retries:
+                with self._lock:
+                    self.retried += 1
+                self._server.sleep(self.retry_delay * attempt)
+        with self._lock:
+            self.failed += 1
+        logger.error('Delivery {} failed after {} attempts: {}'.format(name, self.max_retries, error))
+        return False
+
+    def join(self):
+        """
+        Wait until every queued job is done
+        """
+        for queue in self._queues:
+            queue.join()
+
+    def stats(self):
+        return {
+            "depth": sum(queue.qsize() for queue in self._queues),
+            "maxsize": self.maxsize,
+            "workers": self.workers,
+            "enqueued": self.enqueued,
+            "inline": self.inline,
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "avg_lag_ms": round(self.total_lag * 1000 / self.lag_count, 3) if self.lag_count else 0,
+            "max_lag_ms": round(self.max_lag * 1000, 3)
+        }
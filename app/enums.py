@@ -13,3 +13,24 @@ AVATAR_PATH = "app/files/avatars/"
 AVATAR_PATH_SEVER = URL_SERVER + "/avatars/"
 DEFAULT_AVATAR = "default_avatar.png"
 DEFAULT_GROUP_AVATAR = "default_group_avatar.png"
+
+CONVERSATION_PRIVATE = "private"
+CONVERSATION_GROUP = "group"
+
+# formats of the group messages: every member gets the message encrypted with their public key, or the body is
+# encrypted once with a symmetric key and every member gets this key encrypted with their public key
+MESSAGE_VERSION_RSA = 1
+MESSAGE_VERSION_ENVELOPE = 2
+
+MAX_BATCH_MESSAGES = 100
+
+# users returned by a search, ngram_token_size of the MySQL server
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+NGRAM_TOKEN_SIZE = 2
+
+# users in one presence query
+MAX_PRESENCE_USERS = 500
+
+# users in one key directory query
+MAX_KEY_USERS = 500
@@ -8,6 +8,11 @@ from webargs.flaskparser import FlaskParser
 from flask_jwt_extended import JWTManager
 from logging.handlers import RotatingFileHandler
 
+from app.cache import RevocationCache, MembershipCache, RecentMessageCache, ConversationIdCache, \
+    PublicKeyCache, FriendCache
+from app.delivery import DeliveryQueue
+from app.presence import PresenceRegistry, PresenceChanges, TypingIndicators
+
 parser = FlaskParser()
 jwt = JWTManager()
 
@@ -15,8 +20,35 @@ jwt = JWTManager()
 db = SQLAlchemy()
 ma = Marshmallow()
 
+# revoked flag of the tokens by jti
+revoked_tokens = RevocationCache()
+
+# members of the groups by group id
+group_members = MembershipCache()
+
+# friends of the users by user id
+user_friends = FriendCache()
+
+# public keys of the users by user id
+public_keys = PublicKeyCache()
+
+# messages sent with a client message id by (conversation type, sender id, client message id)
+recent_messages = RecentMessageCache()
+
+# ids of the private conversations by (smaller user id, greater user id)
+conversation_ids = ConversationIdCache()
+
 # list user online
-online_users = {}
+online_users = PresenceRegistry()
+
+# online and offline transitions of the users, published to their friends and group members in periodic diffs
+presence_changes = PresenceChanges(online_users)
+
+# typing state of the users per conversation
+typing_indicators = TypingIndicators()
+
+# socket fan-out and seen updates of the sent messages, run after the response
+delivery = DeliveryQueue()
 
 # init flask_socket io
 sio = SocketIO(debug=False, log_output=False, cors_allowed_origins="*")
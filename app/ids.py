@@ -0,0 +1,128 @@
+import uuid
+
+from sqlalchemy.types import TypeDecorator, String, BINARY
+
+CONVERSATION_ID_DIGITS = 32
+
+
+class BinaryIds(object):
+    """
+    Storage of the id columns, canonical strings by default or binary when BINARY_IDS is set.
+    The app always reads and writes the canonical strings
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        self.enabled = app.config.get('BINARY_IDS', False)
+
+
+binary_ids = BinaryIds()
+
+
+def uuid_to_bin(value):
+    """
+    Pack a uuid string in 16 bytes with the timestamp fields first (time_hi, time_mid, time_low) like
+    UUID_TO_BIN(value, 1) of MySQL, the uuid1 ids of consecutive inserts stay next to each other in the indexes
+    Args:
+        value: uuid string
+
+    Returns:
+        16 bytes, empty bytes which match no row if value is not a uuid
+
+    """
+    try:
+        b = uuid.UUID(value).bytes
+    except (AttributeError, TypeError, ValueError):
+        return b''
+    return b[6:8] + b[4:6] + b[0:4] + b[8:]
+
+
+def bin_to_uuid(value):
+    """
+    Returns:
+        canonical uuid string of the bytes made by uuid_to_bin
+    """
+    b = bytes(value)
+    return str(uuid.UUID(bytes=b[4:8] + b[2:4] + b[0:2] + b[8:16]))
+
+
+def conversation_id_to_bin(value):
+    """
+    Pack an id made by generate_id, 32 base 36 digits in the uuid layout, in 21 bytes
+    Args:
+        value:
+
+    Returns:
+        21 bytes, empty bytes which match no row if value is not a conversation id
+
+    """
+    if not isinstance(value, str) or len(value) != 36 or value[8] != '-' or value[13] != '-' or value[18] != '-' \
+            or value[23] != '-':
+        return b''
+    digits = value.replace('-', '')
+    if len(digits) != CONVERSATION_ID_DIGITS or not digits.isascii() or not digits.isalnum():
+        return b''
+    return int(digits, 36).to_bytes(ConversationIdType.length, 'big')
+
+
+def bin_to_conversation_id(value):
+    """
+    Returns:
+        conversation id string of the bytes made by conversation_id_to_bin
+    """
+    number = int.from_bytes(bytes(value), 'big')
+    digits = []
+    for _ in range(CONVERSATION_ID_DIGITS):
+        number, digit = divmod(number, 36)
+        digits.append("0123456789abcdefghijklmnopqrstuvwxyz"[digit])
+    s = "".join(reversed(digits))
+    return "{}-{}-{}-{}-{}".format(s[:8], s[8:12], s[12:16], s[16:20], s[20:])
+
+
+class UUIDType(TypeDecorator):
+    """
+    Column of uuid strings, stored as VARCHAR(50) or as BINARY(16) when the binary ids are enabled
+    """
+    impl = String(50)
+    length = 16
+
+    def load_dialect_impl(self, dialect):
+        if binary_ids.enabled:
+            return dialect.type_descriptor(BINARY(self.length))
+        return dialect.type_descriptor(String(50))
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not binary_ids.enabled:
+            return value
+        return self.to_bin(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not binary_ids.enabled:
+            return value
+        return self.from_bin(value)
+
+    @staticmethod
+    def to_bin(value):
+        return uuid_to_bin(value)
+
+    @staticmethod
+    def from_bin(value):
+        return bin_to_uuid(value)
+
+
+class ConversationIdType(UUIDType):
+    """
+    Column of the private conversation ids made by generate_id, stored as VARCHAR(50) or as BINARY(21) when the binary
+    ids are enabled, the base 36 digits do not fit in 16 bytes
+    """
+    length = 21
+
+    @staticmethod
+    def to_bin(value):
+        return conversation_id_to_bin(value)
+
+    @staticmethod
+    def from_bin(value):
+        return bin_to_conversation_id(value)
@@ -1,18 +1,46 @@
 # coding: utf-8
-from sqlalchemy import Index
+import re
+import sys
 
-from app.enums import AVATAR_PATH_SEVER, DEFAULT_AVATAR, DEFAULT_GROUP_AVATAR
-from app.extensions import db
+from sqlalchemy import Index, func, and_, or_, bindparam, case, literal_column
+
+from app.enums import AVATAR_PATH_SEVER, DEFAULT_AVATAR, DEFAULT_GROUP_AVATAR, CONVERSATION_PRIVATE, \
+    CONVERSATION_GROUP, SEARCH_LIMIT, NGRAM_TOKEN_SIZE, MESSAGE_VERSION_RSA
+from app.extensions import db, revoked_tokens, group_members, user_friends
+from app.ids import UUIDType, ConversationIdType
 from flask_jwt_extended import decode_token, get_jwt_identity, get_raw_jwt
-from sqlalchemy.dialects.mysql import INTEGER, TEXT
-from app.utils import send_error, get_timestamp_now
+from sqlalchemy.dialects.mysql import INTEGER, TEXT, insert as mysql_insert
+from sqlalchemy.orm import aliased
+from app.utils import send_error, get_timestamp_now, generate_members_hash, generate_key_fingerprint
+
+
+def before_cursor(created_date_column, id_column, cursor):
+    """
+    Filter the rows after the cursor in the order (created_date desc, id desc), with an index on
+    (..., created_date, id) the database seeks directly to the cursor instead of skipping the previous pages.
+    created_date <= cursor is the range of the index, the OR only filters the rows of the same second
+    Args:
+        created_date_column:
+        id_column:
+        cursor: (created_date, id) of the last row of the previous page
+
+    Returns:
+
+    """
+    created_date, _id = cursor
+    return and_(created_date_column <= created_date, or_(created_date_column < created_date, id_column < _id))
 
 
 class Group(db.Model):
     __tablename__ = 'groups'
+    __table_args__ = (
+        Index('index_members_hash', 'members_hash'),
+    )
 
-    id = db.Column(db.String(50), primary_key=True)
+    id = db.Column(UUIDType, primary_key=True)
     name = db.Column(db.String(100), default="Group Chat")
+    # fingerprint of the members, see generate_members_hash
+    members_hash = db.Column(db.String(64))
     avatar_path = db.Column(db.String(255), default=AVATAR_PATH_SEVER + DEFAULT_GROUP_AVATAR)
     created_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
     modified_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
@@ -58,14 +86,35 @@ class Group(db.Model):
     def get_by_id(cls, _id):
         return cls.query.get(_id)
 
+    @classmethod
+    def get_by_members_hash(cls, members_hash):
+        return cls.query.filter_by(members_hash=members_hash).first()
+
+    def update_members_hash(self):
+        """
+        Compute the fingerprint again from the members in the current transaction
+        """
+        members_id = [user_id for user_id, in db.session.query(GroupUser.user_id).filter_by(group_id=self.id)]
+        self.members_hash = generate_members_hash(members_id)
+
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('index_username', 'username'),
+        # GET /users lists and counts the users which are not deleted by username
+        Index('index_user_list', 'is_deleted', 'username'),
+        # n-grams of the names for search, MySQL only, other databases search the username prefix
+        Index('index_user_search', 'username', 'display_name', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
 
-    id = db.Column(db.String(50), primary_key=True)
+    id = db.Column(UUIDType, primary_key=True)
     username = db.Column(db.String(100), nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
-    pub_key = db.Column(TEXT, nullable=False)
+    # the key is only loaded by the key directory, the other apis give its fingerprint and version
+    pub_key = db.deferred(db.Column(TEXT, nullable=False))
+    pub_key_fingerprint = db.Column(db.String(64))
+    pub_key_version = db.Column(INTEGER(unsigned=True), default=0)
     gender = db.Column(db.Boolean, default=1)
     display_name = db.Column(db.String(100))
     is_active = db.Column(db.Boolean, default=True)
@@ -78,6 +127,8 @@ class User(db.Model):
     avatar_path = db.Column(db.String(255), default=AVATAR_PATH_SEVER + DEFAULT_AVATAR)
     test_message = db.Column(TEXT, default="test message")
     is_deleted = db.Column(db.Boolean, default=False)
+    # last time the user went offline, 0 if the user was never seen
+    last_seen_date = db.Column(INTEGER(unsigned=True), default=0)
 
     def get_password_age(self):
         return int((get_timestamp_now() - self.modified_date_password) / 86400)
@@ -91,7 +142,8 @@ class User(db.Model):
             "force_change_password": self.force_change_password,
             "created_date": self.created_date,
             "avatar_path": self.avatar_path,
-            "pub_key": self.pub_key
+            "key_fingerprint": self.pub_key_fingerprint,
+            "key_version": self.pub_key_version
         }
 
     @staticmethod
@@ -106,11 +158,40 @@ class User(db.Model):
                 "force_change_password": o.force_change_password,
                 "created_date": o.created_date,
                 "avatar_path": o.avatar_path,
-                "pub_key": o.pub_key
+                "key_fingerprint": o.pub_key_fingerprint,
+                "key_version": o.pub_key_version
             }
             items.append(item)
         return items
 
+    def set_pub_key(self, pub_key):
+        """
+        Change the public key, the version goes up when the fingerprint changes
+        Returns:
+            True if the key changed
+        """
+        fingerprint = generate_key_fingerprint(pub_key)
+        if fingerprint == self.pub_key_fingerprint:
+            return False
+        self.pub_key = pub_key
+        self.pub_key_fingerprint = fingerprint
+        self.pub_key_version = (self.pub_key_version or 0) + 1
+        return True
+
+    @classmethod
+    def get_public_keys(cls, users_id):
+        """
+        Returns:
+            dict user id -> {public_key, fingerprint, version} of the users who exist
+        """
+        if not users_id:
+            return {}
+        rows = db.session.query(cls.id, cls.pub_key, cls.pub_key_fingerprint, cls.pub_key_version) \
+            .filter(cls.id.in_(users_id))
+        return {row.id: {"public_key": row.pub_key,
+                         "fingerprint": row.pub_key_fingerprint or generate_key_fingerprint(row.pub_key),
+                         "version": row.pub_key_version or 0} for row in rows}
+
     @classmethod
     def get_all(cls, page=1, page_size=10):
         return cls.query.filter_by(is_deleted=False).order_by(cls.username) \
@@ -120,6 +201,36 @@ class User(db.Model):
     def get_current_user(cls):
         return cls.query.get(get_jwt_identity())
 
+    @classmethod
+    def search(cls, text_search, limit=SEARCH_LIMIT):
+        """
+        Search the users whose username or display name contains text_search with the FULLTEXT ngram index of MySQL.
+        The exact usernames come first, then the username and display name prefixes, then the relevance of the index.
+        Texts shorter than the ngrams and the other databases search the username prefix on index_username
+        Args:
+            text_search:
+            limit: maximum number of users
+
+        Returns:
+            list User
+
+        """
+        if db.engine.dialect.name != 'mysql' or len(text_search) < NGRAM_TOKEN_SIZE:
+            # username >= text_search and username < next text in the order, so the index can seek to the prefix
+            end = text_search[:-1] + chr(min(ord(text_search[-1]) + 1, sys.maxunicode))
+            return cls.query.filter(cls.username >= text_search, cls.username < end) \
+                .order_by(cls.username).limit(limit).all()
+
+        # the text is searched as one phrase, the operators of the boolean mode are removed
+        phrase = '"{}"'.format(re.sub(r'[-+<>()~*"@]', ' ', text_search).strip())
+        relevance = db.text("MATCH (users.username, users.display_name) AGAINST (:phrase IN BOOLEAN MODE)") \
+            .bindparams(phrase=phrase)
+        prefix = text_search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return cls.query.filter(relevance) \
+            .order_by((cls.username == text_search).desc(), cls.username.like(prefix).desc(),
+                      cls.display_name.like(prefix).desc(), db.desc(relevance), cls.username) \
+            .limit(limit).all()
+
     @classmethod
     def get_by_id(cls, _id):
         return cls.query.get(_id)
@@ -130,6 +241,52 @@ class User(db.Model):
         friends = cls.query.join(Friend, cls.id == Friend.friend_id).filter(Friend.user_id == current_user_id).all()
         return cls.many_to_json(friends)
 
+    @classmethod
+    def get_contacts_id(cls, users_id):
+        """
+        Get the friends of the users and the members of their groups, the users who see their presence
+        Args:
+            users_id: list user ids
+
+        Returns:
+            dict user id -> set user ids of the contacts
+
+        """
+        contacts = {user_id: set() for user_id in users_id}
+        if not contacts:
+            return contacts
+        for user_id, friend_id in db.session.query(Friend.user_id, Friend.friend_id) \
+                .filter(Friend.user_id.in_(users_id)):
+            contacts[user_id].add(friend_id)
+        # the members of all their groups in one query, the users are members of their own groups
+        for members_id in GroupUser.warm_members(users_id).values():
+            for user_id in members_id:
+                if user_id in contacts:
+                    contacts[user_id].update(members_id)
+        for user_id, contacts_id in contacts.items():
+            contacts_id.discard(user_id)
+        return contacts
+
+    @classmethod
+    def get_last_seen(cls, users_id):
+        """
+        Returns:
+            dict user id -> last seen date of the users who exist
+        """
+        if not users_id:
+            return {}
+        return {user_id: last_seen_date or 0 for user_id, last_seen_date in
+                db.session.query(cls.id, cls.last_seen_date).filter(cls.id.in_(users_id))}
+
+    @classmethod
+    def update_last_seen(cls, users_id, last_seen_date):
+        """
+        Set the last seen date of the users with one UPDATE, the statement is added to the current transaction
+        """
+        if users_id:
+            cls.query.filter(cls.id.in_(users_id)).update({cls.last_seen_date: last_seen_date},
+                                                          synchronize_session=False)
+
     @classmethod
     def get_friends(cls, page, page_size):
         current_user_id = get_jwt_identity()
@@ -140,6 +297,10 @@ class User(db.Model):
 
 class GroupUser(db.Model):
     __tablename__ = 'group_user'
+    __table_args__ = (
+        # the primary key starts with user_id, the members of a group are read by group_id
+        Index('index_group_members', 'group_id', 'user_id'),
+    )
 
     user_id = db.Column(db.ForeignKey('users.id'), primary_key=True)
     group_id = db.Column(db.ForeignKey('groups.id'), primary_key=True)
@@ -148,6 +309,40 @@ class GroupUser(db.Model):
     def get_by_group_id(cls, group_id):
         return cls.query.filter_by(group_id=group_id).all()
 
+    @classmethod
+    def get_members_id(cls, group_id):
+        """
+        Get the members of the group through the membership cache, the cache must be invalidated whenever the members
+        of the group change
+        Returns:
+            frozenset user ids, empty if the group does not exist
+        """
+        members_id = group_members.get(group_id)
+        if members_id is None:
+            members_id = frozenset(user_id for user_id, in db.session.query(cls.user_id).filter_by(group_id=group_id))
+            group_members.set(group_id, members_id)
+        return members_id
+
+    @classmethod
+    def warm_members(cls, users_id):
+        """
+        Load the members of every group of the users into the membership cache with one query
+        Args:
+            users_id: list user ids
+
+        Returns:
+            dict group id -> frozenset user ids of the members, for the groups of the users
+        """
+        groups = aliased(cls)
+        members = {}
+        for group_id, member_id in db.session.query(cls.group_id, cls.user_id).distinct() \
+                .join(groups, groups.group_id == cls.group_id).filter(groups.user_id.in_(users_id)):
+            members.setdefault(group_id, set()).add(member_id)
+        members = {group_id: frozenset(members_id) for group_id, members_id in members.items()}
+        for group_id, members_id in members.items():
+            group_members.set(group_id, members_id)
+        return members
+
     @classmethod
     def get_by_user_id(cls, user_id):
         return cls.query.filter_by(user_id=user_id).first()
@@ -155,59 +350,89 @@ class GroupUser(db.Model):
 
 class Friend(db.Model):
     __tablename__ = 'friends'
+    __table_args__ = (
+        Index('index_user_friend', 'user_id', 'friend_id'),
+    )
 
-    id = db.Column(db.String(50), primary_key=True)
+    id = db.Column(UUIDType, primary_key=True)
     user_id = db.Column(db.ForeignKey('users.id'))
     friend_id = db.Column(db.ForeignKey('users.id'))
-    group_id = db.Column(db.String(50), nullable=False)
+    group_id = db.Column(ConversationIdType, nullable=False)
 
     @classmethod
     def get_by_id(cls, _id):
         return cls.query.get(_id)
 
     @classmethod
-    def check_friend(cls, friend_id):
-        return cls.query.filter_by(user_id=get_jwt_identity(), friend_id=friend_id).first()
+    def check_friend(cls, friend_id, user_id=None):
+        return cls.query.filter_by(user_id=user_id or get_jwt_identity(), friend_id=friend_id).first()
+
+    @classmethod
+    def get_friends_id(cls, user_id):
+        """
+        Get the friends of the user through the friends cache, the cache must be invalidated whenever a friend of the
+        user is added or removed
+        Returns:
+            frozenset user ids
+        """
+        friends_id = user_friends.get(user_id)
+        if friends_id is None:
+            friends_id = frozenset(friend_id for friend_id, in db.session.query(cls.friend_id).filter_by(user_id=user_id))
+            user_friends.set(user_id, friends_id)
+        return friends_id
 
 
 class Message(db.Model):
     __tablename__ = 'messages'
     __table_args__ = (
         Index('index_get', 'group_id', 'created_date', 'seen'),
+        Index('index_private_history', 'group_id', 'created_date', 'id'),
+        Index('index_sender_client', 'sender_id', 'client_message_id', unique=True),
     )
     # TODO oder_by desc filed created_date
 
-    id = db.Column(db.String(50), primary_key=True)
+    id = db.Column(UUIDType, primary_key=True)
     sender_id = db.Column(db.ForeignKey('users.id'))
     receiver_id = db.Column(db.ForeignKey('users.id'))
-    group_id = db.Column(db.String(50), nullable=False)
+    group_id = db.Column(ConversationIdType, nullable=False)
     created_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
+    # seen by the receiver, replaced by the read watermark Conversation.last_seen_date and only read by the migration
     seen = db.Column(db.Boolean, default=False)
+    # idempotency key chosen by the client, a retry with the same key returns the stored message
+    client_message_id = db.Column(db.String(50))
 
     message_user = db.relationship('UserMessage', cascade="all,delete")
 
     @staticmethod
-    def to_json(obj):
+    def to_json(obj, seen=False):
         return {
             "id": obj.Message.id,
             "message": obj.message,
             "sender_id": obj.Message.sender_id,
             "receiver_id": obj.Message.receiver_id,
             "created_date": obj.Message.created_date,
-            "seen": obj.Message.seen
+            "seen": seen
         }
 
     @staticmethod
-    def many_to_json(objects):
+    def many_to_json(objects, seen_dates):
+        """
+        Args:
+            objects:
+            seen_dates: dict (user id, conversation id) -> read watermark of the two users of the conversation
+
+        """
         items = []
         for obj in objects:
+            message = obj.Message
+            seen_date = seen_dates.get((message.receiver_id, message.sender_id), 0)
             item = {
-                "id": obj.Message.id,
+                "id": message.id,
                 "message": obj.message,
-                "sender_id": obj.Message.sender_id,
-                "receiver_id": obj.Message.receiver_id,
-                "created_date": obj.Message.created_date,
-                "seen": obj.Message.seen
+                "sender_id": message.sender_id,
+                "receiver_id": message.receiver_id,
+                "created_date": message.created_date,
+                "seen": message.sender_id == message.receiver_id or message.created_date <= seen_date
             }
             items.append(item)
         return items
@@ -220,17 +445,82 @@ class Message(db.Model):
     def get_by_id(cls, _id):
         return cls.query.get(_id)
 
+    @classmethod
+    def get_history(cls, group_id, user_id):
+        """
+        Query the messages of the conversation with the cipher text of the user. The cipher text is a correlated
+        subquery so the database reads index_private_history in order and stops after the page, a join may start from
+        index_user_message instead and sort every message of the user
+        Returns:
+            query of rows (Message, message)
+        """
+        message = db.session.query(UserMessage.message) \
+            .filter(UserMessage.user_id == user_id, UserMessage.message_id == cls.id) \
+            .correlate(cls).as_scalar().label('message')
+        return db.session.query(cls, message).filter(cls.group_id == group_id)
+
     @classmethod
     def get_messages(cls, group_id, page=1, page_size=10):
-        return cls.query.filter_by(group_id=group_id, seen=False) \
-            .add_columns(UserMessage.message) \
-            .join(UserMessage, cls.id == UserMessage.message_id) \
-            .filter(UserMessage.user_id == get_jwt_identity()) \
-            .order_by(cls.created_date.desc()).paginate(page=page, per_page=page_size, error_out=False).items
+        return cls.get_history(group_id, get_jwt_identity()) \
+            .order_by(cls.created_date.desc(), cls.id.desc()) \
+            .paginate(page=page, per_page=page_size, error_out=False).items
+
+    @classmethod
+    def get_messages_before(cls, group_id, before=None, page_size=10):
+        """
+        Keyset pagination of the messages, newest first
+        Args:
+            group_id:
+            before: (created_date, id) of the last message of the previous page, None to get the first page
+            page_size:
+
+        Returns:
+
+        """
+        query = cls.get_history(group_id, get_jwt_identity())
+        if before is not None:
+            query = query.filter(before_cursor(cls.created_date, cls.id, before))
+        return query.order_by(cls.created_date.desc(), cls.id.desc()).limit(page_size).all()
+
+    @classmethod
+    def get_by_client_message_ids(cls, sender_id, client_messages_id):
+        """
+        Returns:
+            dict client message id -> row (Message, message) of the messages already stored for these keys, message
+            is the cipher text of the sender
+        """
+        if not client_messages_id:
+            return {}
+        rows = db.session.query(cls, UserMessage.message) \
+            .join(UserMessage, and_(cls.id == UserMessage.message_id, UserMessage.user_id == sender_id)) \
+            .filter(cls.sender_id == sender_id, cls.client_message_id.in_(client_messages_id)).all()
+        return {row.Message.client_message_id: row for row in rows}
+
+    @classmethod
+    def insert_messages(cls, messages):
+        """
+        Insert the messages and the cipher text of every user with two multi-row INSERT statements, the statements are
+        added to the current transaction
+        Args:
+            messages: list dict {id, sender_id, receiver_id, group_id, created_date, client_message_id, messages},
+                      messages is the dict user id -> cipher text of the user
+
+        """
+        db.session.execute(cls.__table__.insert(), [
+            {"id": item["id"], "sender_id": item["sender_id"], "receiver_id": item["receiver_id"],
+             "group_id": item["group_id"], "created_date": item["created_date"],
+             "client_message_id": item["client_message_id"]}
+            for item in messages])
+        db.session.execute(UserMessage.__table__.insert(), [
+            {"message": message, "user_id": user_id, "message_id": item["id"]}
+            for item in messages for user_id, message in item["messages"].items()])
 
 
 class UserMessage(db.Model):
     __tablename__ = 'user_messages'
+    __table_args__ = (
+        Index('index_user_message', 'user_id', 'message_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(TEXT)
@@ -273,22 +563,35 @@ class UserMessage(db.Model):
 
 class GroupMessage(db.Model):
     __tablename__ = 'group_messages'
+    __table_args__ = (
+        Index('index_group_history', 'group_id', 'created_date', 'id'),
+        Index('index_group_sender_client', 'sender_id', 'client_message_id', unique=True),
+    )
 
-    id = db.Column(db.String(50), primary_key=True)
+    id = db.Column(UUIDType, primary_key=True)
     sender_id = db.Column(db.ForeignKey('users.id'))
     group_id = db.Column(db.ForeignKey('groups.id'))
     created_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
+    # idempotency key chosen by the client, a retry with the same key returns the stored message
+    client_message_id = db.Column(db.String(50))
+    # MESSAGE_VERSION_RSA: user_messages_group has the message encrypted for every member.
+    # MESSAGE_VERSION_ENVELOPE: body is the message encrypted once with a symmetric key, user_messages_group has this
+    # key encrypted for every member
+    version = db.Column(db.SmallInteger, default=MESSAGE_VERSION_RSA)
+    body = db.Column(TEXT)
     message_user = db.relationship('UserMessageGroup', cascade="all,delete")
 
     @staticmethod
-    def to_json(obj):
+    def to_json(obj, seen=False):
         return {
             "id": obj.GroupMessage.id,
             "sender_id": obj.GroupMessage.sender_id,
             "group_id": obj.GroupMessage.group_id,
             "created_date": obj.GroupMessage.created_date,
+            "version": obj.GroupMessage.version or MESSAGE_VERSION_RSA,
+            "body": obj.GroupMessage.body,
             "message": obj.message,
-            "seen": obj.seen,
+            "seen": seen,
         }
 
     @staticmethod
@@ -305,16 +608,25 @@ class GroupMessage(db.Model):
         return items
 
     @staticmethod
-    def many_to_json(objects):
+    def many_to_json(objects, user_id, seen_date):
+        """
+        Args:
+            objects:
+            user_id: the reader, the messages of the reader are seen
+            seen_date: read watermark of the reader in the group
+
+        """
         items = []
         for obj in objects:
             item = {
                 "id": obj.GroupMessage.id,
+                "version": obj.GroupMessage.version or MESSAGE_VERSION_RSA,
+                "body": obj.GroupMessage.body,
                 "message": obj.message,
                 "sender_id": obj.GroupMessage.sender_id,
                 "group_id": obj.GroupMessage.group_id,
                 "created_date": obj.GroupMessage.created_date,
-                "seen": obj.seen
+                "seen": obj.GroupMessage.sender_id == user_id or obj.GroupMessage.created_date <= seen_date
             }
             items.append(item)
         return items
@@ -331,20 +643,83 @@ class GroupMessage(db.Model):
     def get_messages(cls, group_id, page=1, page_size=10):
         return cls.query.filter_by(group_id=group_id) \
             .add_columns(UserMessageGroup.message) \
-            .add_columns(UserMessageGroup.seen) \
             .join(UserMessageGroup, cls.id == UserMessageGroup.message_id) \
-            .filter(UserMessageGroup.user_id == get_jwt_identity(), UserMessageGroup.seen == False) \
-            .order_by(cls.created_date.desc()).paginate(page=page, per_page=page_size, error_out=False).items
+            .filter(UserMessageGroup.user_id == get_jwt_identity()) \
+            .order_by(cls.created_date.desc(), cls.id.desc()) \
+            .paginate(page=page, per_page=page_size, error_out=False).items
+
+    @classmethod
+    def insert_message(cls, message_id, sender_id, group_id, created_date, messages, client_message_id=None,
+                       version=MESSAGE_VERSION_RSA, body=None):
+        """
+        Insert the message and the cipher text of every member with two multi-row INSERT statements, no ORM object is
+        created so nothing is loaded into the session. The statements are added to the current transaction
+        Args:
+            message_id:
+            sender_id:
+            group_id:
+            created_date:
+            messages: dict member id -> cipher text of the member, the encrypted key of the member for the envelope
+            client_message_id:
+            version: MESSAGE_VERSION_RSA or MESSAGE_VERSION_ENVELOPE
+            body: cipher text of the envelope, None for MESSAGE_VERSION_RSA
+
+        """
+        db.session.execute(cls.__table__.insert(), {"id": message_id, "sender_id": sender_id, "group_id": group_id,
+                                                    "created_date": created_date,
+                                                    "client_message_id": client_message_id,
+                                                    "version": version, "body": body})
+        if messages:
+            # executing an INSERT with an empty list of rows fails
+            db.session.execute(UserMessageGroup.__table__.insert(), [
+                {"message": message, "user_id": member_id, "group_id": group_id, "message_id": message_id}
+                for member_id, message in messages.items()])
+
+    @classmethod
+    def get_by_client_message_id(cls, sender_id, client_message_id):
+        """
+        Returns:
+            row (GroupMessage, message) of the message already stored for this key or None, message is the cipher
+            text of the sender
+        """
+        return db.session.query(cls, UserMessageGroup.message) \
+            .join(UserMessageGroup, and_(cls.id == UserMessageGroup.message_id,
+                                         UserMessageGroup.user_id == sender_id)) \
+            .filter(cls.sender_id == sender_id, cls.client_message_id == client_message_id).first()
+
+    @classmethod
+    def get_messages_before(cls, group_id, before=None, page_size=10):
+        """
+        Keyset pagination of the messages, newest first
+        Args:
+            group_id:
+            before: (created_date, id) of the last message of the previous page, None to get the first page
+            page_size:
+
+        Returns:
+
+        """
+        query = cls.query.filter_by(group_id=group_id) \
+            .add_columns(UserMessageGroup.message) \
+            .join(UserMessageGroup, cls.id == UserMessageGroup.message_id) \
+            .filter(UserMessageGroup.user_id == get_jwt_identity())
+        if before is not None:
+            query = query.filter(before_cursor(cls.created_date, cls.id, before))
+        return query.order_by(cls.created_date.desc(), cls.id.desc()).limit(page_size).all()
 
 
 class UserMessageGroup(db.Model):
     __tablename__ = 'user_messages_group'
+    __table_args__ = (
+        Index('index_message_user', 'message_id', 'user_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(TEXT)
     user_id = db.Column(db.ForeignKey('users.id'))
     group_id = db.Column(db.ForeignKey('groups.id'))
     message_id = db.Column(db.ForeignKey('group_messages.id'))
+    # seen by the member, replaced by the read watermark Conversation.last_seen_date and only read by the migration
     seen = db.Column(db.Boolean, default=False)
 
     def to_json(self):
@@ -381,13 +756,211 @@ class UserMessageGroup(db.Model):
         return cls.query.filter_by(user_id=user_id, message_id=message_id).first()
 
 
+class Conversation(db.Model):
+    """
+    Inbox of the users, a row per (user, conversation) which is updated in the transaction writing a message
+    conversation_id is the partner id of a private conversation or the group id of a group conversation
+    """
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        Index('index_inbox', 'user_id', 'last_created_date', 'conversation_id'),
+    )
+
+    user_id = db.Column(db.ForeignKey('users.id'), primary_key=True)
+    conversation_id = db.Column(UUIDType, primary_key=True)
+    type = db.Column(db.String(10), nullable=False)
+    last_message_id = db.Column(UUIDType)
+    last_sender_id = db.Column(UUIDType)
+    last_created_date = db.Column(INTEGER(unsigned=True))
+    last_message = db.Column(TEXT)
+    # number of messages of the other users created after the read watermark
+    unseen = db.Column(INTEGER(unsigned=True), default=0)
+    # read watermark, the messages created until this time have been seen by the user, it replaces the seen flag of
+    # every message so reading a conversation is one UPDATE of this row
+    last_seen_date = db.Column(INTEGER(unsigned=True), default=0)
+
+    @staticmethod
+    def many_to_json(objects):
+        items = []
+        for obj in objects:
+            conversation = obj.Conversation
+            if conversation.type == CONVERSATION_GROUP:
+                name = obj.Group.name if obj.Group else None
+                avatar_path = obj.Group.avatar_path if obj.Group else None
+            else:
+                name = (obj.User.display_name or obj.User.username) if obj.User else None
+                avatar_path = obj.User.avatar_path if obj.User else None
+            item = {
+                "conversation_id": conversation.conversation_id,
+                "type": conversation.type,
+                "conversation_name": name,
+                "conversation_avatar": avatar_path,
+                "unseen": conversation.unseen,
+                "latest_message": {
+                    "id": conversation.last_message_id,
+                    "sender_id": conversation.last_sender_id,
+                    "created_date": conversation.last_created_date,
+                    "version": obj.version or MESSAGE_VERSION_RSA,
+                    "body": obj.body,
+                    "message": conversation.last_message
+                }
+            }
+            items.append(item)
+        return items
+
+    @classmethod
+    def get_inbox(cls, before=None, page_size=10, conversation_type=None, page=1):
+        """
+        Get the conversations of the current user ordered by the latest message
+        Args:
+            before: (last_created_date, conversation_id) of the last conversation of the previous page
+            page_size:
+            conversation_type: CONVERSATION_PRIVATE or CONVERSATION_GROUP, None for both
+            page: offset pagination of the legacy listings, used without before
+
+        Returns:
+            list rows (Conversation, User, Group, version, body), version and body of the latest group message
+        """
+        query = db.session.query(cls, User, Group, GroupMessage.version, GroupMessage.body) \
+            .outerjoin(User, and_(cls.type == CONVERSATION_PRIVATE, User.id == cls.conversation_id)) \
+            .outerjoin(Group, and_(cls.type == CONVERSATION_GROUP, Group.id == cls.conversation_id)) \
+            .outerjoin(GroupMessage, and_(cls.type == CONVERSATION_GROUP, GroupMessage.id == cls.last_message_id)) \
+            .filter(cls.user_id == get_jwt_identity())
+        if conversation_type is not None:
+            query = query.filter(cls.type == conversation_type)
+        if before is not None:
+            query = query.filter(before_cursor(cls.last_created_date, cls.conversation_id, before))
+        query = query.order_by(cls.last_created_date.desc(), cls.conversation_id.desc())
+        if page > 1:
+            query = query.offset((page - 1) * page_size)
+        return query.limit(page_size).all()
+
+    @classmethod
+    def update_latest(cls, conversation_type, message_id, sender_id, created_date, recipients, unseen=1):
+        """
+        Set the new message as the latest message of the conversation for every recipient, this function only adds
+        the statements to the current transaction, the caller commits them together with the message.
+        On MySQL the rows are upserted with one INSERT ... ON DUPLICATE KEY UPDATE, so the first messages of two
+        concurrent requests do not insert the same row twice
+        Args:
+            conversation_type: CONVERSATION_PRIVATE or CONVERSATION_GROUP
+            message_id:
+            sender_id:
+            created_date:
+            recipients: list (user_id, conversation_id, message), message is the cipher text of the user or the
+                        encrypted key of the user for an envelope group message
+            unseen: number of new messages in the conversation, the latest one is message_id
+
+        """
+        rows = [{"user_id": user_id, "conversation_id": conversation_id, "type": conversation_type,
+                 "last_message_id": message_id, "last_sender_id": sender_id, "last_created_date": created_date,
+                 "last_message": message, "unseen": 0 if user_id == sender_id else unseen}
+                for user_id, conversation_id, message in recipients]
+        if not rows:
+            return
+        table = cls.__table__
+        if db.engine.dialect.name == 'mysql':
+            # VALUES(column) by hand, SQLAlchemy 1.3 renders every inserted column as the column being assigned
+            new = {name: literal_column("VALUES({})".format(name), type_=table.c[name].type) for name in rows[0]}
+            db.session.execute(mysql_insert(table).on_duplicate_key_update(cls._latest_values(new)), rows)
+            return
+
+        # the benchmarks on sqlite, one writer at a time: update the existing rows then insert the missing ones
+        existed = set(db.session.query(cls.user_id, cls.conversation_id)
+                      .filter(cls.user_id.in_({row["user_id"] for row in rows}),
+                              cls.conversation_id.in_({row["conversation_id"] for row in rows})).all())
+        updated = [{"b_" + name: value for name, value in row.items()} for row in rows
+                   if (row["user_id"], row["conversation_id"]) in existed]
+        inserted = [row for row in rows if (row["user_id"], row["conversation_id"]) not in existed]
+        if updated:
+            db.session.execute(table.update(preserve_parameter_order=True)
+                               .where(and_(table.c.user_id == bindparam('b_user_id'),
+                                           table.c.conversation_id == bindparam('b_conversation_id')))
+                               .values(cls._latest_values({name: bindparam('b_' + name, type_=table.c[name].type)
+                                                           for name in rows[0]})), updated)
+        if inserted:
+            db.session.execute(table.insert(), inserted)
+
+    @classmethod
+    def _latest_values(cls, new):
+        """
+        SET clauses of a conversation receiving a message, the unseen counter always grows and the latest message
+        only moves to a message which is not older, a message committed late does not replace a newer one.
+        The dates have a resolution of one second, a message of another user which is not newer than the read
+        watermark moves the watermark just before the message so it is not reported as seen before it is read.
+        MySQL evaluates the assignments from left to right: last_seen_date is set before unseen and
+        last_created_date is set last
+        Args:
+            new: dict column name -> value of the message
+
+        Returns:
+            list (column name, value)
+        """
+        table = cls.__table__
+        newer = new["last_created_date"] >= table.c.last_created_date
+        values = [("last_seen_date", case([(and_(new["unseen"] > 0, table.c.last_seen_date >= new["last_created_date"]),
+                                            new["last_created_date"] - 1)], else_=table.c.last_seen_date)),
+                  ("unseen", table.c.unseen + new["unseen"])]
+        for name in ("last_message_id", "last_sender_id", "last_message", "last_created_date"):
+            values.append((name, case([(newer, new[name])], else_=table.c[name])))
+        return values
+
+    @classmethod
+    def get_all_unseen(cls, user_id):
+        """
+        Returns:
+            list rows (conversation_id, type, unseen) of the conversations having unseen messages
+        """
+        return db.session.query(cls.conversation_id, cls.type, cls.unseen) \
+            .filter(cls.user_id == user_id, cls.unseen > 0).all()
+
+    @classmethod
+    def delete_conversation(cls, user_id, conversation_id):
+        """
+        Remove the conversation from the inbox of the user, added to the current transaction
+        """
+        cls.query.filter_by(user_id=user_id, conversation_id=conversation_id).delete(synchronize_session=False)
+
+    @classmethod
+    def mark_seen(cls, user_id, conversation_id, seen_date):
+        """
+        Move the read watermark of the user and reset the unseen counter with one UPDATE whatever the number of
+        messages, added to the current transaction
+        Returns:
+            1 if the conversation had unseen messages else 0
+        """
+        return cls.query.filter(cls.user_id == user_id, cls.conversation_id == conversation_id, cls.unseen > 0) \
+            .update({cls.unseen: 0, cls.last_seen_date: seen_date}, synchronize_session=False)
+
+    @classmethod
+    def get_seen_dates(cls, keys):
+        """
+        Args:
+            keys: list (user_id, conversation_id)
+
+        Returns:
+            dict (user_id, conversation_id) -> read watermark, the conversations without a row are left out
+        """
+        if not keys:
+            return {}
+        # one equality pair per key so every key is a lookup of the primary key
+        rows = db.session.query(cls.user_id, cls.conversation_id, cls.last_seen_date) \
+            .filter(or_(*[and_(cls.user_id == user_id, cls.conversation_id == conversation_id)
+                          for user_id, conversation_id in keys])).all()
+        return {(user_id, conversation_id): last_seen_date or 0 for user_id, conversation_id, last_seen_date in rows}
+
+
 class Token(db.Model):
     __tablename__ = 'tokens'
+    __table_args__ = (
+        Index('index_jti', 'jti'),
+        Index('index_user_identity', 'user_identity', 'revoked'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     jti = db.Column(db.String(36), nullable=False)
     token_type = db.Column(db.String(10), nullable=False)
-    user_identity = db.Column(db.String(50), nullable=False)
+    user_identity = db.Column(UUIDType, nullable=False)
     revoked = db.Column(db.Boolean, nullable=False)
     expires = db.Column(INTEGER(unsigned=True), nullable=False)
 
@@ -423,10 +996,14 @@ class Token(db.Model):
         it was created.
         """
         jti = decoded_token['jti']
+        revoked = revoked_tokens.get(jti)
+        if revoked is not None:
+            return revoked
+
         token = Token.query.filter_by(jti=jti).first()
-        if token:
-            return token.revoked
-        return True
+        revoked = token.revoked if token else True
+        revoked_tokens.set(jti, revoked, decoded_token['exp'])
+        return revoked
 
     @staticmethod
     def revoke_token(jti):
@@ -438,6 +1015,7 @@ class Token(db.Model):
             token = Token.query.filter_by(jti=jti).first()
             token.revoked = True
             db.session.commit()
+            revoked_tokens.invalidate(jti)
         except Exception as ex:
             return send_error(message=str(ex))
 
@@ -458,9 +1036,13 @@ class Token(db.Model):
 
             tokens = Token.query.filter(Token.user_identity.in_(users_identity), Token.revoked == False).all()
 
+            # read before the commit, which expires the tokens and would reload every row to get its jti
+            jtis = [token.jti for token in tokens]
             for token in tokens:
                 token.revoked = True
             db.session.commit()
+            for jti in jtis:
+                revoked_tokens.invalidate(jti)
         except Exception as ex:
             return send_error(message=str(ex))
 
@@ -477,9 +1059,12 @@ class Token(db.Model):
         try:
             tokens = Token.query.filter(Token.user_identity == users_identity, Token.revoked == False,
                                         Token.jti != jti).all()
+            jtis = [token.jti for token in tokens]
             for token in tokens:
                 token.revoked = True
             db.session.commit()
+            for revoked_jti in jtis:
+                revoked_tokens.invalidate(revoked_jti)
         except Exception as ex:
             return send_error(message=str(ex))
 
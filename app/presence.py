@@ -0,0 +1,558 @@
+import atexit
+import logging
+import os
+import socket
+from threading import Lock, main_thread
+from time import monotonic
+
+logger = logging.getLogger('api')
+
+
+class LocalPresenceBackend(object):
+    """
+    Presence of the sockets connected to this process, kept in two dictionaries
+    """
+
+    def __init__(self):
+        self._user_by_session = {}
+        self._sessions_by_user = {}
+        self._lock = Lock()
+
+    def add(self, session_id, user_id):
+        with self._lock:
+            old_user_id = self._user_by_session.get(session_id)
+            if old_user_id is not None:
+                self._discard(session_id, old_user_id)
+            self._user_by_session[session_id] = user_id
+            sessions = self._sessions_by_user.setdefault(user_id, set())
+            sessions.add(session_id)
+            return len(sessions) == 1
+
+    def remove(self, session_id):
+        with self._lock:
+            user_id = self._user_by_session.pop(session_id, None)
+            if user_id is None:
+                return None, False
+            return user_id, self._discard(session_id, user_id)
+
+    def _discard(self, session_id, user_id):
+        sessions = self._sessions_by_user.get(user_id)
+        if sessions is None:
+            return True
+        sessions.discard(session_id)
+        if not sessions:
+            del self._sessions_by_user[user_id]
+            return True
+        return False
+
+    def get(self, session_id):
+        return self._user_by_session.get(session_id)
+
+    def get_sessions(self, user_id):
+        return list(self._sessions_by_user.get(user_id, ()))
+
+    def is_online(self, user_id):
+        return user_id in self._sessions_by_user
+
+    def get_users(self):
+        return list(self._sessions_by_user.keys())
+
+    def heartbeat(self):
+        return []
+
+    def clear(self):
+        with self._lock:
+            self._user_by_session.clear()
+            self._sessions_by_user.clear()
+
+    def __len__(self):
+        return len(self._user_by_session)
+
+
+class RedisPresenceBackend(object):
+    """
+    Presence shared by all worker processes, stored in redis with the same two indexes:
+        presence:session:<session id> -> user id
+        presence:user:<user id> -> set of session ids
+    Every worker also keeps the set of its own sessions in presence:worker:<worker id> and proves it is alive with
+    presence:alive:<worker id> which expires ttl seconds after its last heartbeat. The sessions of a worker which
+    stopped without clearing them, killed or crashed, are removed by the heartbeat of the other workers once its key
+    expired
+    """
+
+    def __init__(self, url, ttl=30):
+        import redis  # optional dependency, only needed when PRESENCE_URL is configured
+
+        self._redis = redis.StrictRedis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self._worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        self._worker_key = self._sessions_key(self._worker_id)
+        atexit.register(self.clear)
+
+    @staticmethod
+    def _session_key(session_id):
+        return "presence:session:" + session_id
+
+    @staticmethod
+    def _user_key(user_id):
+        return "presence:user:" + user_id
+
+    @staticmethod
+    def _sessions_key(worker_id):
+        return "presence:worker:" + worker_id
+
+    @staticmethod
+    def _alive_key(worker_id):
+        return "presence:alive:" + worker_id
+
+    def add(self, session_id, user_id):
+        old_user_id = self._redis.get(self._session_key(session_id))
+        if old_user_id is not None:
+            self.remove(session_id)
+        pipe = self._redis.pipeline()
+        pipe.set(self._alive_key(self._worker_id), 1, ex=self.ttl)
+        pipe.set(self._session_key(session_id), user_id)
+        pipe.sadd(self._user_key(user_id), session_id)
+        pipe.sadd(self._worker_key, session_id)
+        pipe.scard(self._user_key(user_id))
+        return pipe.execute()[-1] == 1
+
+    def remove(self, session_id):
+        return self._remove(session_id, self._worker_key)
+
+    def _remove(self, session_id, worker_key):
+        user_id = self._redis.get(self._session_key(session_id))
+        if user_id is None:
+            self._redis.srem(worker_key, session_id)
+            return None, False
+        pipe = self._redis.pipeline()
+        pipe.delete(self._session_key(session_id))
+        pipe.srem(self._user_key(user_id), session_id)
+        pipe.srem(worker_key, session_id)
+        pipe.scard(self._user_key(user_id))
+        _, removed, _, remaining = pipe.execute()
+        # only the worker which removed the last session reports it, when two workers reap the same sessions
+        return user_id, removed == 1 and remaining == 0
+
+    def heartbeat(self):
+        """
+        Refresh the expiry of this worker and remove the sessions of the workers whose key expired
+        Returns:
+            list id of the users who went offline with the removed sessions
+        """
+        self._redis.set(self._alive_key(self._worker_id), 1, ex=self.ttl)
+        offline = []
+        prefix = self._sessions_key("")
+        for key in list(self._redis.scan_iter(match=prefix + "*", count=1000)):
+            worker_id = key[len(prefix):]
+            if worker_id == self._worker_id or self._redis.exists(self._alive_key(worker_id)):
+                continue
+            logger.warning('Presence worker {} expired, remove its sessions'.format(worker_id))
+            offline.extend(self._clear_worker(worker_id))
+        return offline
+
+    def _clear_worker(self, worker_id):
+        offline = []
+        worker_key = self._sessions_key(worker_id)
+        for session_id in self._redis.smembers(worker_key):
+            user_id, is_last_session = self._remove(session_id, worker_key)
+            if is_last_session:
+                offline.append(user_id)
+        self._redis.delete(worker_key)
+        return offline
+
+    def get(self, session_id):
+        return self._redis.get(self._session_key(session_id))
+
+    def get_sessions(self, user_id):
+        return list(self._redis.smembers(self._user_key(user_id)))
+
+    def is_online(self, user_id):
+        return self._redis.exists(self._user_key(user_id)) > 0
+
+    def get_users(self):
+        prefix = self._user_key("")
+        return [key[len(prefix):] for key in self._redis.scan_iter(match=prefix + "*", count=1000)]
+
+    def clear(self):
+        """
+        Remove the sessions of this worker
+        """
+        self._clear_worker(self._worker_id)
+        self._redis.delete(self._alive_key(self._worker_id))
+
+    def __len__(self):
+        return self._redis.scard(self._worker_key)
+
+
+class PresenceRegistry(object):
+    """
+    Keep track of the connected sockets with two indexes which are always updated together:
+        session id -> user id
+        user id -> set of session ids
+    so looking up the user of a session, the sessions of a user or checking if a user is online are all O(1).
+    The indexes live in this process, or in redis when PRESENCE_URL is configured so all workers share them, then a
+    background task sends the heartbeat of this worker every heartbeat_interval seconds
+    """
+
+    def __init__(self):
+        self.backend = LocalPresenceBackend()
+        self.heartbeat_interval = 10.0
+        self._reap = None
+        self._app = None
+        self._server = None
+        self._started = False
+        self._lock = Lock()
+
+    def init_app(self, app, server):
+        """
+        Args:
+            app:
+            server: the engine.io server of socket.io, the heartbeats run in one of its background tasks
+        """
+        url = app.config.get('PRESENCE_URL')
+        if url:
+            self.backend = RedisPresenceBackend(url, app.config.get('PRESENCE_TTL', 30))
+        self.heartbeat_interval = app.config.get('PRESENCE_HEARTBEAT_INTERVAL', self.heartbeat_interval)
+        self._app = app
+        self._server = server
+
+    def on_reap(self, func):
+        """
+        Register func(offline) called with the list id of the users who went offline when the sessions of a dead
+        worker are removed
+        """
+        self._reap = func
+        return func
+
+    def _start(self):
+        # the task starts with the first session so it runs in the serving process, not in a parent which forks
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._server.start_background_task(self._run)
+
+    def _run(self):
+        while main_thread().is_alive():
+            self._server.sleep(self.heartbeat_interval)
+            try:
+                with self._app.app_context():
+                    self.heartbeat()
+            except Exception:
+                logger.exception('Presence heartbeat failed')
+
+    def heartbeat(self):
+        """
+        Keep this worker alive and remove the sessions of the dead workers
+        Returns:
+            list id of the users who went offline
+        """
+        offline = self.backend.heartbeat()
+        if offline and self._reap is not None:
+            self._reap(offline)
+        return offline
+
+    def add(self, session_id, user_id):
+        """
+        Register a session of the user, a session which was authenticated before is moved to the new user
+        Args:
+            session_id:
+            user_id:
+
+        Returns:
+            True if this is the first session of the user
+
+        """
+        if self._server is not None and isinstance(self.backend, RedisPresenceBackend):
+            self._start()
+        return self.backend.add(session_id, user_id)
+
+    def remove(self, session_id):
+        """
+        Unregister a session
+        Args:
+            session_id:
+
+        Returns:
+            (user_id, is_last_session), user_id is None if the session was never authenticated
+
+        """
+        return self.backend.remove(session_id)
+
+    def get(self, session_id, default=None):
+        """
+        Returns:
+            user id of the session
+        """
+        user_id = self.backend.get(session_id)
+        return default if user_id is None else user_id
+
+    def get_sessions(self, user_id):
+        """
+        Returns:
+            list session ids of the user
+        """
+        return self.backend.get_sessions(user_id)
+
+    def is_online(self, user_id):
+        return self.backend.is_online(user_id)
+
+    def get_users(self):
+        """
+        Returns:
+            list id of online users, each user appears once
+        """
+        return self.backend.get_users()
+
+    def clear(self):
+        self.backend.clear()
+
+    def __contains__(self, session_id):
+        return self.backend.get(session_id) is not None
+
+    def __getitem__(self, session_id):
+        user_id = self.backend.get(session_id)
+        if user_id is None:
+            raise KeyError(session_id)
+        return user_id
+
+    def __len__(self):
+        return len(self.backend)
+
+
+class PresenceChanges(object):
+    """
+    Coalesce the online and offline transitions of the users connected to this worker and publish them every
+    flush_interval seconds as one diff: the users who came online and the users who went offline since the last
+    flush. A user who goes offline and comes back within the interval is not published at all.
+    With flush_interval = 0 every transition is published at once
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.flush_interval = 1.0
+        self.changes = 0
+        self.published = 0
+        self.flushes = 0
+        self._pending = {}
+        self._publish = None
+        self._app = None
+        self._server = None
+        self._started = False
+        self._lock = Lock()
+
+    def init_app(self, app, server):
+        """
+        Args:
+            app:
+            server: the engine.io server of socket.io, the flushes run in one of its background tasks
+        """
+        self.flush_interval = app.config.get('PRESENCE_FLUSH_INTERVAL', self.flush_interval)
+        self._app = app
+        self._server = server
+
+    def on_flush(self, func):
+        """
+        Register func(online, offline) which publishes a diff, online and offline are lists of user ids
+        """
+        self._publish = func
+        return func
+
+    def _start(self):
+        # the task starts with the first change so it runs in the serving process, not in a parent which forks
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._server.start_background_task(self._run)
+
+    def _run(self):
+        while main_thread().is_alive():
+            self._server.sleep(self.flush_interval)
+            try:
+                with self._app.app_context():
+                    self.flush()
+            except Exception:
+                logger.exception('Presence flush failed')
+
+    def changed(self, user_id, online):
+        """
+        Record a transition of the user, call it after the registry is updated
+        Args:
+            user_id:
+            online: True if the user came online, False if the user went offline
+
+        """
+        with self._lock:
+            # the state before the first transition of the interval, compared to the registry at the flush
+            self._pending.setdefault(user_id, not online)
+            self.changes += 1
+        if self.flush_interval <= 0:
+            self.flush()
+        elif self._server is not None:
+            self._start()
+
+    def flush(self):
+        """
+        Publish the users whose state differs from their state at the previous flush
+        Returns:
+            (online, offline) lists of user ids
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        online, offline = [], []
+        for user_id, was_online in pending.items():
+            is_online = self.registry.is_online(user_id)
+            if is_online != was_online:
+                (online if is_online else offline).append(user_id)
+        self.flushes += 1
+        if (online or offline) and self._publish is not None:
+            self._publish(online, offline)
+            self.published += len(online) + len(offline)
+        return online, offline
+
+    def stats(self):
+        return {
+            "flush_interval": self.flush_interval,
+            "pending": len(self._pending),
+            "changes": self.changes,
+            "published": self.published,
+            "flushes": self.flushes
+        }
+
+
+class TypingIndicators(object):
+    """
+    Typing state of the users per conversation, kept in this process only:
+    (conversation type, conversation id, user id) -> entry.
+    The keystrokes of a user only refresh the expiry of the entry, the recipients get the transitions: started
+    when the user starts typing, stopped when the client says so or when no keystroke came for timeout seconds.
+    A conversation changes state at most once per interval for a user, a change which comes too early is applied by
+    the sweep which runs every interval in a background task
+    """
+
+    def __init__(self):
+        self.interval = 1.0
+        self.timeout = 5.0
+        self.keystrokes = 0
+        self.transitions = 0
+        self._entries = {}
+        self._publish = None
+        self._server = None
+        self._started = False
+        self._lock = Lock()
+
+    def init_app(self, app, server):
+        """
+        Args:
+            app:
+            server: the engine.io server of socket.io, the sweeps run in one of its background tasks
+        """
+        self.interval = app.config.get('TYPING_INTERVAL', self.interval)
+        self.timeout = app.config.get('TYPING_TIMEOUT', self.timeout)
+        self._server = server
+
+    def on_change(self, func):
+        """
+        Register func(conversation_type, conversation_id, user_id, is_typing) which publishes a transition
+        """
+        self._publish = func
+        return func
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._server.start_background_task(self._run)
+
+    def _run(self):
+        while main_thread().is_alive():
+            self._server.sleep(max(self.interval, 0.1))
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Typing sweep failed')
+
+    def _change(self, key, entry, is_typing, now):
+        entry["typing"] = is_typing
+        entry["changed"] = now
+        entry["pending"] = None
+        self.transitions += 1
+        return key + (is_typing,)
+
+    def update(self, conversation_type, conversation_id, user_id, is_typing):
+        """
+        Record a keystroke (is_typing True) or the end of the typing (is_typing False) of the user
+        """
+        now = monotonic()
+        key = (conversation_type, conversation_id, user_id)
+        with self._lock:
+            self.keystrokes += 1
+            entry = self._entries.get(key)
+            if entry is None:
+                if not is_typing:
+                    return
+                entry = self._entries[key] = {"typing": False, "changed": float('-inf'), "pending": None,
+                                              "expires": 0}
+            if is_typing:
+                entry["expires"] = now + self.timeout
+            if is_typing == entry["typing"]:
+                entry["pending"] = None
+                return
+            if now - entry["changed"] < self.interval:
+                entry["pending"] = is_typing
+                change = None
+            else:
+                change = self._change(key, entry, is_typing, now)
+        if self._server is not None:
+            self._start()
+        if change is not None and self._publish is not None:
+            self._publish(*change)
+
+    def stop_user(self, user_id):
+        """
+        The user went offline, every conversation where the user was typing gets stopped
+        """
+        now = monotonic()
+        changes = []
+        with self._lock:
+            for key in [key for key in self._entries if key[2] == user_id]:
+                entry = self._entries.pop(key)
+                if entry["typing"]:
+                    changes.append(self._change(key, entry, False, now))
+        for change in changes:
+            if self._publish is not None:
+                self._publish(*change)
+
+    def sweep(self):
+        """
+        Apply the pending changes which waited for the interval, stop the users whose keystrokes expired and forget
+        the entries which are not typing any more
+        Returns:
+            list (conversation_type, conversation_id, user_id, is_typing) published
+        """
+        now = monotonic()
+        changes = []
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry["typing"] and entry["expires"] <= now:
+                    changes.append(self._change(key, entry, False, now))
+                elif entry["pending"] is not None and now - entry["changed"] >= self.interval:
+                    changes.append(self._change(key, entry, entry["pending"], now))
+                elif not entry["typing"] and entry["pending"] is None and now - entry["changed"] >= self.interval:
+                    del self._entries[key]
+        for change in changes:
+            if self._publish is not None:
+                self._publish(*change)
+        return changes
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "timeout": self.timeout,
+            "typing": sum(1 for entry in self._entries.values() if entry["typing"]),
+            "keystrokes": self.keystrokes,
+            "transitions": self.transitions
+        }
@@ -1,3 +1,5 @@
+from app.enums import MAX_PRESENCE_USERS
+
 user_validator = {
     "type": "object",
     "properties": {
@@ -36,3 +38,18 @@ password_validator = {
     },
     "required": ["new_password"]
 }
+
+presence_validator = {
+    "type": "object",
+    "properties": {
+        "users_id": {
+            "type": "array",
+            "items": {
+                "type": "string",
+                "maxLength": 50
+            },
+            "maxItems": MAX_PRESENCE_USERS
+        }
+    },
+    "required": ["users_id"]
+}
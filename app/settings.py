@@ -24,6 +24,57 @@ class AppConfig(Config):
     JWT_BLACKLIST_ENABLED = True
     JWT_BLACKLIST_TOKEN_CHECKS = ['access', 'refresh']
 
+    # token revocation cache, TOKEN_CACHE_CHANNEL_URL is a redis url to share invalidations between workers
+    TOKEN_CACHE_ENABLED = os.environ.get('TOKEN_CACHE_ENABLED', '1') == '1'
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 60))
+    TOKEN_CACHE_CHANNEL_URL = os.environ.get('TOKEN_CACHE_CHANNEL_URL')
+
+    # group members cache, GROUP_CACHE_CHANNEL_URL is a redis url to share invalidations between workers
+    GROUP_CACHE_SIZE = int(os.environ.get('GROUP_CACHE_SIZE', 10000))
+    GROUP_CACHE_CHANNEL_URL = os.environ.get('GROUP_CACHE_CHANNEL_URL')
+
+    # friends cache, FRIEND_CACHE_CHANNEL_URL is a redis url to share invalidations between workers
+    FRIEND_CACHE_SIZE = int(os.environ.get('FRIEND_CACHE_SIZE', 100000))
+    FRIEND_CACHE_CHANNEL_URL = os.environ.get('FRIEND_CACHE_CHANNEL_URL')
+
+    # key directory cache, KEY_CACHE_CHANNEL_URL is a redis url to share invalidations between workers
+    KEY_CACHE_SIZE = int(os.environ.get('KEY_CACHE_SIZE', 100000))
+    KEY_CACHE_CHANNEL_URL = os.environ.get('KEY_CACHE_CHANNEL_URL')
+
+    # recently sent messages by client message id, answers the retries of the clients without reading the database
+    RECENT_MESSAGE_CACHE_SIZE = int(os.environ.get('RECENT_MESSAGE_CACHE_SIZE', 100000))
+    RECENT_MESSAGE_CACHE_TTL = int(os.environ.get('RECENT_MESSAGE_CACHE_TTL', 300))
+
+    # ids of the private conversations by pair of users
+    CONVERSATION_ID_CACHE_SIZE = int(os.environ.get('CONVERSATION_ID_CACHE_SIZE', 100000))
+
+    # scale out, run several workers sharing a redis server: SOCKETIO_MESSAGE_QUEUE delivers the emits to the sockets
+    # of every worker and PRESENCE_URL shares the online users, leave them empty to run a single worker
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    PRESENCE_URL = os.environ.get('PRESENCE_URL')
+    # every worker refreshes its presence key every PRESENCE_HEARTBEAT_INTERVAL seconds, the online users of a worker
+    # whose key was not refreshed for PRESENCE_TTL seconds are removed by the other workers
+    PRESENCE_HEARTBEAT_INTERVAL = float(os.environ.get('PRESENCE_HEARTBEAT_INTERVAL', 10))
+    PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 30))
+    # the online and offline changes are sent to the friends and group members in one diff every interval (seconds),
+    # 0 sends every change at once
+    PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 1))
+    # a user is typing until TYPING_TIMEOUT seconds after the last keystroke, the typing state of a user in a
+    # conversation changes at most once every TYPING_INTERVAL seconds
+    TYPING_INTERVAL = float(os.environ.get('TYPING_INTERVAL', 1))
+    TYPING_TIMEOUT = float(os.environ.get('TYPING_TIMEOUT', 5))
+
+    # delivery queue of the sent messages, DELIVERY_WORKERS = 0 delivers in the request like before.
+    # A job waits DELIVERY_PUT_TIMEOUT seconds for a free slot of a full queue then it is dropped, a failed job is tried
+    # again after DELIVERY_RETRY_DELAY seconds times the attempt
+    DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', 2))
+    DELIVERY_QUEUE_SIZE = int(os.environ.get('DELIVERY_QUEUE_SIZE', 10000))
+    DELIVERY_MAX_RETRIES = int(os.environ.get('DELIVERY_MAX_RETRIES', 3))
+    DELIVERY_RETRY_DELAY = float(os.environ.get('DELIVERY_RETRY_DELAY', 0.1))
+    DELIVERY_PUT_TIMEOUT = float(os.environ.get('DELIVERY_PUT_TIMEOUT', 0.05))
+
     # mysql config
     SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI')
+    # store the ids as BINARY(16) instead of VARCHAR(50), migrate/binary_ids.py converts an existing database
+    BINARY_IDS = os.environ.get('BINARY_IDS', '0') == '1'
     SQLALCHEMY_TRACK_MODIFICATIONS = True
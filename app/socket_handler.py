@@ -1,12 +1,13 @@
-import uuid
-
 from flask import request
 from flask_jwt_extended import decode_token
 from flask_socketio import send, emit, join_room, leave_room
 
-from app.extensions import sio, db, logger, online_users
-from app.models import Message, User, Group, GroupUser
-from app.utils import generate_id, get_timestamp_now
+from app.api.v1 import chat, group_chat as group_chat_api
+from app.enums import CONVERSATION_PRIVATE, CONVERSATION_GROUP
+from app.extensions import db, sio, online_users, presence_changes, typing_indicators, group_members, user_friends, \
+    delivery
+from app.models import Group, GroupUser, User, Friend
+from app.utils import emit_to_user, user_room, get_timestamp_now
 
 
 @sio.on('connect')
@@ -38,19 +39,19 @@ def disconnect():
     """
     session_id = request.sid
     print('[DISCONNECTED] ', session_id)
-    current_user_id = online_users.get(session_id)
-    sio.emit('offline', current_user_id, broadcast=True)
-    sessions_id = [key for key, value in online_users.items() if value == current_user_id]
-    sessions_id.append(session_id)
-    for si in sessions_id:
-        online_users.pop(si, 'No Key found')
+    current_user_id, is_last_session = online_users.remove(session_id)
+    # the user is still online while another session of the user is connected
+    if is_last_session:
+        presence_changes.changed(current_user_id, False)
+        typing_indicators.stop_user(current_user_id)
 
 
 @sio.on('auth')
 def auth(token):
     """
     A user when connect to this socket will have a session ID of the connection which can be obtained from request.sid
-    this function will store all users in a dictionary with username and the session ID of the connection
+    this function will store all users in a dictionary with username and the session ID of the connection,
+    the session joins the room of the user so every delivery to the user is a single emit to this room
     Args:
         token:
 
@@ -59,35 +60,148 @@ def auth(token):
     """
     decoded_token = decode_token(token)
     user_id = decoded_token["identity"] if "identity" in decoded_token else "NONE"
-    online_users[request.sid] = user_id
+    old_user_id = online_users.get(request.sid)
+    if old_user_id is not None and old_user_id != user_id:
+        leave_room(user_room(old_user_id))
+    is_first_session = online_users.add(request.sid, user_id)
+    join_room(user_room(user_id))
     print(user_id + ' Login')
-    sio.emit('online', user_id, broadcast=True)
+    if is_first_session and old_user_id != user_id:
+        presence_changes.changed(user_id, True)
+    if old_user_id is not None and old_user_id != user_id and not online_users.is_online(old_user_id):
+        presence_changes.changed(old_user_id, False)
+    if is_first_session:
+        delivery.put(warm_contacts, user_id, key=user_id)
+
+
+def warm_contacts(user_id):
+    """
+    Load the friends of the user and the members of the groups of the user into the caches, so the conversations of
+    the typing events of the user are known without reading the database
+    Args:
+        user_id:
+
+    """
+    Friend.get_friends_id(user_id)
+    GroupUser.warm_members([user_id])
+
+
+@online_users.on_reap
+def reap_presence(offline):
+    """
+    The sessions of a dead worker were removed, its users who have no session left went offline
+    Args:
+        offline: list user ids
+
+    """
+    for user_id in offline:
+        presence_changes.changed(user_id, False)
+
+
+@presence_changes.on_flush
+def publish_presence(online, offline):
+    """
+    Store the last seen date of the users who went offline and send the changes to the online friends and group
+    members of the users, every contact gets one 'presence' event {online: [user ids], offline: [user ids]} with all
+    the changes it can see instead of one event per change
+    Args:
+        online: list user ids who came online
+        offline: list user ids who went offline
+
+    """
+    if offline:
+        User.update_last_seen(offline, get_timestamp_now())
+        db.session.commit()
+
+    changes = {**dict.fromkeys(offline, "offline"), **dict.fromkeys(online, "online")}
+    online_contacts = {}
+    diffs = {}
+    for user_id, contacts_id in User.get_contacts_id(list(changes)).items():
+        for contact_id in contacts_id:
+            if contact_id not in online_contacts:
+                online_contacts[contact_id] = online_users.is_online(contact_id)
+            if online_contacts[contact_id]:
+                diffs.setdefault(contact_id, {"online": [], "offline": []})[changes[user_id]].append(user_id)
+
+    for contact_id, diff in diffs.items():
+        emit_to_user('presence', diff, contact_id)
 
 
 @sio.on('typing')
 def typing(payload: dict):
     """
+    Keystrokes of the user, the recipients get the started and stopped transitions from typing_indicators
     Args:
-        payload: {conversationId: string; isTyping: boolean; };
+        payload: {conversationId: string; isTyping: boolean; type?: 'private' | 'group'; };
+                 type is a hint, without it the conversation is a group if the id is a group and private otherwise
 
     Returns:
 
     """
-
-    conversation_id = payload.get('conversationId', None)
-    check_group = Group.get_by_id(conversation_id)
-    members_id = [conversation_id]
     current_user_id = online_users.get(request.sid)
-    if check_group:
-        members = GroupUser.get_by_group_id(conversation_id)
-        members_id = [m.user_id for m in members if m.user_id != current_user_id]
-    else:
-        payload['conversationId'] = current_user_id
+    if current_user_id is None or not isinstance(payload, dict):
+        return
+    conversation_id = payload.get('conversationId')
+    if not isinstance(conversation_id, str):
+        return
+    conversation_type = get_conversation_type(conversation_id, current_user_id, payload.get('type'))
+    typing_indicators.update(conversation_type, conversation_id, current_user_id, bool(payload.get('isTyping', True)))
+
+
+def get_conversation_type(conversation_id, user_id, hint=None):
+    """
+    Type of the conversation from the hint of the client, else from the membership and friends caches loaded when the
+    user connects, the database is only read when neither cache knows the id
+    Args:
+        conversation_id: id of the group or id of the partner of a private conversation
+        user_id:
+        hint: type sent by the client, may be missing
+
+    Returns:
+        CONVERSATION_PRIVATE or CONVERSATION_GROUP
+    """
+    if hint in (CONVERSATION_PRIVATE, CONVERSATION_GROUP):
+        return hint
+    if group_members.get(conversation_id) is not None:
+        return CONVERSATION_GROUP
+    if conversation_id in (user_friends.get(user_id) or ()):
+        return CONVERSATION_PRIVATE
+    return CONVERSATION_GROUP if Group.get_by_id(conversation_id) is not None else CONVERSATION_PRIVATE
+
 
+@typing_indicators.on_change
+def publish_typing(conversation_type, conversation_id, user_id, is_typing):
+    """
+    Every transition goes through the delivery queue with the conversation as key, so the started and stopped
+    transitions of a conversation are emitted in the order they happened
+    """
+    delivery.put(deliver_typing, conversation_type, conversation_id, user_id, is_typing, key=conversation_id)
+
+
+def deliver_typing(conversation_type, conversation_id, user_id, is_typing):
+    """
+    Send the transition to the partner of a private conversation or to the other members of the group, the members
+    come from the membership cache
+    Args:
+        conversation_type: CONVERSATION_PRIVATE or CONVERSATION_GROUP
+        conversation_id: id of the group or id of the partner of a private conversation
+        user_id: user who started or stopped typing
+        is_typing:
+
+    """
+    payload = {"conversationId": conversation_id, "type": conversation_type, "userId": user_id,
+               "isTyping": is_typing, "state": "started" if is_typing else "stopped"}
+    if conversation_type == CONVERSATION_PRIVATE:
+        # the partner sees it as the conversation with the user
+        payload["conversationId"] = user_id
+        emit_to_user('typing', payload, conversation_id)
+        return
+    members_id = GroupUser.get_members_id(conversation_id)
+    if user_id not in members_id:
+        return
     for member_id in members_id:
-        receivers_session_id = [key for key, value in online_users.items() if value == member_id]
-        for session_id in receivers_session_id:
-            sio.emit('typing', payload, room=session_id)
+        if member_id != user_id:
+            emit_to_user('typing', payload, member_id)
 
 
 @sio.on('message')
@@ -105,40 +219,71 @@ def handle_message(msg):
     send(msg, broadcast=True)
 
 
-@sio.on('private_chat')
-def private_chat(data):
+def ack(data=None, message="OK", status=True):
+    """
+    Acknowledgement of an event, the same fields as the response of the api
     """
-    A session ID of the connection is a room contain this user, this function will get session id of the receiver user
-    from dictionary users, then emit event new_private_msg with parameter room=receive_session_id
+    return {"status": status, "message": message, "data": data}
+
+
+def send_from_socket(send_message, payload, target_key, options=()):
+    """
+    Send a message of the authenticated user of this session with the same function as the api
     Args:
-        data:
+        send_message: chat.send_message or group_chat.send_message
+        payload: event data
+        target_key: key of the receiver id or the group id in payload
+        options: optional keys of payload passed to send_message as keyword arguments
 
     Returns:
+        ack with the stored message
 
     """
+    current_user_id = online_users.get(request.sid)
+    if current_user_id is None:
+        return ack(message="Not authenticated", status=False)
+    try:
+        target_id = payload[target_key]
+        messages = payload['messages']
+    except (KeyError, TypeError) as ex:
+        return ack(message="Parameters error: " + str(ex), status=False)
 
-    receiver_id = data["receiver_id"]
-    message = data['message']
+    kwargs = {key: payload[key] for key in options if key in payload}
+    data, error = send_message(current_user_id, target_id, messages, payload.get('client_message_id'), **kwargs)
+    if error is not None:
+        return ack(message=error, status=False)
+    return ack(data=data)
 
-    check_receiver = User.get_by_id(receiver_id)
-    if check_receiver is None:
-        logger.error("Not found receiver")
-        return
 
-    created_date = get_timestamp_now()
-    _id = str(uuid.uuid1())
-    current_user_id = online_users[request.sid]
-    group_id = generate_id(current_user_id, receiver_id)
-    new_values = Message(id=_id, message=message, sender_id=current_user_id, group_id=group_id,
-                         created_date=created_date)
-    db.session.add(new_values)
-    db.session.commit()
+@sio.on('private_chat')
+def private_chat(payload):
+    """
+    Send a private message over the socket instead of POST /api/v1/chats/<receiver_id>,
+    the session must have sent auth before
+    Args:
+        payload: {receiver_id: string; messages: {[user_id]: cipher text for this user}; client_message_id?: string};
+
+    Returns:
+        ack {status, message, data}, data is the stored message with its id and created_date
 
-    receivers_session_id = [key for key, value in online_users.items() if value == receiver_id]
-    data = Message.to_json(new_values)
+    """
+    return send_from_socket(chat.send_message, payload, 'receiver_id')
 
-    for i in receivers_session_id:
-        sio.emit('new_private_msg', data, room=i)
+
+@sio.on('group_chat')
+def group_chat(payload):
+    """
+    Send a group message over the socket instead of POST /api/v1/group_chats/<group_id>,
+    the session must have sent auth before
+    Args:
+        payload: {group_id: string; messages: {[user_id]: cipher text for this user}; client_message_id?: string;
+                  version?: 1 | 2; body?: string}, version 2 is an envelope: messages has the key of body per user
+
+    Returns:
+        ack {status, message, data}, data is the stored message with its id and created_date
+
+    """
+    return send_from_socket(group_chat_api.send_message, payload, 'group_id', ('version', 'body'))
 
 
 @sio.on('chat_group')
@@ -1,10 +1,12 @@
+import hashlib
 from time import time
 
 from flask import jsonify
 from flask_jwt_extended import get_jwt_identity
 
+from app.delivery import PartialDelivery
 from app.enums import ALLOWED_EXTENSIONS_IMG
-from .extensions import parser, online_users
+from .extensions import parser, online_users, sio, conversation_ids
 import datetime
 import werkzeug
 from marshmallow import fields, validate as validate_
@@ -183,18 +185,120 @@ def is_user_online(user_id):
     """
         Returns:
             True if current user is online
+            if user_id is a list, True if any user in the list except current user is online
     """
     if type(user_id) is list:
-        user_id.remove(get_jwt_identity())
-        for session_id, _user_id in online_users.items():
-            if _user_id in user_id:
-                return True
-        return False
+        current_user_id = get_jwt_identity()
+        return any(online_users.is_online(_user_id) for _user_id in user_id if _user_id != current_user_id)
 
-    for session_id, _user_id in online_users.items():
-        if _user_id == user_id:
-            return True
-    return False
+    return online_users.is_online(user_id)
+
+
+def user_room(user_id):
+    """
+    Every session of a user joins the room of the user when it authenticates
+    """
+    return "user:" + user_id
+
+
+def emit_to_user(event, data, user_id):
+    """
+    Emit the event once to the room of the user, socket.io delivers it to every connected session of the user
+    Args:
+        event:
+        data:
+        user_id:
+
+    Returns:
+
+    """
+    sio.emit(event, data, room=user_room(user_id))
+
+
+def emit_to_users(event, data, users_id):
+    """
+    Emit the event to the room of every user, the emits which fail do not stop the others
+    Args:
+        event:
+        data:
+        users_id: list user ids
+
+    Raises:
+        PartialDelivery: with the users whose emit failed, the delivery queue retries only them
+
+    """
+    failed, error = [], None
+    for user_id in users_id:
+        try:
+            emit_to_user(event, data, user_id)
+        except Exception as ex:
+            failed.append(user_id)
+            error = ex
+    if failed:
+        raise PartialDelivery(error, emit_to_users, event, data, failed)
+
+
+def generate_members_hash(users_id):
+    """
+    Fingerprint of the members of a group, the same set of users always gives the same hash
+    Args:
+        users_id: list user ids
+
+    Returns:
+        sha256 hex digest of the sorted user ids
+
+    """
+    return hashlib.sha256(",".join(sorted(set(users_id))).encode()).hexdigest()
+
+
+def generate_key_fingerprint(pub_key):
+    """
+    Fingerprint of a public key, the clients compare it to the key they have to know when to download it again
+    Args:
+        pub_key:
+
+    Returns:
+        sha256 hex digest of the key
+
+    """
+    return hashlib.sha256((pub_key or "").encode()).hexdigest()
+
+
+def is_client_message_id(client_message_id):
+    """
+    Returns:
+        True if the idempotency key sent by the client is empty or fits the column client_message_id
+    """
+    return client_message_id is None or (isinstance(client_message_id, str) and 0 < len(client_message_id) <= 50)
+
+
+def encode_cursor(created_date, _id):
+    """
+    Encode the position of the last item of a page, the client sends it back to get the next page
+    Args:
+        created_date:
+        _id:
+
+    Returns:
+
+    """
+    return "{}_{}".format(created_date, _id)
+
+
+def decode_cursor(cursor):
+    """
+    Args:
+        cursor: string created by encode_cursor
+
+    Returns:
+        (created_date, id) or None if the cursor is invalid
+
+    """
+    try:
+        created_date, _id = cursor.split("_", 1)
+        return int(created_date), _id
+    except (AttributeError, ValueError):
+        return None
 
 
 mapping_char_to_number = {**{chr(i): i - 48 for i in range(48, 58)},
@@ -202,16 +306,45 @@ mapping_char_to_number = {**{chr(i): i - 48 for i in range(48, 58)},
 mapping_number_to_char = {**{i: chr(i + 48) for i in range(0, 10)},
                           **{i: chr(i + 87) for i in range(10, 36)}}
 
+# byte value of every character of an id: the base 36 digit, 100 for '-' and 120 for anything else
+DIGIT_VALUES = bytes(mapping_char_to_number.get(chr(i), 100 if chr(i) == '-' else 120) for i in range(256))
+# character of the sum of two byte values: the base 36 digit for two digits, '-' for two dashes and NUL otherwise
+SUM_CHARS = bytes(ord(mapping_number_to_char[i % 36]) if i <= 70 else ord('-') if i == 200 else 0
+                  for i in range(256))
+ID_LENGTH = 36
 
-def generate_id(id1, id2):
+
+def id_to_int(value):
     """
-    Generate id from two id
     Args:
-        id1:
-        id2:
+        value: id string
+
+    Returns:
+        integer with one byte per character of value holding its value in DIGIT_VALUES, None if value is not a string
+        of 36 characters
+
+    """
+    if not isinstance(value, str) or len(value) != ID_LENGTH:
+        return None
+    return int.from_bytes(value.encode('ascii', 'replace').translate(DIGIT_VALUES), 'big')
+
 
+def int_to_id(number):
+    """
+    Add the integers of two ids, the bytes never carry (at most 240), and map the sums back to characters
     Returns:
+        id string, None if a character is not a digit or a dash is not at its place
+    """
+    rs = number.to_bytes(ID_LENGTH, 'big').translate(SUM_CHARS).decode('ascii')
+    if rs[8] != '-' or rs[13] != '-' or rs[18] != '-' or rs[23] != '-' or rs.count('-') != 4 or '\x00' in rs:
+        return None
+    return rs
+
 
+def generate_id_slow(id1, id2):
+    """
+    Reference implementation of generate_id, one character at a time, used for the ids which are not two canonical
+    strings of base 36 digits so the result or the error stays the same
     """
     u11 = id1
     u22 = id2
@@ -226,3 +359,50 @@ def generate_id(id1, id2):
         index += 1
         new_id += '-'
     return new_id[:-1]
+
+
+def generate_id(id1, id2):
+    """
+    Generate id from two id, every digit is the sum of the digits of id1 and id2 modulo 36 so
+    generate_id(id1, id2) == generate_id(id2, id1). The ids of the recent conversations are kept in conversation_ids
+    Args:
+        id1:
+        id2:
+
+    Returns:
+
+    """
+    if not isinstance(id1, str) or not isinstance(id2, str):
+        return generate_id_slow(id1, id2)
+    key = (id1, id2) if id1 <= id2 else (id2, id1)
+    rs = conversation_ids.get(key)
+    if rs is None:
+        number1 = id_to_int(id1)
+        number2 = id_to_int(id2)
+        rs = int_to_id(number1 + number2) if number1 is not None and number2 is not None else None
+        if rs is None:
+            return generate_id_slow(id1, id2)
+        conversation_ids.set(key, rs)
+    return rs
+
+
+def generate_ids(user_id, partners_id):
+    """
+    Generate the ids of the conversations of one user with many partners, the user id is converted once
+    Args:
+        user_id:
+        partners_id: list id of the partners
+
+    Returns:
+        list id of the conversations in the order of partners_id
+
+    """
+    number = id_to_int(user_id)
+    if number is None:
+        return [generate_id_slow(user_id, partner_id) for partner_id in partners_id]
+    rs = []
+    for partner_id in partners_id:
+        partner_number = id_to_int(partner_id)
+        group_id = int_to_id(number + partner_number) if partner_number is not None else None
+        rs.append(generate_id_slow(user_id, partner_id) if group_id is None else group_id)
+    return rs
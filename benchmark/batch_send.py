@@ -0,0 +1,51 @@
+"""
+Flush of an outbox of OUTBOX messages to RECEIVERS friends with one POST /api/v1/chats/<receiver_id> per message and
+with one POST /api/v1/chats/batch, then the same batch again like a client retrying after a timeout
+python benchmark/batch_send.py
+"""
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app, create_users, auth_headers, QueryCounter
+
+from app.models import Message
+
+OUTBOX = 100
+RECEIVERS = 10
+
+
+def outbox(sender_id, receivers_id):
+    return [{"client_message_id": str(uuid.uuid4()), "receiver_id": receivers_id[index % len(receivers_id)],
+             "messages": {sender_id: "x" * 344, receivers_id[index % len(receivers_id)]: "x" * 344}}
+            for index in range(OUTBOX)]
+
+
+def flush_one_by_one(client, headers, items):
+    for item in items:
+        client.post('/api/v1/chats/' + item["receiver_id"], json={"messages": item["messages"]}, headers=headers)
+
+
+def flush_batch(client, headers, items):
+    client.post('/api/v1/chats/batch', json={"items": items}, headers=headers)
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    users_id = create_users(RECEIVERS + 1)
+    sender_id, receivers_id = users_id[0], users_id[1:]
+    headers = auth_headers(sender_id)
+    client = app.test_client()
+    counter = QueryCounter()
+
+    items = []
+    for name, func in (("one post per message", flush_one_by_one), ("batch", flush_batch),
+                       ("batch retried", flush_batch)):
+        if name != "batch retried":
+            items = outbox(sender_id, receivers_id)
+        stored = Message.query.count()
+        with counter.measure():
+            start = perf_counter()
+            func(client, headers, items)
+            elapsed = perf_counter() - start
+        print(f"{OUTBOX} messages to {RECEIVERS} friends, {name}: {elapsed * 1000:.1f} ms, {counter.count} queries, "
+              f"{Message.query.count() - stored} messages stored")
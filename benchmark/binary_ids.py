@@ -0,0 +1,86 @@
+"""
+Size of the tables and indexes and latency of the history query (messages and their user_messages) with the ids
+stored as VARCHAR(50) and as BINARY(16), every storage runs in its own process because the storage is chosen at startup
+python benchmark/binary_ids.py
+"""
+import os
+import subprocess
+import sys
+import uuid
+from time import perf_counter
+
+USERS = 1000
+CONVERSATIONS = 500
+MESSAGES = 50000
+QUERIES = 500
+
+if __name__ == '__main__' and '--child' not in sys.argv:
+    for binary in ('0', '1'):
+        subprocess.run([sys.executable, os.path.realpath(__file__), '--child'], check=True,
+                       env=dict(os.environ, BINARY_IDS=binary))
+    sys.exit(0)
+
+from common import create_benchmark_app, create_users
+
+from app.extensions import db
+from app.ids import binary_ids
+from app.models import Message
+from app.utils import generate_id, get_timestamp_now
+
+
+def fill():
+    """
+    Returns:
+        list (user_id, partner_id) of the conversations
+    """
+    users_id = create_users(USERS)
+    conversations = [(users_id[index % USERS], users_id[(index * 7 + 1) % USERS]) for index in range(CONVERSATIONS)]
+    created_date = get_timestamp_now()
+    for start in range(0, MESSAGES, 1000):
+        items = []
+        for index in range(start, min(start + 1000, MESSAGES)):
+            sender_id, receiver_id = conversations[index % CONVERSATIONS]
+            items.append({"id": str(uuid.uuid1()), "sender_id": sender_id, "receiver_id": receiver_id,
+                          "group_id": generate_id(sender_id, receiver_id), "created_date": created_date + index,
+                          "client_message_id": None, "messages": {sender_id: "x" * 344, receiver_id: "x" * 344}})
+        Message.insert_messages(items)
+    db.session.commit()
+    return conversations
+
+
+def sizes():
+    """
+    Returns:
+        (bytes of the tables, bytes of the indexes), the primary key of InnoDB is the table itself
+    """
+    if db.engine.dialect.name == 'mysql':
+        tables = [row[0] for row in db.engine.execute("SHOW TABLES")]
+        for table in tables:
+            db.engine.execute(f"ANALYZE TABLE {table}")
+        rows = db.engine.execute("SELECT index_name, stat_value * @@innodb_page_size FROM mysql.innodb_index_stats "
+                                 "WHERE database_name = DATABASE() AND stat_name = 'size'").fetchall()
+        return sum(size for name, size in rows if name == 'PRIMARY'), \
+            sum(size for name, size in rows if name != 'PRIMARY')
+
+    indexes = {row[0] for row in db.engine.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    rows = db.engine.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall()
+    return sum(size for name, size in rows if name not in indexes), sum(size for name, size in rows if name in indexes)
+
+
+def history_latency(conversations):
+    start = perf_counter()
+    for index in range(QUERIES):
+        user_id, partner_id = conversations[index % len(conversations)]
+        Message.get_history(generate_id(user_id, partner_id), user_id) \
+            .order_by(Message.created_date.desc(), Message.id.desc()).limit(20).all()
+    return (perf_counter() - start) / QUERIES
+
+
+if __name__ == '__main__':
+    create_benchmark_app()
+    conversations = fill()
+    table_bytes, index_bytes = sizes()
+    latency = history_latency(conversations)
+    storage = "BINARY(16)" if binary_ids.enabled else "VARCHAR(50)"
+    print(f"{storage} ids, {MESSAGES} messages: tables {table_bytes / 2 ** 20:.1f} MB, "
+          f"indexes {index_bytes / 2 ** 20:.1f} MB, history join {latency * 1000:.3f} ms")
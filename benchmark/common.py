@@ -0,0 +1,80 @@
+import os
+import sys
+import uuid
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# benchmarks run on an in-memory sqlite database unless SQLALCHEMY_DATABASE_URI is set
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('URL_SERVER', 'http://localhost:5010')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('JWT_SECRET_KEY', 'benchmark')
+# the jobs of the delivery queue run in the request, the workers can not share an in-memory sqlite database
+os.environ.setdefault('DELIVERY_WORKERS', '0')
+# the presence changes are published in the event for the same reason
+os.environ.setdefault('PRESENCE_FLUSH_INTERVAL', '0')
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from app.app import create_app
+from app.extensions import db
+from app.models import User, Token
+from app.utils import get_timestamp_now
+
+
+def create_benchmark_app():
+    """
+    Create the app with a new schema, the app context is pushed
+    """
+    app = create_app()
+    app.app_context().push()
+    db.drop_all()
+    db.create_all()
+    return app
+
+
+def create_users(total):
+    """
+    Insert users with the bulk path, returns list user ids
+    """
+    users_id = [str(uuid.uuid1()) for _ in range(total)]
+    created_date = get_timestamp_now()
+    db.session.bulk_insert_mappings(User, [{
+        "id": user_id,
+        "username": "user_{}".format(index),
+        "display_name": "User {}".format(index),
+        "password_hash": "-",
+        "pub_key": "-",
+        "created_date": created_date
+    } for index, user_id in enumerate(users_id)])
+    db.session.commit()
+    return users_id
+
+
+def auth_headers(user_id):
+    """
+    Returns the Authorization header of a new access token of the user
+    """
+    access_token = create_access_token(identity=user_id)
+    Token.add_token_to_database(access_token, user_id)
+    return {"Authorization": "Bearer " + access_token}
+
+
+class QueryCounter(object):
+    """
+    Count the statements sent to the database
+    """
+
+    def __init__(self):
+        self.count = 0
+        event.listen(db.engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+    @contextmanager
+    def measure(self):
+        self.count = 0
+        yield self
@@ -0,0 +1,71 @@
+"""
+Latency of POST /api/v1/group_chats/<group_id> with the fan-out and the seen update in the request and with the
+delivery queue. Every emit waits EMIT_LATENCY seconds like a publish to the socket.io message queue of a scaled out
+deployment. The workers need their own connections so the database is a sqlite file
+python benchmark/delivery.py
+"""
+import os
+import tempfile
+import uuid
+from time import perf_counter, sleep
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI',
+                      'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'delivery.db'))
+os.environ.setdefault('DELIVERY_WORKERS', '2')
+
+from common import create_benchmark_app, create_users, auth_headers
+
+from app.extensions import db, sio, delivery
+from app.models import Group, GroupUser
+from app.utils import get_timestamp_now
+
+GROUP_SIZE = 50
+MESSAGES = 100
+EMIT_LATENCY = 0.0005
+
+
+def slow_emit(emit):
+    def wrapper(*args, **kwargs):
+        sleep(EMIT_LATENCY)
+        return emit(*args, **kwargs)
+
+    return wrapper
+
+
+def create_group(members_id):
+    group_id = str(uuid.uuid1())
+    db.session.add(Group(id=group_id, name="benchmark", created_date=get_timestamp_now()))
+    db.session.bulk_insert_mappings(GroupUser, [{"user_id": user_id, "group_id": group_id} for user_id in members_id])
+    db.session.commit()
+    return group_id
+
+
+def run(client, url, headers, messages):
+    latencies = []
+    start = perf_counter()
+    for _ in range(MESSAGES):
+        request_start = perf_counter()
+        client.post(url, json={"messages": messages}, headers=headers)
+        latencies.append(perf_counter() - request_start)
+    delivery.join()
+    latencies.sort()
+    return latencies, perf_counter() - start
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    workers_configured = delivery.workers
+    sio.emit = slow_emit(sio.emit)
+    members_id = create_users(GROUP_SIZE)
+    group_id = create_group(members_id)
+    headers = auth_headers(members_id[0])
+    messages = {member_id: "x" * 344 for member_id in members_id}  # base64 of a RSA 2048 cipher text
+    client = app.test_client()
+
+    for workers in (0, workers_configured):
+        delivery.workers = workers
+        latencies, total = run(client, '/api/v1/group_chats/' + group_id, headers, messages)
+        name = "in the request" if workers == 0 else f"queue with {workers} workers"
+        print(f"group of {GROUP_SIZE}, {name}: mean {sum(latencies) * 1000 / MESSAGES:.2f} ms, "
+              f"p95 {latencies[int(MESSAGES * 0.95)] * 1000:.2f} ms, all delivered after {total:.2f} s")
+    print(delivery.stats())
@@ -0,0 +1,90 @@
+"""
+Bytes stored (tables and indexes) and insert time per group message with the message encrypted with RSA for every
+member (version 1) and as an envelope (version 2): the message encrypted once with AES-GCM in body and the AES key
+encrypted with RSA for every member. RSA 2048 with OAEP SHA-256 encrypts at most 190 bytes per block, a longer
+message is a list of blocks
+python benchmark/envelope.py
+"""
+import base64
+import math
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app, create_users
+
+from app.enums import MESSAGE_VERSION_RSA, MESSAGE_VERSION_ENVELOPE
+from app.extensions import db
+from app.models import Group, GroupUser, GroupMessage
+
+GROUP_SIZES = (10, 100, 1000)
+MESSAGE_SIZES = (100, 2000)
+MESSAGES = 50
+RSA_BLOCK = 190
+RSA_CIPHER = 344  # base64 of a RSA 2048 cipher text
+GCM_OVERHEAD = 12 + 16  # nonce and tag
+
+
+def rsa_cipher(size):
+    return "x" * (RSA_CIPHER * math.ceil(size / RSA_BLOCK))
+
+
+def envelope_body(size):
+    return base64.b64encode(b"x" * (size + GCM_OVERHEAD)).decode()
+
+
+def create_group(members_id):
+    group_id = str(uuid.uuid1())
+    db.session.add(Group(id=group_id, name="benchmark"))
+    db.session.bulk_insert_mappings(GroupUser, [{"user_id": user_id, "group_id": group_id} for user_id in members_id])
+    db.session.commit()
+    return group_id
+
+
+def stored_bytes():
+    """
+    Returns:
+        bytes of the pages of the message tables and of their indexes
+    """
+    if db.engine.dialect.name == 'mysql':
+        for table in ('group_messages', 'user_messages_group'):
+            db.engine.execute(f"ANALYZE TABLE {table}")
+        return db.engine.execute("SELECT SUM(stat_value) * @@innodb_page_size FROM mysql.innodb_index_stats "
+                                 "WHERE database_name = DATABASE() AND stat_name = 'size' "
+                                 "AND table_name IN ('group_messages', 'user_messages_group')").scalar()
+    return db.engine.execute("SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                             "(SELECT name FROM sqlite_master WHERE tbl_name IN "
+                             "('group_messages', 'user_messages_group'))").scalar() or 0
+
+
+def measure(members_id, version, size):
+    """
+    Returns:
+        (bytes stored per message, insert time per message in ms)
+    """
+    group_id = create_group(members_id)
+    if version == MESSAGE_VERSION_RSA:
+        messages, body = {member_id: rsa_cipher(size) for member_id in members_id}, None
+    else:
+        messages, body = {member_id: rsa_cipher(1) for member_id in members_id}, envelope_body(size)
+    before = stored_bytes()
+    elapsed = 0
+    for index in range(MESSAGES):
+        start = perf_counter()
+        GroupMessage.insert_message(str(uuid.uuid1()), members_id[0], group_id, index, messages, None, version, body)
+        db.session.commit()
+        elapsed += perf_counter() - start
+    return (stored_bytes() - before) / MESSAGES, elapsed / MESSAGES * 1000
+
+
+if __name__ == '__main__':
+    create_benchmark_app()
+    users_id = create_users(max(GROUP_SIZES))
+
+    for group_size in GROUP_SIZES:
+        for size in MESSAGE_SIZES:
+            rsa_bytes, rsa_ms = measure(users_id[:group_size], MESSAGE_VERSION_RSA, size)
+            envelope_bytes, envelope_ms = measure(users_id[:group_size], MESSAGE_VERSION_ENVELOPE, size)
+            print(f"group of {group_size}, message of {size} bytes: "
+                  f"rsa {rsa_bytes / 1024:.1f} KB {rsa_ms:.2f} ms, "
+                  f"envelope {envelope_bytes / 1024:.1f} KB {envelope_ms:.2f} ms per message, "
+                  f"rsa / envelope x{rsa_bytes / envelope_bytes:.1f}")
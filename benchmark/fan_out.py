@@ -0,0 +1,64 @@
+"""
+Emit count and payload serialization time of one group message, with one emit per session of every member and with
+one emit per member to the room of the member
+python benchmark/fan_out.py
+"""
+import json
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app
+
+from app.extensions import online_users
+from app.utils import user_room
+
+GROUP_SIZES = (20, 200, 1000)
+SESSIONS_PER_USER = 3
+CIPHER_TEXT = "x" * 344  # base64 of a RSA 2048 cipher text
+
+
+class CountingEmitter(object):
+    """
+    Stand-in of sio.emit, serializes the payload like the socket.io packet encoder does
+    """
+
+    def __init__(self):
+        self.emits = 0
+        self.serialization = 0.0
+
+    def emit(self, event, data, room=None):
+        start = perf_counter()
+        json.dumps([event, data], separators=(',', ':'))
+        self.serialization += perf_counter() - start
+        self.emits += 1
+
+
+def per_session(sio, data, members_id):
+    for member_id in members_id:
+        data["message"] = CIPHER_TEXT
+        for session_id in online_users.get_sessions(member_id):
+            sio.emit('new_group_msg', data, room=session_id)
+
+
+def per_user_room(sio, data, members_id):
+    for member_id in members_id:
+        data["message"] = CIPHER_TEXT
+        sio.emit('new_group_msg', data, room=user_room(member_id))
+
+
+if __name__ == '__main__':
+    create_benchmark_app()
+    for size in GROUP_SIZES:
+        online_users.clear()
+        members_id = [str(uuid.uuid1()) for _ in range(size)]
+        for member_id in members_id:
+            for _ in range(SESSIONS_PER_USER):
+                online_users.add(uuid.uuid4().hex, member_id)
+        data = {"id": str(uuid.uuid1()), "sender_id": members_id[0], "group_id": str(uuid.uuid1()),
+                "created_date": 1600000000}
+
+        for func in (per_session, per_user_room):
+            sio = CountingEmitter()
+            func(sio, data, members_id)
+            print(f"group of {size}, {SESSIONS_PER_USER} sessions/user, {func.__name__}: {sio.emits} emits, "
+                  f"{sio.serialization * 1000:.2f} ms serializing")
@@ -0,0 +1,40 @@
+"""
+Time generate_id and generate_ids against the character by character implementation over batches of 1k partners, cold
+and from the conversation id cache. tests/test_generate_id.py checks they give the same ids and errors
+python benchmark/generate_id.py
+"""
+import uuid
+from time import perf_counter
+
+import common  # noqa: F401, sets the environment of the app
+
+from app.extensions import conversation_ids
+from app.utils import generate_id, generate_ids, generate_id_slow
+
+PARTNERS = 1000
+ROUNDS = 20
+
+
+def timed(func):
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        func()
+    return (perf_counter() - start) / ROUNDS / PARTNERS * 10 ** 6
+
+
+if __name__ == '__main__':
+    user_id = str(uuid.uuid1())
+    partners_id = [str(uuid.uuid1()) for _ in range(PARTNERS)]
+    assert generate_ids(user_id, partners_id) == [generate_id_slow(user_id, p) for p in partners_id]
+
+    def cold():
+        conversation_ids.clear()
+        for partner_id in partners_id:
+            generate_id(user_id, partner_id)
+
+    reference = timed(lambda: [generate_id_slow(user_id, partner_id) for partner_id in partners_id])
+    single = timed(cold)
+    batch = timed(lambda: generate_ids(user_id, partners_id))
+    cached = timed(lambda: [generate_id(user_id, partner_id) for partner_id in partners_id])
+    print(f"batches of {PARTNERS} partners, per id: reference {reference:.2f} us, generate_id {single:.2f} us, "
+          f"generate_ids {batch:.2f} us, generate_id from the cache {cached:.2f} us")
@@ -0,0 +1,93 @@
+"""
+Query count and latency of GET /api/v1/chats with the old per friend queries and the page of the inbox rows
+python benchmark/get_chats.py
+"""
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app, create_users, auth_headers, QueryCounter
+
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+from app.enums import CONVERSATION_PRIVATE
+from app.extensions import db
+from app.models import Friend, Message, User, UserMessage, Conversation
+from app.utils import generate_id, get_timestamp_now
+
+FRIENDS = 500
+MESSAGES_PER_FRIEND = 5
+ROUNDS = 5
+
+
+def legacy_get_chats(page=1, page_size=10):
+    current_user_id = get_jwt_identity()
+    friends = User.get_all_friends()
+    for friend in friends:
+        group_id = generate_id(current_user_id, friend["id"])
+        message = Message.query.filter_by(group_id=group_id, seen=False) \
+            .add_columns(UserMessage.message) \
+            .join(UserMessage, Message.id == UserMessage.message_id) \
+            .filter(UserMessage.user_id == current_user_id) \
+            .order_by(Message.created_date.desc()).first()
+        friend["unseen"] = Message.query.filter_by(sender_id=friend["id"], group_id=group_id, seen=False).count()
+        friend["latest_message"] = Message.to_json(message) if message else None
+    list_chats = [friend for friend in friends if friend["latest_message"]]
+    list_chats = sorted(list_chats, key=lambda k: k["latest_message"]["created_date"], reverse=True)
+    return list_chats[(page - 1) * page_size:page * page_size]
+
+
+def seed(user_id, friends_id):
+    created_date = get_timestamp_now()
+    friends, messages, user_messages, conversations = [], [], [], []
+    for index, friend_id in enumerate(friends_id):
+        group_id = generate_id(user_id, friend_id)
+        friends.append({"id": str(uuid.uuid1()), "user_id": user_id, "friend_id": friend_id, "group_id": group_id})
+        friends.append({"id": str(uuid.uuid1()), "user_id": friend_id, "friend_id": user_id, "group_id": group_id})
+        for i in range(MESSAGES_PER_FRIEND):
+            message_id = str(uuid.uuid1())
+            sender_id, receiver_id = (friend_id, user_id) if i % 2 else (user_id, friend_id)
+            messages.append({"id": message_id, "sender_id": sender_id, "receiver_id": receiver_id,
+                             "group_id": group_id, "created_date": created_date + index * 10 + i, "seen": False})
+            user_messages.append({"message": "cipher", "user_id": user_id, "message_id": message_id})
+            user_messages.append({"message": "cipher", "user_id": friend_id, "message_id": message_id})
+        conversations.append({"user_id": user_id, "conversation_id": friend_id, "type": CONVERSATION_PRIVATE,
+                              "last_message_id": message_id, "last_sender_id": sender_id,
+                              "last_created_date": created_date + index * 10 + i, "last_message": "cipher",
+                              "unseen": MESSAGES_PER_FRIEND // 2})
+    db.session.bulk_insert_mappings(Friend, friends)
+    db.session.bulk_insert_mappings(Message, messages)
+    db.session.bulk_insert_mappings(UserMessage, user_messages)
+    db.session.bulk_insert_mappings(Conversation, conversations)
+    db.session.commit()
+
+
+def inbox_get_chats(page=1, page_size=10):
+    return Conversation.get_inbox(page_size=page_size, conversation_type=CONVERSATION_PRIVATE, page=page)
+
+
+def run(counter, func):
+    with counter.measure():
+        func()
+        queries = counter.count
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        func()
+    return queries, (perf_counter() - start) / ROUNDS
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    users_id = create_users(FRIENDS + 1)
+    seed(users_id[0], users_id[1:])
+    headers = auth_headers(users_id[0])
+    counter = QueryCounter()
+
+    with app.test_request_context(headers=headers):
+        verify_jwt_in_request()
+        legacy = legacy_get_chats()
+        inbox = inbox_get_chats()
+        assert [c["latest_message"]["id"] for c in legacy] == [row.Conversation.last_message_id for row in inbox]
+
+        for name, func in (("per friend queries", legacy_get_chats), ("inbox rows", inbox_get_chats)):
+            queries, latency = run(counter, func)
+            print(f"{name}: {FRIENDS} friends, {queries} queries, {latency * 1000:.1f} ms")
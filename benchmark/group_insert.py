@@ -0,0 +1,54 @@
+"""
+Throughput of writing a group message with one ORM object per member and with the multi-row INSERT path
+python benchmark/group_insert.py
+"""
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app, create_users
+
+from app.extensions import db
+from app.models import Group, GroupUser, GroupMessage, UserMessageGroup
+from app.utils import get_timestamp_now
+
+GROUP_SIZES = (2, 20, 200, 1000)
+MESSAGES = 50
+
+
+def create_group(members_id):
+    group_id = str(uuid.uuid1())
+    db.session.add(Group(id=group_id, name="benchmark", created_date=get_timestamp_now()))
+    db.session.bulk_insert_mappings(GroupUser, [{"user_id": user_id, "group_id": group_id} for user_id in members_id])
+    db.session.commit()
+    return group_id
+
+
+def orm_insert(sender_id, group_id, messages):
+    message_id = str(uuid.uuid1())
+    db.session.add(GroupMessage(id=message_id, sender_id=sender_id, group_id=group_id,
+                                created_date=get_timestamp_now()))
+    for member_id, message in messages.items():
+        db.session.add(UserMessageGroup(message=message, user_id=member_id, message_id=message_id, group_id=group_id))
+    db.session.commit()
+
+
+def bulk_insert(sender_id, group_id, messages):
+    GroupMessage.insert_message(str(uuid.uuid1()), sender_id, group_id, get_timestamp_now(), messages)
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    create_benchmark_app()
+    users_id = create_users(max(GROUP_SIZES))
+
+    for size in GROUP_SIZES:
+        members_id = users_id[:size]
+        group_id = create_group(members_id)
+        messages = {member_id: "x" * 344 for member_id in members_id}  # base64 of a RSA 2048 cipher text
+        rs = []
+        for func in (orm_insert, bulk_insert):
+            start = perf_counter()
+            for _ in range(MESSAGES):
+                func(members_id[0], group_id, messages)
+            rs.append(MESSAGES / (perf_counter() - start))
+        print(f"group of {size}: orm {rs[0]:.1f} msg/s, multi-row insert {rs[1]:.1f} msg/s")
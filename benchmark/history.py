@@ -0,0 +1,116 @@
+"""
+Latency of a page of the private and group message history with offset and cursor pagination at depth 1, 100 and
+10,000, then the query plan of the cursor page: the messages are read in the order of the history index from the
+cursor, no sort
+python benchmark/history.py
+"""
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app, create_users, auth_headers
+
+from flask_jwt_extended import verify_jwt_in_request
+from sqlalchemy import event
+
+from app.extensions import db
+from app.models import Message, UserMessage, Group, GroupUser, GroupMessage, UserMessageGroup
+from app.utils import generate_id
+
+PAGE_SIZE = 10
+DEPTHS = (1, 100, 10000)
+ROUNDS = 5
+
+
+def seed(user_id, partner_id, total):
+    group_id = generate_id(user_id, partner_id)
+    messages, user_messages = [], []
+    for i in range(total):
+        message_id = str(uuid.uuid1())
+        messages.append({"id": message_id, "sender_id": user_id, "receiver_id": partner_id, "group_id": group_id,
+                         "created_date": 1600000000 + i, "seen": False})
+        user_messages.append({"message": "cipher", "user_id": user_id, "message_id": message_id})
+        user_messages.append({"message": "cipher", "user_id": partner_id, "message_id": message_id})
+    db.session.bulk_insert_mappings(Message, messages)
+    db.session.bulk_insert_mappings(UserMessage, user_messages)
+    db.session.commit()
+    return group_id
+
+
+def seed_group(user_id, partner_id, total):
+    group_id = str(uuid.uuid1())
+    db.session.add(Group(id=group_id, name="benchmark"))
+    db.session.flush()
+    db.session.bulk_insert_mappings(GroupUser, [{"user_id": user_id, "group_id": group_id},
+                                                {"user_id": partner_id, "group_id": group_id}])
+    messages, user_messages = [], []
+    for i in range(total):
+        message_id = str(uuid.uuid1())
+        messages.append({"id": message_id, "sender_id": user_id, "group_id": group_id,
+                         "created_date": 1600000000 + i})
+        user_messages.append({"message": "cipher", "user_id": user_id, "group_id": group_id,
+                              "message_id": message_id})
+        user_messages.append({"message": "cipher", "user_id": partner_id, "group_id": group_id,
+                              "message_id": message_id})
+    db.session.bulk_insert_mappings(GroupMessage, messages)
+    db.session.bulk_insert_mappings(UserMessageGroup, user_messages)
+    db.session.commit()
+    return group_id
+
+
+def timed(func):
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        rs = func()
+    return rs, (perf_counter() - start) / ROUNDS
+
+
+def explain(func):
+    """
+    Returns:
+        plan of the last SELECT sent by func, EXPLAIN QUERY PLAN on sqlite and EXPLAIN on MySQL
+    """
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+    statement, parameters = [item for item in statements if item[0].lstrip().startswith('SELECT')][-1]
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    return db.engine.execute(prefix + statement, parameters).fetchall()
+
+
+def run(label, model, group_id):
+    # the cursor of the page before every depth, read once from the newest message
+    ordered = db.session.query(model.created_date, model.id).filter(model.group_id == group_id) \
+        .order_by(model.created_date.desc(), model.id.desc()).all()
+
+    for depth in DEPTHS:
+        before = tuple(ordered[(depth - 1) * PAGE_SIZE - 1]) if depth > 1 else None
+        by_offset, offset_latency = timed(
+            lambda: model.get_messages(group_id=group_id, page=depth, page_size=PAGE_SIZE))
+        by_cursor, cursor_latency = timed(
+            lambda: model.get_messages_before(group_id=group_id, before=before, page_size=PAGE_SIZE))
+        assert [row[0].id for row in by_offset] == [row[0].id for row in by_cursor]
+        print(f"{label} page {depth}: offset {offset_latency * 1000:.2f} ms, cursor {cursor_latency * 1000:.2f} ms")
+
+    for row in explain(lambda: model.get_messages_before(group_id=group_id, before=before, page_size=PAGE_SIZE)):
+        print(f"  {tuple(row)}")
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    user_id, partner_id = create_users(2)
+    total = PAGE_SIZE * max(DEPTHS)
+    private_id = seed(user_id, partner_id, total)
+    group_id = seed_group(user_id, partner_id, total)
+    headers = auth_headers(user_id)
+
+    with app.test_request_context(headers=headers):
+        verify_jwt_in_request()
+        run("private", Message, private_id)
+        run("group", GroupMessage, group_id)
@@ -0,0 +1,44 @@
+"""
+Cost of a client retrying POST /api/v1/chats/<receiver_id> with the same client_message_id: the first send, a replay
+answered by the recent messages cache and a replay read from the unique index after the cache was cleared,
+like a retry reaching another worker
+python benchmark/idempotency.py
+"""
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app, create_users, auth_headers, QueryCounter
+
+from app.extensions import recent_messages
+from app.models import Message
+
+REQUESTS = 200
+
+
+def send(client, url, headers, bodies, clear_cache=False):
+    latency = 0
+    for body in bodies:
+        if clear_cache:
+            recent_messages.clear()
+        start = perf_counter()
+        client.post(url, json=body, headers=headers)
+        latency += perf_counter() - start
+    return latency / len(bodies)
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    sender_id, receiver_id = create_users(2)
+    headers = auth_headers(sender_id)
+    client = app.test_client()
+    counter = QueryCounter()
+    url = '/api/v1/chats/' + receiver_id
+    bodies = [{"client_message_id": str(uuid.uuid4()),
+               "messages": {sender_id: "x" * 344, receiver_id: "x" * 344}} for _ in range(REQUESTS)]
+
+    for name, clear_cache in (("first send", False), ("replay, cached", False), ("replay, not cached", True)):
+        with counter.measure():
+            latency = send(client, url, headers, bodies, clear_cache)
+        print(f"{name}: {latency * 1000:.3f} ms/request, {counter.count / REQUESTS:.2f} queries/request, "
+              f"{Message.query.count()} messages stored")
+    print(recent_messages.stats())
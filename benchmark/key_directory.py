@@ -0,0 +1,108 @@
+"""
+Bytes downloaded by a client opening its inbox: the list of its friends and the info of its 10 private and 10 group
+conversations, then the keys of every participant from GET /api/v1/keys with the ETag of the previous open.
+The bytes of the same responses with the public keys embedded, like before the key directory, are rebuilt from the
+responses with the keys of the directory
+python benchmark/key_directory.py
+"""
+import json
+import uuid
+
+from common import create_benchmark_app, create_users, auth_headers
+
+from app.extensions import db
+from app.models import User, Friend, Group, GroupUser
+from app.utils import generate_key_fingerprint
+
+FRIENDS = 100
+PRIVATE_CHATS = 10
+GROUP_CHATS = 10
+GROUP_SIZE = 20
+PUB_KEY = "-----BEGIN PUBLIC KEY-----\n" + "A" * 392 + "\n-----END PUBLIC KEY-----"  # RSA 2048, PEM
+
+
+def fill():
+    """
+    Returns:
+        (user id, list friend ids, list group ids)
+    """
+    users_id = create_users(FRIENDS + 1)
+    User.query.update({User.pub_key: PUB_KEY, User.pub_key_fingerprint: generate_key_fingerprint(PUB_KEY),
+                       User.pub_key_version: 1}, synchronize_session=False)
+    user_id, friends_id = users_id[0], users_id[1:]
+    db.session.bulk_insert_mappings(Friend, [{"id": str(uuid.uuid1()), "user_id": user_id, "friend_id": friend_id,
+                                              "group_id": "-"} for friend_id in friends_id])
+    groups_id = []
+    for index in range(GROUP_CHATS):
+        group_id = str(uuid.uuid1())
+        groups_id.append(group_id)
+        db.session.add(Group(id=group_id))
+        db.session.flush()
+        members_id = [user_id] + friends_id[index * 5:index * 5 + GROUP_SIZE - 1]
+        db.session.bulk_insert_mappings(GroupUser, [{"user_id": member_id, "group_id": group_id}
+                                                    for member_id in members_id])
+    db.session.commit()
+    return user_id, friends_id, groups_id
+
+
+def embed_keys(data, keys):
+    """
+    The response as it was with the public keys: pub_key in the listings, public_key in the infos
+    """
+    if isinstance(data, list):
+        return [embed_keys(item, keys) for item in data]
+    if isinstance(data, dict):
+        rs = {}
+        for key, value in data.items():
+            if key == "key_fingerprint":
+                continue
+            if key == "key_version":
+                if "id" in data:
+                    rs["pub_key"] = keys[data["id"]]["public_key"]
+                continue
+            rs[key] = embed_keys(value, keys)
+        if "users" in data:
+            for user_id, info in rs["users"].items():
+                info["public_key"] = keys[user_id]["public_key"]
+        return rs
+    return data
+
+
+def size(body):
+    return len(json.dumps(body, separators=(",", ":")).encode())
+
+
+def open_inbox(client, headers, friends_id, groups_id, etag):
+    """
+    Returns:
+        (bytes, bytes with the keys embedded, etag, keys)
+    """
+    bodies = [client.get('/api/v1/users/friends', headers=headers).get_json()]
+    bodies += [client.get('/api/v1/chats/{}/info'.format(partner_id), headers=headers).get_json()
+               for partner_id in friends_id[:PRIVATE_CHATS]]
+    bodies += [client.get('/api/v1/group_chats/{}/info'.format(group_id), headers=headers).get_json()
+               for group_id in groups_id]
+    participants = sorted({user_id for body in bodies[1:] for user_id in body["data"]["users"]})
+
+    key_headers = dict(headers, **({"If-None-Match": etag} if etag else {}))
+    response = client.get('/api/v1/keys?users_id=' + ",".join(participants), headers=key_headers)
+    keys = response.get_json()["data"] if response.status_code == 200 else None
+    directory_bytes = len(response.data)
+    return sum(size(body) for body in bodies) + directory_bytes, bodies, response.headers.get("ETag"), keys
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    user_id, friends_id, groups_id = fill()
+    headers = auth_headers(user_id)
+    client = app.test_client()
+
+    first_bytes, bodies, etag, keys = open_inbox(client, headers, friends_id, groups_id, None)
+    embedded_bytes = sum(size(embed_keys(body, keys)) for body in bodies)
+    next_bytes, _, next_etag, _ = open_inbox(client, headers, friends_id, groups_id, etag)
+    assert next_etag == etag
+
+    print(f"inbox open, {FRIENDS} friends, {PRIVATE_CHATS} private and {GROUP_CHATS} group chats of {GROUP_SIZE}:")
+    print(f"keys embedded {embedded_bytes} bytes, first open {first_bytes} bytes, "
+          f"next opens {next_bytes} bytes (304 from the directory), saved {embedded_bytes - next_bytes} bytes "
+          f"per open, x{embedded_bytes / next_bytes:.1f}")
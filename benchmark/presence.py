@@ -0,0 +1,54 @@
+"""
+Fan-out cost of finding the sessions of the receivers with the old linear scan of online_users
+and with the PresenceRegistry indexes
+python benchmark/presence.py
+"""
+import random
+import uuid
+from timeit import timeit
+
+import common  # noqa: F401, importing the app package needs the environment set by common
+
+from app.presence import PresenceRegistry
+
+SESSIONS_PER_USER = 2
+GROUP_SIZE = 50
+ROUNDS = 20
+
+
+def build(total_sessions):
+    users_id = [str(uuid.uuid1()) for _ in range(total_sessions // SESSIONS_PER_USER)]
+    online_users = {}
+    registry = PresenceRegistry()
+    for user_id in users_id:
+        for _ in range(SESSIONS_PER_USER):
+            session_id = uuid.uuid4().hex
+            online_users[session_id] = user_id
+            registry.add(session_id, user_id)
+    return users_id, online_users, registry
+
+
+def fan_out_scan(online_users, members_id):
+    sessions = []
+    for member_id in members_id:
+        sessions.extend([key for key, value in online_users.items() if value == member_id])
+    return sessions
+
+
+def fan_out_registry(registry, members_id):
+    sessions = []
+    for member_id in members_id:
+        sessions.extend(registry.get_sessions(member_id))
+    return sessions
+
+
+if __name__ == '__main__':
+    for total_sessions in (10000, 100000):
+        users_id, online_users, registry = build(total_sessions)
+        members_id = random.sample(users_id, GROUP_SIZE)
+        assert sorted(fan_out_scan(online_users, members_id)) == sorted(fan_out_registry(registry, members_id))
+
+        scan = timeit(lambda: fan_out_scan(online_users, members_id), number=ROUNDS) / ROUNDS
+        indexed = timeit(lambda: fan_out_registry(registry, members_id), number=ROUNDS) / ROUNDS
+        print(f"{total_sessions} sessions, group of {GROUP_SIZE}: "
+              f"scan {scan * 1000:.3f} ms, registry {indexed * 1000:.3f} ms, x{scan / indexed:.0f}")
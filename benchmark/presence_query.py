@@ -0,0 +1,43 @@
+"""
+Bytes and latency for a client to know the presence of its 200 contacts while 10,000 users are online with 2 sessions
+each: downloading GET /api/v1/users/online_users and POST /api/v1/users/presence with the contact list
+python benchmark/presence_query.py
+"""
+import random
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app, create_users, auth_headers
+
+from app.extensions import online_users
+
+USERS = 20000
+ONLINE = 10000
+SESSIONS_PER_USER = 2
+CONTACTS = 200
+ROUNDS = 20
+
+
+def timed(client, method, url, headers, json=None):
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        response = client.open(url, method=method, json=json, headers=headers)
+        assert response.get_json()["status"], response.get_json()
+    return len(response.data), (perf_counter() - start) / ROUNDS
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    users_id = create_users(USERS)
+    for user_id in users_id[:ONLINE]:
+        for _ in range(SESSIONS_PER_USER):
+            online_users.add(uuid.uuid4().hex, user_id)
+    contacts_id = random.Random(2021).sample(users_id, CONTACTS)
+    headers = auth_headers(users_id[0])
+    client = app.test_client()
+
+    list_bytes, list_time = timed(client, 'GET', '/api/v1/users/online_users', headers)
+    presence_bytes, presence_time = timed(client, 'POST', '/api/v1/users/presence', headers,
+                                          {"users_id": contacts_id})
+    print(f"{ONLINE} users online, {CONTACTS} contacts: online_users {list_bytes} bytes in {list_time * 1000:.1f} ms, "
+          f"presence {presence_bytes} bytes in {presence_time * 1000:.1f} ms with the last seen dates")
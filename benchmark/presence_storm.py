@@ -0,0 +1,112 @@
+"""
+Reconnect storm after a deploy: every user connects again within STORM_SECONDS. Counts the socket.io frames and the
+CPU time of the old global 'online' broadcast and of the 'presence' diffs sent to the friends and group members every
+PRESENCE_FLUSH_INTERVAL seconds, with the socket.io test client.
+The flushes run in their background task, so the database is a sqlite file every thread opens on its own
+python benchmark/presence_storm.py
+"""
+import contextlib
+import io
+import os
+import random
+import tempfile
+import uuid
+from time import perf_counter, process_time, sleep
+
+database = os.path.join(tempfile.mkdtemp(), 'presence_storm.db')
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + database)
+os.environ.setdefault('PRESENCE_FLUSH_INTERVAL', '0.5')
+
+from common import create_benchmark_app, create_users, auth_headers
+
+from app.extensions import db, sio, presence_changes
+from app.models import Friend, Group, GroupUser
+
+USERS = 1000
+FRIENDS = 20
+GROUP_SIZE = 50
+STORM_SECONDS = 3
+
+
+def fill():
+    """
+    Every user has about FRIENDS friends and is a member of one group
+    Returns:
+        list user ids
+    """
+    users_id = create_users(USERS)
+    rng = random.Random(2021)
+    pairs = set()
+    for user_id in users_id:
+        for friend_id in rng.sample(users_id, FRIENDS // 2):
+            if friend_id != user_id:
+                pairs.add((user_id, friend_id))
+                pairs.add((friend_id, user_id))
+    db.session.bulk_insert_mappings(Friend, [{"id": str(uuid.uuid1()), "user_id": user_id, "friend_id": friend_id,
+                                              "group_id": "-"} for user_id, friend_id in pairs])
+    for start in range(0, USERS, GROUP_SIZE):
+        group_id = str(uuid.uuid1())
+        db.session.add(Group(id=group_id))
+        db.session.flush()
+        db.session.bulk_insert_mappings(GroupUser, [{"user_id": user_id, "group_id": group_id}
+                                                    for user_id in users_id[start:start + GROUP_SIZE]])
+    db.session.commit()
+    return users_id
+
+
+def frames(clients, event):
+    return sum(1 for client in clients for packet in client.get_received() if packet["name"] == event)
+
+
+def broadcast_storm(app, users_id):
+    """
+    The old auth handler: every connection is announced to every connected socket
+    """
+    clients = []
+    start = process_time()
+    for user_id in users_id:
+        clients.append(sio.test_client(app))
+        sio.emit('online', user_id, broadcast=True)
+    cpu = process_time() - start
+    count = frames(clients, 'online')
+    for client in clients:
+        client.disconnect()
+    return count, cpu
+
+
+def presence_storm(app, users_id, tokens):
+    """
+    The users connect and authenticate one after the other over STORM_SECONDS, the diffs are sent in the background
+    """
+    clients = []
+    delay = STORM_SECONDS / len(users_id)
+    start = process_time()
+    begin = perf_counter()
+    for index, user_id in enumerate(users_id):
+        client = sio.test_client(app)
+        client.emit('auth', tokens[user_id])
+        clients.append(client)
+        # keep the pace of the storm, the sleeps are not counted in the cpu time
+        sleep(max(0.0, begin + (index + 1) * delay - perf_counter()))
+    sleep(presence_changes.flush_interval * 2)
+    cpu = process_time() - start
+    count = frames(clients, 'presence')
+    stats = presence_changes.stats()
+    for client in clients:
+        client.disconnect()
+    return count, cpu, stats
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    users_id = fill()
+    tokens = {user_id: auth_headers(user_id)["Authorization"][len("Bearer "):] for user_id in users_id}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        broadcast_frames, broadcast_cpu = broadcast_storm(app, users_id)
+        presence_frames, presence_cpu, stats = presence_storm(app, users_id, tokens)
+    print(f"{USERS} users reconnecting in {STORM_SECONDS} s, {FRIENDS} friends and a group of {GROUP_SIZE} each")
+    print(f"global broadcast: {broadcast_frames} frames, {broadcast_cpu * 1000:.0f} ms cpu")
+    print(f"presence diffs every {presence_changes.flush_interval} s: {presence_frames} frames, "
+          f"{presence_cpu * 1000:.0f} ms cpu (authentication included), {stats}")
+    os.remove(database)
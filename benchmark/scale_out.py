@@ -0,0 +1,112 @@
+"""
+Delivery throughput of private messages with several workers sharing a redis server. Every worker is a
+`python main.py` process on its own port, the clients connect to the workers round-robin and the messages are posted
+round-robin too, so most deliveries cross workers through the message queue.
+Needs the database of SQLALCHEMY_DATABASE_URI migrated with migrate/init_db.py, MySQL or a sqlite file which runs but
+serializes the writes of all workers, a redis server at REDIS_URL, the pinned eventlet and the socket.io client which
+is not a dependency of the api: pip install "python-socketio[client]<5" requests
+python benchmark/scale_out.py 1 2 4
+"""
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+BASE_PORT = 5100
+CLIENTS = 100
+SENDERS = 16
+MESSAGES = 4000
+TIMEOUT = 120
+
+
+def start_workers(total):
+    env = dict(os.environ, SOCKETIO_MESSAGE_QUEUE=REDIS_URL, PRESENCE_URL=REDIS_URL)
+    workers = [subprocess.Popen([sys.executable, 'main.py'], cwd=ROOT, env=dict(env, PORT=str(BASE_PORT + i)))
+               for i in range(total)]
+    for i in range(total):
+        for _ in range(100):
+            try:
+                requests.get(url(i, '/api/v1/users/profile'))
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+    return workers
+
+
+def url(worker, path):
+    return 'http://127.0.0.1:{}{}'.format(BASE_PORT + worker, path)
+
+
+def create_users(total):
+    users = []
+    for _ in range(total):
+        username = 'bench_' + uuid.uuid4().hex[:12]
+        user_id = requests.post(url(0, '/api/v1/users'),
+                                json={"username": username, "password": "password", "pub_key": "key"}).json()["data"]["id"]
+        token = requests.post(url(0, '/api/v1/auth/login'),
+                              json={"username": username, "password": "password"}).json()["data"]["access_token"]
+        users.append((user_id, token))
+    return users
+
+
+def run(total_workers, users):
+    workers = start_workers(total_workers)
+    received = [0]
+    lock = threading.Lock()
+
+    def on_message(data):
+        with lock:
+            received[0] += 1
+
+    clients = []
+    try:
+        for i, (user_id, token) in enumerate(users):
+            client = socketio.Client()
+            client.on('new_private_msg', on_message)
+            # engine.io 3.9 answers 500 to a request without Origin when cors_allowed_origins is "*"
+            client.connect(url(i % total_workers, ''), headers={'Origin': url(i % total_workers, '')})
+            client.emit('auth', token)
+            clients.append(client)
+        time.sleep(1)
+
+        def send(i):
+            sender_id, token = users[i % len(users)]
+            receiver_id, _ = random.choice(users)
+            requests.post(url(i % total_workers, '/api/v1/chats/' + receiver_id),
+                          json={"messages": {sender_id: "cipher", receiver_id: "cipher"}},
+                          headers={"Authorization": "Bearer " + token})
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=SENDERS) as executor:
+            list(executor.map(send, range(MESSAGES)))
+        while received[0] < MESSAGES and time.perf_counter() - start < TIMEOUT:
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        print(f"{total_workers} workers: {received[0]}/{MESSAGES} delivered, {received[0] / elapsed:.0f} msg/s")
+    finally:
+        for client in clients:
+            client.disconnect()
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 2, 4]
+    workers = start_workers(1)
+    try:
+        bench_users = create_users(CLIENTS)
+    finally:
+        workers[0].terminate()
+        workers[0].wait()
+    for count in counts:
+        run(count, bench_users)
@@ -0,0 +1,79 @@
+"""
+Latency and size of the results of the user search before (LIKE '%text%' on username and display name, every match)
+and with User.search (FULLTEXT ngram index on MySQL, username prefix on index_username elsewhere, ranked and capped).
+Set SQLALCHEMY_DATABASE_URI to a MySQL database to measure the ngram index, BENCHMARK_USERS to change the size
+python benchmark/search_user.py
+"""
+import os
+import random
+import string
+import uuid
+from time import perf_counter
+
+from common import create_benchmark_app
+
+from app.enums import SEARCH_LIMIT
+from app.extensions import db
+from app.models import User
+from app.utils import get_timestamp_now
+
+USERS = int(os.environ.get('BENCHMARK_USERS', 1000000))
+CHUNK_SIZE = 50000
+ROUNDS = 5
+
+
+def random_name(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 12)))
+
+
+def fill(rng):
+    """
+    Returns:
+        list usernames
+    """
+    usernames = []
+    created_date = get_timestamp_now()
+    for start in range(0, USERS, CHUNK_SIZE):
+        rows = []
+        for _ in range(min(CHUNK_SIZE, USERS - start)):
+            username = random_name(rng)
+            usernames.append(username)
+            rows.append({"id": str(uuid.uuid1()), "username": username, "password_hash": "-", "pub_key": "-",
+                         "display_name": "{} {}".format(random_name(rng).title(), random_name(rng).title()),
+                         "created_date": created_date})
+        db.session.execute(User.__table__.insert(), rows)
+    db.session.commit()
+    return usernames
+
+
+def like_search(text_search):
+    text_search = "%{}%".format(text_search)
+    return User.query.filter((User.username.like(text_search)) | (User.display_name.like(text_search))).all()
+
+
+def timed(func, text_search):
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        rs = func(text_search)
+        db.session.expunge_all()
+    return len(rs), (perf_counter() - start) / ROUNDS * 1000
+
+
+if __name__ == '__main__':
+    create_benchmark_app()
+    rng = random.Random(2021)
+    start = perf_counter()
+    usernames = fill(rng)
+    print(f"{USERS} users on {db.engine.dialect.name} inserted in {perf_counter() - start:.1f} s")
+
+    texts = {
+        "exact username": usernames[USERS // 2],
+        "username prefix": usernames[USERS // 3][:4],
+        "two letters": usernames[USERS // 4][:2],
+        "inside a name": usernames[USERS // 5][1:5],
+    }
+    for label, text_search in texts.items():
+        like_count, like_ms = timed(like_search, text_search)
+        search_count, search_ms = timed(User.search, text_search)
+        print(f"{label} '{text_search}': LIKE {like_count} users in {like_ms:.1f} ms, "
+              f"search {search_count} users (limit {SEARCH_LIMIT}) in {search_ms:.1f} ms")
@@ -0,0 +1,44 @@
+"""
+Messages per second of one client sending private messages with POST /api/v1/chats/<receiver_id> and with the
+socket event private_chat on its authenticated connection, both in process with the flask and socket.io test clients
+python benchmark/socket_send.py
+"""
+from time import perf_counter
+
+from common import create_benchmark_app, create_users, auth_headers
+
+from app.extensions import sio
+
+MESSAGES = 1000
+
+
+def send_http(client, sender_id, receiver_id, headers):
+    messages = {sender_id: "x" * 344, receiver_id: "x" * 344}  # base64 of a RSA 2048 cipher text
+    start = perf_counter()
+    for _ in range(MESSAGES):
+        rs = client.post('/api/v1/chats/' + receiver_id, json={"messages": messages}, headers=headers).get_json()
+        assert rs["status"], rs
+    return MESSAGES / (perf_counter() - start)
+
+
+def send_socket(socket_client, sender_id, receiver_id):
+    messages = {sender_id: "x" * 344, receiver_id: "x" * 344}
+    start = perf_counter()
+    for _ in range(MESSAGES):
+        ack = socket_client.emit('private_chat', {"receiver_id": receiver_id, "messages": messages}, callback=True)
+        assert ack["status"] and ack["data"]["id"], ack
+    return MESSAGES / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    sender_id, receiver_id = create_users(2)
+    headers = auth_headers(sender_id)
+
+    http_rate = send_http(app.test_client(), sender_id, receiver_id, headers)
+
+    socket_client = sio.test_client(app)
+    socket_client.emit('auth', headers["Authorization"][len("Bearer "):])
+    socket_rate = send_socket(socket_client, sender_id, receiver_id)
+
+    print(f"http {http_rate:.1f} msg/s, socket {socket_rate:.1f} msg/s, x{socket_rate / http_rate:.2f}")
@@ -0,0 +1,34 @@
+"""
+Auth overhead of an authenticated request with the revocation cache on and off
+python benchmark/token_cache.py
+"""
+from time import perf_counter
+
+from common import create_benchmark_app, create_users, auth_headers, QueryCounter
+
+from app.extensions import revoked_tokens
+
+REQUESTS = 2000
+
+
+def run(client, headers, counter):
+    with counter.measure():
+        start = perf_counter()
+        for _ in range(REQUESTS):
+            client.get('/api/v1/users/profile', headers=headers)
+        return (perf_counter() - start) / REQUESTS, counter.count / REQUESTS
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    users_id = create_users(1)
+    headers = auth_headers(users_id[0])
+    client = app.test_client()
+    counter = QueryCounter()
+
+    for enabled in (False, True):
+        revoked_tokens.enabled = enabled
+        revoked_tokens.clear()
+        latency, queries = run(client, headers, counter)
+        print(f"cache {'on' if enabled else 'off'}: {latency * 1000:.3f} ms/request, {queries:.2f} queries/request, "
+              f"{revoked_tokens.stats()}")
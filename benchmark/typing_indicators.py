@@ -0,0 +1,83 @@
+"""
+Frames, statements and time of 1000 keystrokes of a user in a group of 50 members who are all connected: the old
+handler which sends every keystroke to every member and the typing indicators which only send the transitions
+python benchmark/typing_indicators.py
+"""
+import contextlib
+import io
+import uuid
+from time import perf_counter, sleep
+
+from common import create_benchmark_app, create_users, auth_headers, QueryCounter
+
+from app.extensions import db, sio, group_members, typing_indicators
+from app.models import Group, GroupUser
+from app.utils import emit_to_user
+
+GROUP_SIZE = 50
+KEYSTROKES = 1000
+
+
+def old_typing(current_user_id, payload):
+    """
+    The handler before the typing indicators, with the members read through the membership cache
+    """
+    conversation_id = payload.get('conversationId', None)
+    group_members_id = GroupUser.get_members_id(conversation_id)
+    members_id = [conversation_id]
+    if group_members_id:
+        members_id = [member_id for member_id in group_members_id if member_id != current_user_id]
+    else:
+        payload['conversationId'] = current_user_id
+    for member_id in members_id:
+        emit_to_user('typing', payload, member_id)
+
+
+def frames(clients):
+    return sum(1 for client in clients for packet in client.get_received() if packet["name"] == "typing")
+
+
+if __name__ == '__main__':
+    app = create_benchmark_app()
+    users_id = create_users(GROUP_SIZE)
+    group_id = str(uuid.uuid1())
+    db.session.add(Group(id=group_id))
+    db.session.flush()
+    db.session.bulk_insert_mappings(GroupUser, [{"user_id": user_id, "group_id": group_id} for user_id in users_id])
+    db.session.commit()
+    counter = QueryCounter()
+
+    clients = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for user_id in users_id:
+            client = sio.test_client(app)
+            client.emit('auth', auth_headers(user_id)["Authorization"][len("Bearer "):])
+            clients.append(client)
+    frames(clients)
+    typist, sender_id = clients[0], users_id[0]
+
+    for label, cached in (("cold cache", False), ("warm cache", True)):
+        if not cached:
+            group_members.clear()
+        with counter.measure():
+            start = perf_counter()
+            for _ in range(KEYSTROKES):
+                old_typing(sender_id, {"conversationId": group_id, "isTyping": True})
+            old_time = perf_counter() - start
+        old_frames, old_queries = frames(clients), counter.count
+
+        if not cached:
+            group_members.clear()
+        with counter.measure():
+            start = perf_counter()
+            for _ in range(KEYSTROKES):
+                typist.emit('typing', {"conversationId": group_id, "isTyping": True})
+            typist.emit('typing', {"conversationId": group_id, "isTyping": False})
+            new_time = perf_counter() - start
+            # the stop came within the interval of the start, the sweep sends it
+            sleep(typing_indicators.interval)
+            typing_indicators.sweep()
+        new_frames, new_queries = frames(clients), counter.count
+        print(f"{label}, {KEYSTROKES} keystrokes in a group of {GROUP_SIZE}: "
+              f"old {old_frames} frames, {old_queries} statements, {old_time * 1000:.0f} ms; "
+              f"indicators {new_frames} frames, {new_queries} statements, {new_time * 1000:.0f} ms")
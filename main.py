@@ -1,3 +1,11 @@
+import eventlet
+
+# patch the standard library before anything else imports it, the redis client of the socket.io message queue and
+# of the presence needs the green socket
+eventlet.monkey_patch()
+
+import os
+
 from app.app import create_app
 from app.extensions import sio
 
@@ -12,4 +20,4 @@ if __name__ == '__main__':
     Main Application
     python main.py
     """
-    sio.run(app, host='0.0.0.0', port=5010)
+    sio.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5010)))
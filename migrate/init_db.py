@@ -5,19 +5,27 @@ import os, sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
+from sqlalchemy import inspect, func
+from sqlalchemy.schema import CreateColumn
+
 from app.extensions import db
-from app.models import User
+from app.ids import binary_ids
+from app.enums import CONVERSATION_PRIVATE, CONVERSATION_GROUP
+from app.models import User, Friend, Message, UserMessage, Group, GroupUser, GroupMessage, UserMessageGroup, \
+    Conversation
 from app.settings import AppConfig
+from app.utils import generate_id
 
 CONFIG = AppConfig
 default_file = "migrate/default.json"
 
 
 class Worker:
-    def __init__(self):
+    def __init__(self, upgrade=False):
         app = Flask(__name__)
 
         app.config.from_object(CONFIG)
+        binary_ids.init_app(app)
         db.app = app
         db.init_app(app)
         app_context = app.app_context()
@@ -26,8 +34,9 @@ class Worker:
         print("=" * 25,
               f"Starting migrate database on the uri: {CONFIG.SQLALCHEMY_DATABASE_URI}",
               "=" * 25)
-        db.drop_all()  # drop all tables
-        db.create_all()  # create a new schema
+        if not upgrade:
+            db.drop_all()  # drop all tables
+        db.create_all()  # create a new schema, on upgrade only the missing tables are created
 
         with open(default_file, encoding='utf-8') as file:
             self.default_data = json.load(file)
@@ -42,8 +51,141 @@ class Worker:
 
         db.session.commit()
 
+    @staticmethod
+    def add_missing_columns():
+        """
+        Add the columns declared in the models which do not exist in the tables of the database yet
+        """
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            existed = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existed:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    print(f"Add column {column.name} to {table.name}")
+                    db.engine.execute(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+    @staticmethod
+    def create_missing_indexes():
+        """
+        Create the indexes declared in the models which do not exist in the database yet
+        """
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            existed = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existed:
+                    print(f"Create index {index.name} on {table.name}")
+                    index.create(bind=db.engine)
+
+    @staticmethod
+    def backfill_conversations():
+        """
+        Build the conversations of the messages written before the conversations table existed
+        """
+        existed = set(db.session.query(Conversation.user_id, Conversation.conversation_id).all())
+        rows = []
+
+        for friend in Friend.query.all():
+            if (friend.user_id, friend.friend_id) in existed:
+                continue
+            latest = db.session.query(Message, UserMessage.message) \
+                .join(UserMessage, Message.id == UserMessage.message_id) \
+                .filter(Message.group_id == friend.group_id, UserMessage.user_id == friend.user_id) \
+                .order_by(Message.created_date.desc()).first()
+            if latest is None:
+                continue
+            unseen = Message.query.filter_by(sender_id=friend.friend_id, group_id=friend.group_id, seen=False).count()
+            existed.add((friend.user_id, friend.friend_id))
+            rows.append({"user_id": friend.user_id, "conversation_id": friend.friend_id, "type": CONVERSATION_PRIVATE,
+                         "last_message_id": latest.Message.id, "last_sender_id": latest.Message.sender_id,
+                         "last_created_date": latest.Message.created_date, "last_message": latest.message,
+                         "unseen": unseen, "last_seen_date": 0})
+
+        for member in GroupUser.query.all():
+            if (member.user_id, member.group_id) in existed:
+                continue
+            latest = db.session.query(GroupMessage, UserMessageGroup.message) \
+                .join(UserMessageGroup, GroupMessage.id == UserMessageGroup.message_id) \
+                .filter(GroupMessage.group_id == member.group_id, UserMessageGroup.user_id == member.user_id) \
+                .order_by(GroupMessage.created_date.desc()).first()
+            if latest is None:
+                continue
+            unseen = UserMessageGroup.query.filter_by(user_id=member.user_id, group_id=member.group_id,
+                                                      seen=False).count()
+            existed.add((member.user_id, member.group_id))
+            rows.append({"user_id": member.user_id, "conversation_id": member.group_id, "type": CONVERSATION_GROUP,
+                         "last_message_id": latest.GroupMessage.id, "last_sender_id": latest.GroupMessage.sender_id,
+                         "last_created_date": latest.GroupMessage.created_date, "last_message": latest.message,
+                         "unseen": unseen, "last_seen_date": 0})
+
+        if rows:
+            db.session.execute(Conversation.__table__.insert(), rows)
+        db.session.commit()
+        print(f"{len(rows)} conversations created")
+
+    @staticmethod
+    def backfill_seen_dates():
+        """
+        Set the read watermark of the conversations never read since the upgrade from the seen flags of the messages,
+        the watermark is the date of the latest message of the other users marked as seen
+        """
+        conversations = Conversation.query.filter(Conversation.last_seen_date == 0).all()
+        for conversation in conversations:
+            if conversation.type == CONVERSATION_PRIVATE:
+                group_id = generate_id(conversation.user_id, conversation.conversation_id)
+                seen_date = db.session.query(func.max(Message.created_date)) \
+                    .filter(Message.group_id == group_id, Message.sender_id == conversation.conversation_id,
+                            Message.seen == True).scalar()
+            else:
+                seen_date = db.session.query(func.max(GroupMessage.created_date)) \
+                    .join(UserMessageGroup, GroupMessage.id == UserMessageGroup.message_id) \
+                    .filter(UserMessageGroup.user_id == conversation.user_id,
+                            UserMessageGroup.group_id == conversation.conversation_id,
+                            GroupMessage.sender_id != conversation.user_id, UserMessageGroup.seen == True).scalar()
+            conversation.last_seen_date = seen_date or 0
+        db.session.commit()
+        print(f"{len(conversations)} read watermarks set")
+
+    @staticmethod
+    def backfill_members_hash():
+        """
+        Compute the members fingerprint of the groups created before the column existed
+        """
+        groups = Group.query.filter(Group.members_hash.is_(None)).all()
+        for group in groups:
+            group.update_members_hash()
+        db.session.commit()
+        print(f"{len(groups)} groups fingerprinted")
+
+    @staticmethod
+    def backfill_key_fingerprints():
+        """
+        Compute the fingerprint of the public keys stored before the column existed
+        """
+        users = User.query.filter(User.pub_key_fingerprint.is_(None)).all()
+        for user in users:
+            user.set_pub_key(user.pub_key)
+        db.session.commit()
+        print(f"{len(users)} public keys fingerprinted")
+
 
 if __name__ == '__main__':
-    worker = Worker()
-    worker.insert_default_users()
+    """
+    python migrate/init_db.py               create a new database with the default users
+    python migrate/init_db.py --upgrade     keep the data, add the missing tables, columns and indexes
+                                            then fill the new columns and tables
+    """
+    if '--upgrade' in sys.argv:
+        worker = Worker(upgrade=True)
+        worker.add_missing_columns()
+        worker.create_missing_indexes()
+        worker.backfill_conversations()
+        worker.backfill_seen_dates()
+        worker.backfill_members_hash()
+        worker.backfill_key_fingerprints()
+    else:
+        worker = Worker()
+        worker.insert_default_users()
+        worker.backfill_key_fingerprints()
     print("=" * 50, "Database migration completed", "=" * 50)
@@ -0,0 +1,91 @@
+"""
+generate_id and generate_ids against the character by character implementation generate_id_slow
+python -m pytest tests
+"""
+import os
+import random
+import string
+import sys
+import uuid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+os.environ.setdefault('URL_SERVER', 'http://localhost:5010')
+
+import pytest
+
+from app.extensions import conversation_ids
+from app.utils import generate_id, generate_ids, generate_id_slow
+
+CHECKS = 100000
+BASE36 = string.digits + string.ascii_lowercase
+
+
+def random_id(rng):
+    """
+    Returns:
+        canonical uuid, id made by generate_id or a malformed id, malformed ids make the reference raise or produce
+        a result from the characters it reads
+    """
+    kind = rng.random()
+    if kind < 0.4:
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+    if kind < 0.7:
+        s = "".join(rng.choice(BASE36) for _ in range(32))
+        return "{}-{}-{}-{}-{}".format(s[:8], s[8:12], s[12:16], s[16:20], s[20:])
+    chars = list(str(uuid.UUID(int=rng.getrandbits(128))))
+    for _ in range(rng.randint(1, 3)):
+        chars[rng.randrange(len(chars))] = rng.choice(BASE36 + "-_ AZé")
+    if rng.random() < 0.2:
+        chars = chars[:rng.randrange(len(chars))] if rng.random() < 0.5 else chars + list("0a")
+    return "".join(chars)
+
+
+def outcome(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:  # the error of the reference is part of its behaviour
+        return type(e)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    conversation_ids.clear()
+    yield
+    conversation_ids.clear()
+
+
+def test_same_ids_and_errors_as_reference():
+    rng = random.Random(2021)
+    for _ in range(CHECKS):
+        id1, id2 = random_id(rng), random_id(rng)
+        expected = outcome(generate_id_slow, id1, id2)
+        assert outcome(generate_id, id1, id2) == expected, (id1, id2)
+        assert outcome(generate_id, id2, id1) == outcome(generate_id_slow, id2, id1), (id2, id1)
+        assert outcome(generate_ids, id1, [id2]) == (expected if isinstance(expected, type) else [expected]), \
+            (id1, id2)
+
+
+@pytest.mark.parametrize("value", [None, 1, b"0" * 36, ""])
+def test_same_errors_as_reference_on_other_types(value):
+    partner_id = str(uuid.uuid1())
+    assert outcome(generate_id, value, partner_id) == outcome(generate_id_slow, value, partner_id)
+
+
+def test_symmetric():
+    rng = random.Random(2022)
+    for _ in range(1000):
+        id1, id2 = str(uuid.UUID(int=rng.getrandbits(128))), str(uuid.UUID(int=rng.getrandbits(128)))
+        assert generate_id(id1, id2) == generate_id(id2, id1)
+
+
+def test_cached_id_is_the_same():
+    id1, id2 = str(uuid.uuid1()), str(uuid.uuid1())
+    cold = generate_id(id1, id2)
+    assert generate_id(id1, id2) == cold == generate_id_slow(id1, id2)
+
+
+def test_batch_matches_reference():
+    user_id = str(uuid.uuid1())
+    partners_id = [str(uuid.uuid1()) for _ in range(1000)]
+    assert generate_ids(user_id, partners_id) == [generate_id_slow(user_id, p) for p in partners_id]